@@ -0,0 +1,153 @@
+from collections import OrderedDict
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, inspect, text
+
+from bulk_writer import TX_COLUMNS
+from transactions import Transaction
+
+
+#CONFIGURATION
+NORMALIZED_KEYS = False          # New DBs (and -n) store account ids instead of public keys in `transaction`
+ACCOUNT_CACHE_SIZE = 1 << 20     # public key -> id entries kept by the writer (LRU)
+
+#####################################################################################################################
+
+# Optional normalized storage of the public keys of `transaction`: every key is stored once in `account`
+# and transaction rows keep its 4-byte id (tx_transactor_id, ...) instead of the 55 chars of Base58Check.
+# Rows shrink, so do their indexes, and joins/group bys compare integers.
+# The writer resolves keys through an LRU cache, only keys it has never met cost a round trip (one per batch).
+# Readers needing the keys use the `transaction_keyed` view (same columns of the model), see tx_source().
+# creator_base58 holds usernames for (DAO) creator coin transfers: they get an id like keys do.
+#   python accounts.py normalize   (converts an existing DB in place, then VACUUM FULL "transaction" to reclaim space)
+
+metadata = MetaData()
+
+account = Table('account', metadata,
+                Column('account_id', Integer, primary_key=True),
+                Column('public_key', String, nullable=False, unique=True))
+
+KEY_COLUMNS = {'tx_transactor_base58': 'tx_transactor_id',
+               'other_us_base58': 'other_us_id',
+               'node_recipient_base58': 'node_recipient_id',
+               'creator_base58': 'creator_id'}
+
+KEY_POSITIONS = [TX_COLUMNS.index(column) for column in KEY_COLUMNS]
+NORMALIZED_COLUMNS = [KEY_COLUMNS.get(column, column) for column in TX_COLUMNS]   # Written by COPY/insert
+INDEXED_IDS = ['tx_transactor_id']                      # Same access path of ix_transaction_tx_transactor_base58
+
+VIEW = 'transaction_keyed'
+
+# The view as a table of the model columns, to build queries on
+transaction_keyed = Table(VIEW, MetaData(), *(Column(c.name, c.type) for c in Transaction.__table__.columns))
+
+
+def is_normalized(conn):
+    return 'tx_transactor_id' in {c['name'] for c in inspect(conn).get_columns('transaction')}
+
+
+# Table to read transactions with their public keys from
+def tx_source(conn):
+    return transaction_keyed if is_normalized(conn) else Transaction.__table__
+
+
+# Recreated on every start: follows the columns of the model after migrations
+def create_view(conn):
+    columns, joins = [], []
+    for column in TX_COLUMNS:
+        if (column in KEY_COLUMNS):
+            alias = 'a{}'.format(len(joins))
+            columns.append('{}.public_key AS {}'.format(alias, column))
+            joins.append('LEFT JOIN account {0} ON {0}.account_id = t.{1}'.format(alias, KEY_COLUMNS[column]))
+        else:
+            columns.append('t.{}'.format(column))
+    conn.execute(text('DROP VIEW IF EXISTS {}'.format(VIEW)))
+    conn.execute(text('CREATE VIEW {} AS SELECT {} FROM "transaction" t {}'.format(VIEW, ', '.join(columns), ' '.join(joins))))
+
+
+def drop_view(conn):
+    conn.execute(text('DROP VIEW IF EXISTS {}'.format(VIEW)))
+
+
+# Key columns -> id columns, keys already stored are interned first (instant on an empty table)
+def normalize(conn):
+    account.create(conn, checkfirst=True)
+    keys = ' UNION '.join('SELECT {} AS k FROM "transaction"'.format(column) for column in KEY_COLUMNS)
+    conn.execute(text('INSERT INTO account (public_key) SELECT k FROM ({}) keys WHERE k IS NOT NULL ORDER BY k '
+                      'ON CONFLICT DO NOTHING'.format(keys)))
+
+    for column, id_column in KEY_COLUMNS.items():
+        conn.execute(text('ALTER TABLE "transaction" ADD COLUMN {} INTEGER'.format(id_column)))
+    conn.execute(text('UPDATE "transaction" t SET {}'.format(', '.join(
+        '{} = (SELECT account_id FROM account WHERE public_key = t.{})'.format(id_column, column) for column, id_column in KEY_COLUMNS.items()))))
+    for column in KEY_COLUMNS:
+        conn.execute(text('ALTER TABLE "transaction" DROP COLUMN {}'.format(column)))
+    for id_column in INDEXED_IDS:
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_transaction_{0} ON "transaction" ({0})'.format(id_column)))
+    create_view(conn)
+
+
+# public key -> account id for the writer, ids are created in their own (committed) DB transaction
+# so a cached id is always valid, whatever happens to the batch using it
+class AccountIds:
+
+    columns = NORMALIZED_COLUMNS
+
+    def __init__(self, engine, size=ACCOUNT_CACHE_SIZE):
+        self.engine = engine
+        self.size = size
+        self.cache = OrderedDict()
+
+    def ids(self, keys):
+        found, missing = {}, []
+        for key in keys:
+            account_id = self.cache.get(key)
+            if (account_id is None):
+                missing.append(key)
+            else:
+                self.cache.move_to_end(key)
+                found[key] = account_id
+
+        if (missing):
+            # Sorted inserts: concurrent writers (backfill) lock new keys in the same order, no deadlock
+            with self.engine.begin() as conn:
+                conn.execute(text('INSERT INTO account (public_key) SELECT k FROM unnest(CAST(:keys AS varchar[])) k '
+                                  'WHERE NOT EXISTS (SELECT 1 FROM account WHERE public_key = k) ORDER BY k ON CONFLICT DO NOTHING'),
+                             {'keys': sorted(missing)})
+                rows = conn.execute(text('SELECT public_key, account_id FROM account WHERE public_key = ANY(:keys)'), {'keys': missing})
+            for key, account_id in rows:
+                found[key] = account_id
+                self.cache[key] = account_id
+            while (len(self.cache) > self.size):
+                self.cache.popitem(last=False)
+        return found
+
+    # Rows in TX_COLUMNS order -> rows in NORMALIZED_COLUMNS order
+    def normalize_rows(self, txs):
+        ids = self.ids({tx[p] for tx in txs for p in KEY_POSITIONS if tx[p] is not None})
+        rows = []
+        for tx in txs:
+            row = list(tx)
+            for p in KEY_POSITIONS:
+                if (row[p] is not None):
+                    row[p] = ids[row[p]]
+            rows.append(row)
+        return rows
+
+
+if __name__ == '__main__':
+    import sys
+    import databaseDTO
+
+    sys.argv, args = sys.argv[:1], sys.argv[1:]
+    if (args != ['normalize']):
+        print("usage: accounts.py normalize")
+        exit(-1)
+
+    databaseDTO.bootstrap_db()
+    with databaseDTO.engine.begin() as conn:
+        if (is_normalized(conn)):
+            print(" - Already normalized -")
+            exit(0)
+        normalize(conn)
+        print(" - {} accounts, run VACUUM FULL \"transaction\" to reclaim the space of the keys -".format(
+            conn.execute(text('SELECT count(*) FROM account')).scalar()))
@@ -0,0 +1,207 @@
+import asyncio
+import multiprocessing
+import os
+import socket
+import sys
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, text
+
+import databaseDTO
+import main
+from parse_pool import PARSE_PROCESSES
+
+
+#CONFIGURATION
+SHARD_SIZE = 10000        # Block heights per shard
+LEASE_SECONDS = 300       # A shard not renewed for this long is given to another worker
+WORKER_PROCESSES = 4      # Workers started by `backfill.py work` on this host
+
+#####################################################################################################################
+
+# Range-sharded backfill: the height interval is split into shards kept in the `backfill_shard` table,
+# any number of worker processes (on any host reaching the DB) claim a shard with a lease, fetch the blocks
+# of its heights (asked to the node by height, no chain walk) and mark it done. Leases are renewed while
+# working: a crashed worker stops renewing and its shard is claimed again once the lease expires.
+# Shards resume like iterative_fetch (complete blocks skipped, partial ones completed), then the usual
+# integrity_check verifies the hash links between the shards. With a partitioned `transaction` and shards of the
+# partition size, a shard whose partition doesn't exist yet is loaded detached and attached once complete.
+#   python backfill.py plan [shard_size] [low high]   (default: 1 - node tip)
+#   python backfill.py work [processes]
+#   python backfill.py status
+
+backfill_shard = Table('backfill_shard', MetaData(),
+                       Column('start_height', Integer, primary_key=True),
+                       Column('end_height', Integer),     # Included
+                       Column('status', String),          # pending | leased | done
+                       Column('worker', String),
+                       Column('lease_until', DateTime),
+                       Column('attempts', Integer),
+                       Column('updated_at', DateTime))
+
+
+# Shards end on multiples of size: with the partition size, every whole shard is the range of a partition
+def plan_shards(engine, low, high, size=SHARD_SIZE):
+    backfill_shard.create(engine, checkfirst=True)
+    with engine.begin() as conn:
+        for start in [low] + list(range(low // size * size + size, high + 1, size)):
+            conn.execute(text("INSERT INTO backfill_shard (start_height, end_height, status, attempts, updated_at) "
+                              "VALUES (:start, :end, 'pending', 0, now()) ON CONFLICT (start_height) DO NOTHING"),
+                         {'start': start, 'end': min(start // size * size + size - 1, high)})
+
+
+# Highest pending (or expired) shard -> leased to worker, None when nothing is left.
+# SKIP LOCKED: concurrent claims never wait on each other nor take the same shard
+def claim_shard(engine, worker):
+    with engine.begin() as conn:
+        return conn.execute(text("UPDATE backfill_shard SET status = 'leased', worker = :worker, attempts = attempts + 1, "
+                                 "lease_until = now() + make_interval(secs => :lease), updated_at = now() "
+                                 "WHERE start_height = (SELECT start_height FROM backfill_shard "
+                                 "                      WHERE status = 'pending' OR (status = 'leased' AND lease_until < now()) "
+                                 "                      ORDER BY start_height DESC LIMIT 1 FOR UPDATE SKIP LOCKED) "
+                                 "RETURNING start_height, end_height"),
+                            {'worker': worker, 'lease': LEASE_SECONDS}).one_or_none()
+
+
+# False if the lease has been lost (expired and claimed by someone else)
+def renew_lease(engine, start, worker):
+    with engine.begin() as conn:
+        return conn.execute(text("UPDATE backfill_shard SET lease_until = now() + make_interval(secs => :lease), updated_at = now() "
+                                 "WHERE start_height = :start AND worker = :worker AND status = 'leased'"),
+                            {'start': start, 'worker': worker, 'lease': LEASE_SECONDS}).rowcount == 1
+
+
+def complete_shard(engine, start, worker):
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE backfill_shard SET status = 'done', lease_until = NULL, updated_at = now() "
+                          "WHERE start_height = :start AND worker = :worker"), {'start': start, 'worker': worker})
+
+
+def shard_status(engine):
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT status, count(*), sum(end_height - start_height + 1) FROM backfill_shard "
+                                 "GROUP BY status ORDER BY status")).fetchall()
+
+
+# ------------------------------- Workers ------------------------------------
+
+async def backfill_range(client, start, end, parse_processes):
+    resume = await main.run_db(databaseDTO.resume_plan, (start, end))
+    stored = await main.run_db(databaseDTO.stored_hashes, start, end)
+
+    # Missing heights are fetched by height, partial blocks by hash (their stored txs are known by hash)
+    async def jobs():
+        for height in range(end, start - 1, -1):
+            b_hash = stored.get(height)
+            if (b_hash is None):
+                yield height, height, "clean"
+            else:
+                yield height, b_hash, resume.action(b_hash)
+
+    async def fetch_raw(key):
+        if (isinstance(key, int)):
+            return await client.get_full_block_raw_by_height(key)
+        return await client.get_full_block_raw(key)
+
+    # The range of a partition not created yet is loaded detached and attached at once (partitioning.py)
+    if (not await main.run_db(databaseDTO.is_new_partition, start, end)):
+        await main._ingest(fetch_raw, jobs(), end - start + 1, resume.stored_tx_ids,
+                           main.FETCH_WORKERS * client.size, parse_processes)
+        return
+    blocks = []
+    await main._ingest(fetch_raw, jobs(), end - start + 1, resume.stored_tx_ids,
+                       main.FETCH_WORKERS * client.size, parse_processes, collect=blocks.append)
+    await main.run_db(databaseDTO.load_partition, start, blocks)
+
+
+# Returns True once the lease is lost and task cancelled: any other cancellation of task is a shutdown
+async def keep_lease(start, worker, task):
+    while True:
+        await asyncio.sleep(LEASE_SECONDS / 3)
+        if (not await asyncio.to_thread(renew_lease, databaseDTO.engine, start, worker)):
+            task.cancel('lease lost')
+            return True
+
+
+async def _work(worker, parse_processes):
+    async with main.open_source() as client:
+        while True:
+            shard = await asyncio.to_thread(claim_shard, databaseDTO.engine, worker)
+            if (shard is None):
+                return
+            start, end = shard
+            print(" - {}: shard {} - {} -".format(worker, start, end))
+
+            task = asyncio.create_task(backfill_range(client, start, end, parse_processes))
+            renewal = asyncio.create_task(keep_lease(start, worker, task))
+            try:
+                await task
+            except asyncio.CancelledError:
+                lease_lost = renewal.done() and not renewal.cancelled() and renewal.result()
+                if (not lease_lost or asyncio.current_task().cancelling()):
+                    raise
+                # Rows of the shard still buffered would be written along with the next one: the new owner writes them
+                await main.run_db(databaseDTO.abort_pending)
+                print(" - {}: lease of shard {} lost, skipped -".format(worker, start))
+                continue
+            finally:
+                renewal.cancel()
+
+            await asyncio.to_thread(complete_shard, databaseDTO.engine, start, worker)
+
+
+# One worker process: own DB connection, own client, claims shards until none is left
+def work(parse_processes=0):
+    main.CACHE_DIR = ''  # The block cache is written by a single process
+    databaseDTO.bootstrap_db()
+    worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+    asyncio.run(_work(worker, parse_processes))
+
+
+def start_workers(processes=WORKER_PROCESSES):
+    # Parse processes are shared out among the workers of this host
+    parse_processes = PARSE_PROCESSES // processes
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=work, args=(parse_processes,), name='backfill_{}'.format(i)) for i in range(processes)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+    databaseDTO.catch_up_order_book()
+
+
+def node_tip():
+    async def tip():
+        async with main.open_source() as client:
+            return (await client.get_last_block())['Header']['Height']
+    return asyncio.run(tip())
+
+
+if __name__ == '__main__':
+    # Positional arguments, --long options (i.e. --source) are left to main.open_source
+    args, argv = [], iter(sys.argv[1:])
+    for arg in argv:
+        if (arg.startswith('--')):
+            if ('=' not in arg):
+                next(argv, None)
+        elif (not arg.startswith('-')):
+            args.append(arg)
+
+    databaseDTO.bootstrap_db()
+
+    match args:
+        case ['plan', *rest]:
+            size = int(rest[0]) if rest else SHARD_SIZE
+            low, high = (int(rest[1]), int(rest[2])) if len(rest) == 3 else (1, node_tip())
+            plan_shards(databaseDTO.engine, low, high, size)
+        case ['work']:
+            start_workers()
+        case ['work', processes]:
+            start_workers(int(processes))
+        case ['status']:
+            pass
+        case _:
+            print("usage: backfill.py plan [shard_size] [low high] | work [processes] | status")
+            exit(-1)
+
+    for status, shards, heights in shard_status(databaseDTO.engine):
+        print(" {}: {} shards ({} heights)".format(status, shards, heights))
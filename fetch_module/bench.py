@@ -0,0 +1,330 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+
+from sqlalchemy import create_engine, delete, text
+from sqlalchemy.orm import sessionmaker
+
+import databaseDTO
+from bulk_writer import BulkWriter, block_rows
+from integrity import check_integrity
+from parse_pool import PARSE_PROCESSES, ParsePool
+from parsers import PARSERS, loads
+from resume import load_resume_plan
+from transactions import Base, Transaction
+
+
+#CONFIGURATION
+BENCH_BLOCKS = 2000
+BENCH_TXS_PER_BLOCK = 100     # Mean, block sizes are drawn around it
+BENCH_USERS = 20000           # Distinct public keys, picked with a skewed (popular users) distribution
+BENCH_SCHEMA = "bench"        # PostgreSQL schema the benchmark tables live in (the real ones are never touched)
+BENCH_OUT = "bench_results.json"
+
+# Relative weights of TxnTypes in synthetic blocks (roughly the mainnet mix), one BLOCK_REWARD per block is added
+DEFAULT_MIX = {"LIKE": 30, "SUBMIT_POST": 20, "FOLLOW": 15, "BASIC_TRANSFER": 10, "CREATOR_COIN": 5,
+               "PRIVATE_MESSAGE": 5, "NFT_BID": 3, "UPDATE_PROFILE": 2, "CREATOR_COIN_TRANSFER": 2,
+               "ACCEPT_NFT_BID": 1, "CREATE_NFT": 1, "UPDATE_NFT": 1, "BURN_NFT": 1, "NFT_TRANSFER": 1,
+               "ACCEPT_NFT_TRANSFER": 1, "MESSAGING_GROUP": 1, "AUTHORIZE_DERIVED_KEY": 1, "BITCOIN_EXCHANGE": 1,
+               "DAO_COIN": 1, "DAO_COIN_TRANSFER": 1, "DAO_COIN_LIMIT_ORDER": 1}
+
+#####################################################################################################################
+
+# Ingestion benchmark on synthetic DeSo blocks: parse, insert (per writer backend), resume planning and
+# integrity check timings, written as JSON so results of different commits can be compared.
+#   python bench.py [--blocks N] [--txs N] [--mix LIKE=30,FOLLOW=10,...] [--db URL] [--out FILE]
+
+# Outputs of a tx on the official node (default 2: other user + change), the custom node one (fee) comes first
+N_OUTPUTS = {"UPDATE_PROFILE": 1, "BLOCK_REWARD": 1, "BITCOIN_EXCHANGE": 1, "MESSAGING_GROUP": 1, "AUTHORIZE_DERIVED_KEY": 1}
+RECIPIENT_FIRST = {"BASIC_TRANSFER", "BLOCK_REWARD", "NFT_TRANSFER"}
+NFT_TYPES = {"ACCEPT_NFT_BID", "CREATE_NFT", "UPDATE_NFT", "BURN_NFT", "NFT_TRANSFER", "ACCEPT_NFT_TRANSFER"}
+
+
+class SyntheticChain:
+
+    def __init__(self, mix=DEFAULT_MIX, txs_per_block=BENCH_TXS_PER_BLOCK, users=BENCH_USERS, seed=0):
+        self.rnd = random.Random(seed)
+        self.types = list(mix)
+        self.weights = [mix[t] for t in self.types]
+        self.txs_per_block = txs_per_block
+        self.users = users
+        self.node = self.public_key(users)
+        self.n_txs = 0
+
+    def hex_hash(self):
+        return '{:064x}'.format(self.rnd.getrandbits(256))
+
+    def public_key(self, i):
+        return 'BC1YL' + '{:050d}'.format(i)
+
+    def user(self):
+        return self.public_key(min(int(self.rnd.paretovariate(1.2)) - 1, self.users - 1))
+
+    def post_hash(self):
+        return '{:064x}'.format(self.rnd.randrange(self.users * 50))
+
+    def nanos(self, high=10**10):
+        return self.rnd.randrange(1, high)
+
+    # Full block responses from height 1 to n_blocks (lowest first), like /api/v1/block with FullBlock
+    def blocks(self, n_blocks):
+        prev_hash = '0' * 64
+        for height in range(1, n_blocks + 1):
+            block = self.block(height, prev_hash)
+            prev_hash = block['Header']['BlockHashHex']
+            yield block
+
+    def block(self, height, prev_hash):
+        b_hash = self.hex_hash()
+        n = max(0, int(self.rnd.gauss(self.txs_per_block, self.txs_per_block / 3)))
+        tx_types = ["BLOCK_REWARD"] + self.rnd.choices(self.types, self.weights, k=n)
+        header = {"BlockHashHex": b_hash, "Version": 1, "PrevBlockHashHex": prev_hash, "TstampSecs": 1600000000 + height * 300,
+                  "Height": height, "TransactionMerkleRootHex": self.hex_hash(), "Nonce": self.rnd.getrandbits(63),
+                  "ExtraNonce": self.rnd.getrandbits(32)}
+        return {"Header": header, "Transactions": [self.tx(t, b_hash) for t in tx_types]}
+
+    def tx(self, tx_type, b_hash):
+        self.n_txs += 1
+        transactor, other = self.user(), self.user()
+        custom = tx_type != "BLOCK_REWARD" and self.rnd.random() < 0.3   # Submitted through a custom node -> pays it a fee
+
+        keys = [other, transactor] if tx_type in RECIPIENT_FIRST else [transactor, other]
+        outputs = [{"PublicKeyBase58Check": k, "AmountNanos": self.nanos()} for k in keys[:N_OUTPUTS.get(tx_type, 2)]]
+        affected = [{"PublicKeyBase58Check": k, "Metadata": "BasicTransferOutput"} for k in keys]
+        if (tx_type in NFT_TYPES):
+            affected[1]["Metadata"] = "NFTOwnerPublicKeyBase58Check"
+        if (custom):
+            outputs.insert(0, {"PublicKeyBase58Check": self.node, "AmountNanos": self.nanos(10**6)})
+            affected.insert(0, {"PublicKeyBase58Check": self.node, "Metadata": "BasicTransferOutput"})
+
+        metadata = {"TxnType": tx_type, "TransactorPublicKeyBase58Check": transactor, "AffectedPublicKeys": affected,
+                    "BasicTransferTxindexMetadata": {"FeeNanos": self.rnd.randrange(100, 2000),
+                                                     "DiamondLevel": self.rnd.choice([0, 0, 0, 1, 2]), "PostHashHex": self.post_hash()}}
+        metadata.update(self.tx_metadata(tx_type, transactor, other))
+
+        return {"TransactionIDBase58Check": '3Ju' + '{:048x}'.format(self.rnd.getrandbits(192)),
+                "RawTransactionHex": '{:0400x}'.format(self.rnd.getrandbits(1600)),
+                "SignatureHex": '{:0142x}'.format(self.rnd.getrandbits(568)),
+                "BlockHashHex": b_hash, "Outputs": outputs, "TransactionMetadata": metadata}
+
+    def tx_metadata(self, tx_type, transactor, other):
+        nft = {"NFTPostHashHex": self.post_hash(), "SerialNumber": self.rnd.randrange(1, 100)}
+        match tx_type:
+            case "UPDATE_PROFILE":
+                return {"UpdateProfileTxindexMetadata": {"NewUsername": "user{}".format(self.n_txs),
+                                                         "NewCreatorBasisPoints": self.rnd.randrange(10000), "IsHidden": False}}
+            case "FOLLOW":
+                return {"FollowTxindexMetadata": {"IsUnfollow": self.rnd.random() < 0.1}}
+            case "CREATOR_COIN":
+                buy = self.rnd.random() < 0.5
+                return {"CreatorCoinTxindexMetadata": {"OperationType": "buy" if buy else "sell",
+                                                       "DeSoToSellNanos": self.nanos(), "CreatorCoinToSellNanos": self.nanos(),
+                                                       "DESOLockedNanosDiff": self.nanos() if buy else -self.nanos()}}
+            case "SUBMIT_POST":
+                return {"SubmitPostTxindexMetadata": {"PostHashBeingModifiedHex": self.post_hash(), "ParentPostHashHex": self.post_hash()}}
+            case "LIKE":
+                return {"LikeTxindexMetadata": {"IsUnlike": self.rnd.random() < 0.05, "PostHashHex": self.post_hash()}}
+            case "BITCOIN_EXCHANGE":
+                return {"BitcoinExchangeTxindexMetadata": {"BitcoinSpendAddress": "1" + self.hex_hash()[:33],
+                                                           "SatoshisBurned": self.nanos(10**8), "NanosCreated": self.nanos()}}
+            case "PRIVATE_MESSAGE":
+                return {"PrivateMessageTxindexMetadata": {"TimestampNanos": 1600000000 * 10**9 + self.nanos(10**17)}}
+            case "CREATOR_COIN_TRANSFER":
+                return {"CreatorCoinTransferTxindexMetadata": {"CreatorUsername": other, "CreatorCoinToTransferNanos": self.nanos()}}
+            case "NFT_BID":
+                return {"NFTBidTxindexMetadata": dict(nft, BidAmountNanos=self.nanos())}
+            case "ACCEPT_NFT_BID":
+                bid = self.nanos()
+                royalties = {"CreatorPublicKeyBase58Check": other, "CreatorCoinRoyaltyNanos": bid // 10, "CreatorRoyaltyNanos": bid // 20}
+                return {"AcceptNFTBidTxindexMetadata": dict(nft, BidAmountNanos=bid, NFTRoyaltiesMetadata=royalties)}
+            case "CREATE_NFT":
+                return {"CreateNFTTxindexMetadata": nft}
+            case "UPDATE_NFT":
+                return {"UpdateNFTTxindexMetadata": dict(nft, IsForSale=self.rnd.random() < 0.5)}
+            case "BURN_NFT":
+                return {"BurnNFTTxindexMetadata": nft}
+            case "NFT_TRANSFER":
+                return {"NFTTransferTxindexMetadata": nft}
+            case "ACCEPT_NFT_TRANSFER":
+                return {"AcceptNFTTransferTxindexMetadata": nft}
+            case "DAO_COIN":
+                operation = self.rnd.choice(["mint", "mint", "burn", "disable_minting"])
+                return {"DAOCoinTxindexMetadata": {"CreatorUsername": other, "OperationType": operation,
+                                                   "CoinsToMintNanos": hex(self.nanos(10**30)), "CoinsToBurnNanos": hex(self.nanos(10**20))}}
+            case "DAO_COIN_TRANSFER":
+                return {"DAOCoinTransferTxindexMetadata": {"CreatorUsername": other, "DAOCoinToTransferNanos": hex(self.nanos(10**20))}}
+            case "DAO_COIN_LIMIT_ORDER":
+                return {"DAOCoinLimitOrderTxindexMetadata": self.limit_order(transactor)}
+        return {}
+
+    # Limit orders on a few DAO coins, filling (part of) resting orders of the opposite side, then the order itself
+    def limit_order(self, transactor):
+        buying, selling = self.rnd.sample([self.public_key(i) for i in range(3)], 2)
+        quantity = self.nanos(10**20)
+        fills, filled = [], 0
+        for _ in range(self.rnd.choice([0, 0, 1, 2])):
+            sold = self.nanos(quantity - filled) if filled < quantity - 1 else 0
+            if (not sold):
+                break
+            filled += sold
+            fills.append({"TransactorPublicKeyBase58Check": self.user(), "BuyingDAOCoinCreatorPublicKey": selling,
+                          "SellingDAOCoinCreatorPublicKey": buying, "CoinQuantityInBaseUnitsBought": hex(sold // 2 + 1),
+                          "CoinQuantityInBaseUnitsSold": hex(sold), "IsFulfilled": self.rnd.random() < 0.5})
+        if (fills):
+            fills.append({"TransactorPublicKeyBase58Check": transactor, "BuyingDAOCoinCreatorPublicKey": buying,
+                          "SellingDAOCoinCreatorPublicKey": selling, "CoinQuantityInBaseUnitsBought": hex(filled),
+                          "CoinQuantityInBaseUnitsSold": hex(sum(int(f["CoinQuantityInBaseUnitsBought"], 16) for f in fills)),
+                          "IsFulfilled": filled >= quantity})
+        return {"BuyingDAOCoinCreatorPublicKey": buying, "SellingDAOCoinCreatorPublicKey": selling,
+                "ScaledExchangeRateCoinsToSellPerCoinToBuy": hex(self.nanos(10**38) * 2), "QuantityToFillInBaseUnits": hex(quantity),
+                "FilledDAOCoinLimitOrdersMetadata": fills}
+
+
+def parse_mix(spec):
+    mix = {}
+    for item in spec.split(','):
+        tx_type, weight = item.split('=')
+        if (tx_type not in PARSERS):
+            raise SystemExit("unknown TxnType {}".format(tx_type))
+        mix[tx_type] = float(weight)
+    return mix
+
+
+def result(name, seconds, blocks=None, txs=None, **extra):
+    res = {'name': name, 'seconds': round(seconds, 4), 'blocks': blocks, 'txs': txs}
+    if (blocks):
+        res['blocks_per_s'] = round(blocks / seconds, 1)
+    if (txs):
+        res['txs_per_s'] = round(txs / seconds, 1)
+    res.update(extra)
+    return res
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    value = func(*args)
+    return value, time.perf_counter() - start
+
+
+# -------------------------------- Stages ------------------------------------
+
+def bench_parse(raws, n_txs):
+    parsed, seconds = timed(lambda: [block_rows(loads(raw)) for raw in raws])
+    results = [result('parse', seconds, len(raws), n_txs)]
+
+    if (PARSE_PROCESSES):
+        async def parse_all():
+            with ParsePool(PARSE_PROCESSES) as pool:
+                await pool.parse(raws[0])  # Workers start up out of the measure
+                start = time.perf_counter()
+                await asyncio.gather(*(pool.parse(raw) for raw in raws))
+                return time.perf_counter() - start
+        results.append(result('parse_pool', asyncio.run(parse_all()), len(raws), n_txs, processes=PARSE_PROCESSES))
+
+    return parsed, results
+
+
+def reset_tables(engine):
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+
+
+def bench_insert(engine, parsed, n_txs, use_copy):
+    reset_tables(engine)
+    writer = BulkWriter(engine, use_copy=use_copy)
+
+    def insert_all():
+        for p in parsed:
+            writer.add(p.block, p.txs)
+        writer.flush()
+
+    _, seconds = timed(insert_all)
+    return result('insert_copy' if use_copy else 'insert_executemany', seconds, len(parsed), n_txs)
+
+
+# Reads run on a DB where 1% of the blocks lost some transactions (so the dirty paths are measured too)
+def bench_reads(engine, parsed):
+    damaged = [p.block_hash for p in parsed[::100] if p.txs]
+    with engine.begin() as conn:
+        for b_hash in damaged:
+            conn.execute(delete(Transaction).where(Transaction.block_hash == b_hash, Transaction.tx_type != 'BlockReward'))
+
+    session = sessionmaker(bind=engine)()
+    try:
+        plan, seconds = timed(load_resume_plan, session)
+        results = [result('resume_plan', seconds, len(plan.prev_hashes), partial=len(plan.partial))]
+        report, seconds = timed(check_integrity, session)
+        results.append(result('integrity_check', seconds, len(parsed), partial=len(report.partial), ok=report.ok))
+    finally:
+        session.close()
+    return results
+
+
+# ------------------------------- Database -----------------------------------
+
+# Local PostgreSQL (databaseDTO settings, own schema) if reachable, a temporary SQLite file otherwise
+def bench_engine(url=None):
+    if (url is None):
+        url = databaseDTO.db_url()
+        try:
+            with create_engine(url).begin() as conn:
+                conn.execute(text('CREATE SCHEMA IF NOT EXISTS {}'.format(BENCH_SCHEMA)))
+            return create_engine(url, connect_args={'options': '-csearch_path={}'.format(BENCH_SCHEMA)})
+        except Exception as e:
+            print(" - PostgreSQL not available ({}), falling back to SQLite -".format(type(e).__name__))
+            url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    return create_engine(url)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(n_blocks, txs_per_block, mix, url=None, seed=0):
+    chain = SyntheticChain(mix, txs_per_block, seed=seed)
+    raws = [json.dumps(block).encode() for block in chain.blocks(n_blocks)]
+    n_txs = chain.n_txs
+
+    parsed, results = bench_parse(raws, n_txs)
+
+    engine = bench_engine(url)
+    backends = [True, False] if engine.dialect.driver == 'psycopg2' else [False]
+    for use_copy in backends:
+        results.append(bench_insert(engine, parsed, n_txs, use_copy))
+    results.extend(bench_reads(engine, parsed))
+
+    if (engine.dialect.name == 'postgresql'):
+        Base.metadata.drop_all(engine)
+
+    return {'commit': git_commit(), 'timestamp': time.time(), 'python': platform.python_version(),
+            'database': engine.dialect.name, 'blocks': n_blocks, 'txs': n_txs, 'raw_bytes': sum(map(len, raws)),
+            'mix': mix, 'seed': seed, 'results': results}
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description="DeSo ingestion benchmark on synthetic blocks")
+    args.add_argument('--blocks', type=int, default=BENCH_BLOCKS)
+    args.add_argument('--txs', type=int, default=BENCH_TXS_PER_BLOCK, help="mean transactions per block")
+    args.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help="TxnType weights, i.e. LIKE=30,FOLLOW=10")
+    args.add_argument('--db', default=None, help="SQLAlchemy URL (default: local PostgreSQL, else SQLite)")
+    args.add_argument('--seed', type=int, default=0)
+    args.add_argument('--out', default=BENCH_OUT)
+    args = args.parse_args()
+
+    report = run(args.blocks, args.txs, args.mix, args.db, args.seed)
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    for res in report['results']:
+        print(" {:<20} {:>9.3f}s {:>12} blocks/s {:>12} txs/s".format(res['name'], res['seconds'], res.get('blocks_per_s', '-'), res.get('txs_per_s', '-')))
+    print(" - Results written to {} -".format(args.out))
@@ -0,0 +1,132 @@
+import mmap
+import os
+import re
+import threading
+import zlib
+
+
+#CONFIGURATION
+CACHE_DIR = ""                # Directory of a local cache of full blocks (i.e. "block_cache"), '' -> none (it grows with the chain)
+SEGMENT_SIZE = 1 << 30        # Bytes per segment file, a new one is started when full
+COMPRESSION_LEVEL = 6
+
+#####################################################################################################################
+
+INDEX_FILE = 'index.txt'
+SEGMENT_FILE = re.compile(r'^seg-(\d+)\.dat$')
+
+
+def segment_name(n):
+    return 'seg-{:05d}.dat'.format(n)
+
+
+# On-disk cache of raw full block responses, keyed by block hash.
+# Blocks are zlib compressed and appended to segment files, never rewritten. The index is an append-only
+# text file (hash height prev_hash segment offset length): a record becomes visible only once its line is
+# written, after its bytes, so an interrupted write leaves at most some unreferenced bytes at the end of a segment.
+# Reads go through read-only memory maps of the segments.
+class BlockCache:
+
+    def __init__(self, directory=CACHE_DIR, segment_size=SEGMENT_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.entries = {}   # hash -> (height, prev_hash, segment, offset, length)
+        self._maps = {}     # segment -> mmap
+        self._lock = threading.Lock()
+
+        self._load_index()
+        segments = [int(m.group(1)) for m in map(SEGMENT_FILE.match, os.listdir(directory)) if m]
+        self._open_segment(max(segments, default=0))
+        self._index = open(os.path.join(directory, INDEX_FILE), 'a', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, b_hash):
+        return b_hash in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def close(self):
+        for m in self._maps.values():
+            m.close()
+        self._maps = {}
+        self._segment.close()
+        self._index.close()
+
+    def _load_index(self):
+        path = os.path.join(self.directory, INDEX_FILE)
+        if (not os.path.exists(path)):
+            return
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                fields = line.split()
+                if (len(fields) != 6 or not line.endswith('\n')):  # Torn last line of an interrupted write
+                    continue
+                b_hash, height, prev_hash, segment, offset, length = fields
+                self.entries[b_hash] = (int(height), prev_hash, int(segment), int(offset), int(length))
+
+    def _open_segment(self, n):
+        self._segment_n = n
+        self._segment = open(os.path.join(self.directory, segment_name(n)), 'ab')
+        self._offset = self._segment.tell()
+
+    def put(self, b_hash, height, prev_hash, raw):
+        if (b_hash in self.entries):
+            return
+        data = zlib.compress(raw, COMPRESSION_LEVEL)
+
+        with self._lock:
+            if (self._offset and self._offset + len(data) > self.segment_size):
+                self._segment.close()
+                self._open_segment(self._segment_n + 1)
+
+            offset = self._offset
+            self._segment.write(data)
+            self._segment.flush()
+            self._offset += len(data)
+
+            self._index.write('{} {} {} {} {} {}\n'.format(b_hash, height, prev_hash, self._segment_n, offset, len(data)))
+            self._index.flush()
+            self.entries[b_hash] = (height, prev_hash, self._segment_n, offset, len(data))
+
+    # Compressed bytes as stored (decompression can be left to the parse workers), None if not cached
+    def get_compressed(self, b_hash):
+        entry = self.entries.get(b_hash)
+        if (entry is None):
+            return None
+        _, _, segment, offset, length = entry
+
+        m = self._maps.get(segment)
+        if (m is None or len(m) < offset + length):  # Segment grown since it has been mapped
+            if (m is not None):
+                m.close()
+            with open(os.path.join(self.directory, segment_name(segment)), 'rb') as f:
+                m = self._maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return m[offset:offset + length]
+
+    def get(self, b_hash):
+        data = self.get_compressed(b_hash)
+        return None if data is None else zlib.decompress(data)
+
+    def prev_hash_of(self, b_hash):
+        entry = self.entries.get(b_hash)
+        return None if entry is None else entry[1]
+
+    # (height, hash) of the cached chain from its highest block down to the first one missing
+    def chain(self):
+        if (not self.entries):
+            return []
+        b_hash = max(self.entries, key=lambda h: self.entries[h][0])
+        height = self.entries[b_hash][0]
+
+        chain = []
+        while (b_hash in self.entries):
+            chain.append((height, b_hash))
+            b_hash, height = self.entries[b_hash][1], height - 1
+        return chain
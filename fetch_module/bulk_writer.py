@@ -0,0 +1,217 @@
+import io
+import time
+from collections import namedtuple
+
+from sqlalchemy import column, table
+
+from metrics import BLOCKS, DB_COMMIT, DB_FLUSH, TXS
+from parsers import parse_header, parse_tx
+from transactions import Block, Transaction
+
+
+#CONFIGURATION
+BATCH_BLOCKS = 200        # Flush after this many blocks...
+BATCH_TXS = 20000         # ...or this many transactions, whatever comes first
+
+#####################################################################################################################
+
+BLOCK_COLUMNS = [c.name for c in Block.__table__.columns]
+TX_COLUMNS = [c.name for c in Transaction.__table__.columns]
+
+BLOCK_HASH = BLOCK_COLUMNS.index('block_hash')
+PREV_HASH = BLOCK_COLUMNS.index('prev_block_hash')
+BLOCK_HEIGHT = BLOCK_COLUMNS.index('block_height')
+BLOCK_SKIPPED = BLOCK_COLUMNS.index('tx_skipped')
+TX_ID = TX_COLUMNS.index('tx_id_base58')
+TX_HEIGHT = TX_COLUMNS.index('block_height')
+
+
+# Plain tuples in table column order, the only thing the writer buffers
+def as_row(values, columns):
+    return tuple(values.get(c) for c in columns)
+
+
+def block_row(header, tx_number, tx_skipped=0):
+    return as_row(parse_header(header, tx_number, tx_skipped), BLOCK_COLUMNS)
+
+
+def tx_row(values):
+    return as_row(values, TX_COLUMNS)
+
+
+# A full block turned into rows, ready for the writer (compact enough to cross process boundaries)
+class ParsedBlock(namedtuple('ParsedBlock', ['block', 'txs'])):
+    __slots__ = ()
+
+    @property
+    def block_hash(self):
+        return self.block[BLOCK_HASH]
+
+    @property
+    def prev_hash(self):
+        return self.block[PREV_HASH]
+
+    @property
+    def height(self):
+        return self.block[BLOCK_HEIGHT]
+
+    @property
+    def tx_skipped(self):
+        return self.block[BLOCK_SKIPPED]
+
+
+def block_rows(block_data):
+    header = block_data['Header']
+    txs = [parse_tx(tx, header['BlockHashHex'], header['Height'], i) for i, tx in enumerate(block_data["Transactions"])]
+    rows = [tx_row(tx) for tx in txs if tx is not None]
+    return ParsedBlock(block_row(header, len(txs), len(txs) - len(rows)), rows)
+
+
+# Buffers blocks with their transactions and writes them in batches, one DB transaction per batch.
+# A block is always flushed in the same batch of its transactions, so every block row that
+# becomes visible is already "intirely inserted" (tx_number == stored transactions + tx_skipped).
+# On PostgreSQL+psycopg2 rows are streamed with COPY FROM STDIN, elsewhere with executemany inserts.
+# partitions -> PartitionManager of a partitioned `transaction`, missing ranges are created before writing
+#               (or loaded detached and attached afterwards, see load_partition)
+# derived -> function(conn, txs) updating what is derived from the written transactions, in the same DB transaction
+# accounts -> AccountIds of a normalized `transaction` (public keys stored as account ids)
+# raw -> RawStore of an offloaded `transaction` (raw transactions/signatures decoded into their own table)
+# feed -> ChangeFeed the rows of every batch are published to once committed
+class BulkWriter:
+
+    def __init__(self, engine, batch_blocks=BATCH_BLOCKS, batch_txs=BATCH_TXS, use_copy=None, partitions=None, derived=None,
+                 accounts=None, raw=None, feed=None):
+        self.engine = engine
+        self.partitions = partitions
+        self.derived = derived
+        self.accounts = accounts
+        self.raw = raw
+        self.feed = feed
+        self.batch_blocks = batch_blocks
+        self.batch_txs = batch_txs
+        self.use_copy = (engine.dialect.driver == 'psycopg2') if use_copy is None else use_copy
+        self.blocks = []
+        self.txs = []
+        self.n_blocks = 0  # Blocks (new or repaired) in the current batch
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+
+    # block -> row of a new block, None when only missing transactions of a stored block are added
+    def add(self, block, txs):
+        if block is not None:
+            self.blocks.append(block)
+        self.txs.extend(txs)
+        self.n_blocks += 1
+
+        if self.n_blocks >= self.batch_blocks or len(self.txs) >= self.batch_txs:
+            self.flush()
+
+    # Blocks (ParsedBlock) making up the whole range of a partition not created yet, starting at `start` -> written in
+    # one batch: transactions go into the detached table of the range, attached before the hooks run (same DB transaction)
+    def load_partition(self, start, blocks):
+        self.flush()
+        for parsed in blocks:
+            self.blocks.append(parsed.block)
+            self.txs.extend(parsed.txs)
+        self.n_blocks = len(blocks)
+        if any(self.partitions.start_of(tx[TX_HEIGHT]) != start for tx in self.txs):
+            self.discard()
+            raise ValueError("transactions outside the partition range starting at {}".format(start))
+        self.flush(partition=start)
+
+    # partition -> start of the range the buffered transactions fill, loaded detached (load_partition)
+    def flush(self, partition=None):
+        if not self.blocks and not self.txs:
+            self.n_blocks = 0
+            return
+
+        start = time.perf_counter()
+        tx_columns, tx_rows, raw_rows = TX_COLUMNS, self.txs, []
+        if self.raw is not None:
+            tx_rows, raw_rows = self.raw.split(tx_rows)
+        if self.accounts is not None and tx_rows:
+            tx_columns, tx_rows = self.accounts.columns, self.accounts.normalize_rows(tx_rows)
+        tx_table = Transaction.__table__
+        with self.engine.begin() as conn:
+            if partition is not None:
+                tx_table = table(self.partitions.create_detached(conn, partition))
+            elif self.partitions is not None:
+                self.partitions.ensure(conn, {tx[TX_HEIGHT] for tx in self.txs})
+            self._write(conn, Block.__table__, BLOCK_COLUMNS, self.blocks)
+            self._write(conn, tx_table, tx_columns, tx_rows)
+            if raw_rows:
+                self._write(conn, self.raw.table, self.raw.columns, raw_rows)
+            if partition is not None:
+                self.partitions.attach(conn, partition)
+            if self.derived is not None:
+                self.derived(conn, self.txs)
+            written = time.perf_counter()
+        DB_FLUSH.observe(written - start)
+        DB_COMMIT.observe(time.perf_counter() - written)
+        blocks, txs = self.blocks, self.txs
+        BLOCKS.inc(len(blocks))
+        TXS.inc(len(txs))
+
+        # Committed: nothing below may leave them buffered (they would be written twice)
+        self.blocks = []
+        self.txs = []
+        self.n_blocks = 0
+        if self.feed is not None:
+            self.feed.publish(blocks, txs)
+
+    # Buffered rows dropped unwritten (their batch failed or is abandoned, they are fetched again)
+    def discard(self):
+        self.blocks = []
+        self.txs = []
+        self.n_blocks = 0
+
+    def _write(self, conn, table_, columns, rows):
+        if not rows:
+            return
+        if self.use_copy:
+            copy_rows(conn, table_.name, columns, rows)
+        else:
+            if conn.dialect.name != 'postgresql':
+                rows = [tuple(map(_bind_value, row)) for row in rows]
+            conn.execute(table(table_.name, *map(column, columns)).insert(), [dict(zip(columns, row)) for row in rows])
+
+
+# uint256 amounts (NUMERIC(78, 0) on PostgreSQL) overflow the int64 binding of other drivers (SQLite), they go as text
+def _bind_value(value):
+    if isinstance(value, int) and not isinstance(value, bool) and not -2**63 <= value < 2**63:
+        return str(value)
+    return value
+
+
+# COPY ... FROM STDIN (text format) on the DBAPI connection underlying conn
+def copy_rows(conn, table_name, columns, rows):
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(map(_copy_value, row)))
+        buf.write('\n')
+    buf.seek(0)
+
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert('COPY "{}" ({}) FROM STDIN'.format(table_name, ', '.join('"{}"'.format(c) for c in columns)), buf)
+    finally:
+        cursor.close()
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, bytes):
+        return '\\\\x' + value.hex()   # bytea hex input, backslash escaped for COPY
+    if isinstance(value, str):
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    return str(value)
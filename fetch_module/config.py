@@ -0,0 +1,48 @@
+import configparser
+import os
+
+
+#CONFIGURATION
+CONFIG_FILE = "deso.ini"      # Read if it exists, another one can be given with DESO_CONFIG=<path>
+ENV_PREFIX = "DESO"
+
+#####################################################################################################################
+
+# Settings overriding the #CONFIGURATION defaults of a module, looked up in this order:
+#   1. environment      DESO_<SECTION>_<KEY>   (i.e. DESO_DATABASE_PASSWORD=...)
+#   2. config file      [section] key = value  (INI, i.e. [database] password = ...)
+#   3. the default given by the module (whose type the value is converted to)
+
+_parser = None
+
+
+def _file():
+    global _parser
+    if (_parser is None):
+        _parser = configparser.ConfigParser()
+        path = os.environ.get('{}_CONFIG'.format(ENV_PREFIX), CONFIG_FILE)
+        if (not _parser.read(path) and path != CONFIG_FILE):
+            print("Config file {} not found".format(path))
+            exit(-1)
+    return _parser
+
+
+def _convert(value, default):
+    if (isinstance(default, bool)):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    if (isinstance(default, (int, float))):
+        return type(default)(value)
+    return value
+
+
+def setting(section, key, default):
+    value = os.environ.get('{}_{}_{}'.format(ENV_PREFIX, section, key).upper())
+    if (value is None):
+        value = _file().get(section, key, fallback=None)
+    if (value is None):
+        return default
+    try:
+        return _convert(value, default)
+    except ValueError:
+        print("Invalid value for {}.{}: {!r}".format(section, key, value))
+        exit(-1)
@@ -1,242 +1,413 @@
+import os
 import sys
 
 from transactions import *
+from bulk_writer import TX_ID, BulkWriter, block_rows
+from integrity import check_integrity
+from migrations import migrate
+from raw_store import RAW_OFFLOAD, RawStore, create_raw_table, is_offloaded, load_raw, transaction_raw
+from partitioning import PARTITION_SIZE, PartitionManager, create_partitioned_table, is_partitioned, partition_bounds
+from resume import load_resume_plan
+from accounts import NORMALIZED_KEYS, AccountIds, create_view, drop_view, is_normalized, normalize, tx_source
+from config import setting
+from derived import DERIVED_TABLES, apply_derived, create_derived, orphaned_keys, recompute, touched_keys
+from order_book import ORDER_BOOK, apply_order_book, catch_up, create_order_book, reset_above
+from ledger import LEDGER, SOURCE_COLUMNS, apply_ledger, create_ledger, revert_ledger, rollback_ledger
+from feed import CHANGE_FEED, ChangeFeed, load_sink
 from sqlalchemy import MetaData
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine,func, inspect
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import create_engine,func, inspect, delete, select, text, update
 
 
-#CONFIGURATION
-USERNAME_ROLE = "f.ziccolella"
-PASSWORD_ROLE = "f.ziccolella"
+#CONFIGURATION (defaults, overridden by DESO_DATABASE_<KEY> env vars or the [database] section of deso.ini, see config.py)
+USERNAME_ROLE = setting('database', 'user', "chilledpanda")
+PASSWORD_ROLE = setting('database', 'password', "chilledpanda")
 
-USERNAME_ROLE = "chilledpanda"
-PASSWORD_ROLE = "chilledpanda"
+DB_IP = setting('database', 'host', "localhost")
+PORT = setting('database', 'port', 5432)
+DB_NAME = setting('database', 'name', "deso_blockchain")
 
-DB_IP = "localhost"
-PORT = 5432
-DB_NAME = "deso_blockchain"
+# Connections of a process: the writer thread, the threads of backfill leases/reads, spare ones for bursts
+POOL_SIZE = setting('database', 'pool_size', 5)
+MAX_OVERFLOW = setting('database', 'max_overflow', 5)
+POOL_TIMEOUT = setting('database', 'pool_timeout', 30)            # Seconds waiting for a free connection
+POOL_RECYCLE = setting('database', 'pool_recycle', 1800)          # Seconds, older connections are reopened
+
+# Server side limits of every statement / lock wait (ms, 0 -> none): a stuck query fails instead of hanging the daemon
+STATEMENT_TIMEOUT = setting('database', 'statement_timeout', 600000)
+LOCK_TIMEOUT = setting('database', 'lock_timeout', 60000)
 
 #####################################################################################################################
 
 # Global vars
 metadata_obj = None
-session = None
-tx_infos = ['TransactionIDBase58Check', 'RawTransactionHex', 'Inputs',
-            'Outputs', 'TransactionType', 'BlockHashHex', 'SignatureHex', 'TransactionMetadata']
+engine = None
+session = None    # scoped_session: every thread using it gets its own session (and connection)
+writer = None
+feed = None        # ChangeFeed of the committed rows (if CHANGE_FEED)
 
 # UTILITY FUNCTIONS
 
-def block_is_in_db(b_hash):
+def max_block_h():
     global session
-    block_check = session.query(Block).filter_by(block_hash=b_hash).first()
-    return block_check is not None
+    max_h = session.query(func.max(Block.block_height)).scalar()
+    end_read()
+    return float('-inf') if max_h is None else max_h
 
 
-def get_block_height(b_hash):
+def min_block_h():
     global session
-    block = session.query(Block).filter_by(block_hash=b_hash).first()
-    return block.block_height
+    min_h = session.query(func.min(Block.block_height)).scalar()
+    end_read()
+    return float('+inf') if min_h is None else min_h
 
 
-def block_is_intirely_inserted(b_hash):
+def get_stored_tx_ids(b_hash):
     global session
-    b = session.query(Block).filter_by(block_hash=b_hash).first()
-    return b.tx_number == session.query(Transaction).filter_by(block_hash=b.block_hash).count()
+    tx_ids = {tx_id for tx_id, in session.query(Transaction.tx_id_base58).filter_by(block_hash=b_hash)}
+    end_read()
+    return tx_ids
 
 
-def block_is_intirely_inserted_by_height(b_height):
+def resume_plan(heights=None):
     global session
-    b = session.query(Block).filter_by(block_height=b_height).first()
-    return b.tx_number == session.query(Transaction).filter_by(block_hash=b.block_hash).count()
+    plan = load_resume_plan(session, heights)
+    end_read()
+    return plan
 
 
-def max_block_h():
+# height -> hash of the stored blocks between low and high (included)
+def stored_hashes(low, high):
     global session
-    if (session.query(func.max(Block.block_height)).scalar() is None):
-        return float('-inf')
-    else:
-        return session.query(func.max(Block.block_height)).scalar()
+    hashes = dict(session.query(Block.block_height, Block.block_hash).filter(Block.block_height.between(low, high)))
+    end_read()
+    return hashes
 
 
-def max_block_h_se(session):
-    if (session.query(func.max(Block.block_height)).scalar() is None):
-        return float('-inf')
-    else:
-        return session.query(func.max(Block.block_height)).scalar()
+# tx id -> (raw transaction, signature) bytes, read on demand (never loaded with the rows)
+def get_raw_transactions(tx_ids):
+    global engine
+    with engine.connect() as conn:
+        return load_raw(conn, tx_ids)
 
 
-def min_block_h():
+def integrity_report():
     global session
-    if (session.query(func.min(Block.block_height)).scalar() is None):
-        return float('+inf')
-    else:
-        return session.query(func.min(Block.block_height)).scalar()
+    report = check_integrity(session)
+    end_read()
+    return report
 
 
-def get_prev_block(b_hash):
+# hash -> height of the stored blocks in the last `depth` heights (where forks are looked for)
+def recent_blocks(depth):
+    global session
+    max_h = session.query(func.max(Block.block_height)).scalar()
+    blocks = {} if max_h is None else dict(session.query(Block.block_hash, Block.block_height).filter(Block.block_height >= max_h - depth))
+    end_read()
+    return blocks
+
+
+# Orphaned branch of a fork -> every block above `height` and its transactions go away, in one DB transaction
+# (derived rows they touched are recomputed from the transactions left, the order book is replayed if it saw them,
+# their ledger deltas are taken back). DB errors are raised: the follower retries on its next poll
+def rollback_above(height):
+    global engine
+    global feed
+    global writer
+    writer.flush()
+    orphans = select(Block.block_hash).where(Block.block_height > height)
+    with engine.begin() as conn:
+        derived_keys = orphaned_keys(conn, height)
+        conn.execute(delete(Transaction).where(Transaction.block_hash.in_(orphans)))
+        if (is_offloaded(conn)):
+            conn.execute(delete(transaction_raw).where(transaction_raw.c.block_height > height))
+        n_orphans = conn.execute(delete(Block).where(Block.block_height > height)).rowcount
+        recompute(conn, derived_keys)
+        reset_above(conn, height)
+        rollback_ledger(conn, height)
+    if (feed is not None):
+        feed.rollback(height)
+    catch_up_order_book()
+    return n_orphans
+
+
+# Stored hashes at those heights -> [(height, hash)] (integrity_check compares them with the node chain)
+def blocks_at(heights):
+    global session
+    blocks = session.query(Block.block_height, Block.block_hash).filter(Block.block_height.in_(list(heights))).all()
+    end_read()
+    return blocks
+
+
+# Blocks off the node chain found below the tip (integrity_check) -> they and their stored descendants go away
+# like the orphans of rollback_above, but only them: the canonical blocks at the same heights stay
+def drop_blocks(hashes):
+    global engine
+    global feed
+    global writer
+    writer.flush()
+    with engine.begin() as conn:
+        orphans = conn.execute(text('WITH RECURSIVE orphan AS (SELECT block_hash, block_height FROM block WHERE block_hash = ANY(:hashes) '
+                                    'UNION SELECT b.block_hash, b.block_height FROM block b JOIN orphan o ON b.prev_block_hash = o.block_hash) '
+                                    'SELECT block_hash, block_height FROM orphan'), {'hashes': list(hashes)}).fetchall()
+        if (not orphans):
+            return 0
+        orphan_hashes = [b_hash for b_hash, _ in orphans]
+        transactions = tx_source(conn)
+        in_orphans = transactions.c.block_hash.in_(orphan_hashes)
+        derived_keys = touched_keys(conn, transactions, in_orphans)
+        orphan_txs = [dict(row._mapping) for row in conn.execute(select(*(transactions.c[c] for c in SOURCE_COLUMNS)).where(in_orphans))]
+        if (is_offloaded(conn)):
+            conn.execute(delete(transaction_raw).where(transaction_raw.c.tx_id_base58.in_(
+                select(Transaction.tx_id_base58).where(Transaction.block_hash.in_(orphan_hashes)))))
+        conn.execute(delete(Transaction).where(Transaction.block_hash.in_(orphan_hashes)))
+        conn.execute(delete(Block).where(Block.block_hash.in_(orphan_hashes)))
+        recompute(conn, derived_keys)
+        revert_ledger(conn, orphan_txs)
+        reset_above(conn, min(height for _, height in orphans) - 1)
+    if (feed is not None):
+        feed.orphaned(orphans)
+    catch_up_order_book()
+    return len(orphans)
+
+
+# Parsed blocks (oldest first) written and committed, DB errors are raised (follower)
+def insert_branch(branch):
+    global writer
+    for parsed in branch:
+        writer.add(parsed.block, parsed.txs)
+    writer.flush()
+
+
+# After a failed poll (follower) or a lost shard (backfill): the failed transaction of the session
+# and the rows not written are dropped
+def abort_pending():
     global session
-    return session.query(Block).filter_by(block_hash=b_hash).first().prev_block_hash
+    global writer
+    session.rollback()
+    writer.discard()
 
 
-def tx_is_in_db(tx_hash):
-    global session
-    block_check = session.query(Transaction).filter_by(
-        tx_id_base58=tx_hash).first()
-    return block_check is not None
-
-
-def insert_tx_in_db(header, tx):
-    info = {}
-
-    for key_info in tx_infos:
-        try:
-            info[key_info] = tx[key_info]
-        except (KeyError):
-            info[key_info] = None
-
-    m = info['TransactionMetadata']
-
-    params = (info['TransactionIDBase58Check'], info['RawTransactionHex'], info['Outputs'], info['SignatureHex'],m["TransactorPublicKeyBase58Check"], header['BlockHashHex'], info['TransactionMetadata'])
-    transaction = None
-
-    tx_type = info['TransactionMetadata']['TxnType']
-
-    if (tx_type == "BASIC_TRANSFER"): transaction = BasicTransfer(*params)
-    if (tx_type == "UPDATE_PROFILE"): transaction = UpdateProfile(*params)
-    if (tx_type == "FOLLOW"): transaction = Follow(*params)
-    if (tx_type == "CREATOR_COIN"): transaction = CreatorCoin(*params)
-    if (tx_type == "SUBMIT_POST"): transaction = SubmitPost(*params)
-    if (tx_type == "LIKE"): transaction = Like(*params)
-    if (tx_type == "BLOCK_REWARD"):transaction = BlockReward(*params)               
-    if (tx_type == "BITCOIN_EXCHANGE"): transaction = BitcoinExchange(*params)
-    if (tx_type == "PRIVATE_MESSAGE"):transaction = PrivateMessage(*params)
-    if (tx_type == "MESSAGING_GROUP"):transaction = MessagingGroup(*params)
-    if (tx_type == "CREATOR_COIN_TRANSFER"): transaction = CreatorCoinTransfer(*params)
-    if (tx_type == "AUTHORIZE_DERIVED_KEY"): transaction = AuthorizeDerivatedKey(*params) 
-    if (tx_type == "NFT_BID"): transaction = NFTBid(*params)
-    if (tx_type == "ACCEPT_NFT_BID"): transaction = AcceptNFTBid(*params)
-    if (tx_type == "CREATE_NFT"): transaction = CreateNFT(*params)
-    if (tx_type == "UPDATE_NFT"): transaction = UpdateNFT(*params)
-    if (tx_type == "BURN_NFT"): transaction = BurnNFT(*params)
-    if (tx_type == "NFT_TRANSFER"): transaction = NFTTransfer(*params)
-    if (tx_type == "ACCEPT_NFT_TRANSFER"): transaction = AcceptNFTTransfer(*params)
-
-    #Added only to speed up fetching
-    if (tx_type == "DAO_COIN"): transaction = DaoCoin(*params)
-    if (tx_type == "DAO_COIN_TRANSFER"): transaction = DaoCoinTransfer(*params)
-    if (tx_type == "DAO_COIN_LIMIT_ORDER"): transaction = DaoCoinLimitOrder(*params)
-
-    if(transaction is None):
-        print(tx_type)
-        print(tx)
+# Order book replayed up to the highest stored height with no gap below it (from scratch if it is stale)
+def catch_up_order_book():
+    global engine
+    if (not ORDER_BOOK):
         return
-
     try:
-        session.add(transaction)
+        replayed = catch_up(engine)
     except Exception as e:
-        session.rollback()
         print(e)
         exit(-1)
+    if (replayed):
+        print(" - Order book: {} heights replayed -".format(replayed))
+
+
+# Reads must not leave the session "idle in transaction": its locks would block the writer
+# (i.e. when it creates a new partition) and its snapshot would hold back vacuum
+def end_read():
+    global session
+    session.commit()
 
 
-def insert_block_in_db(block):
+# Push buffered blocks/transactions to the DB
+def flush_db():
+    global writer
     try:
-        session.add(block)
-        session.commit()
+        writer.flush()
     except Exception as e:
-        session.rollback()
         print(e)
         exit(-1)
 
 # -----------------------------------
 
 
+def db_url():
+    return 'postgresql://{}:{}@{}:{}/{}'.format(USERNAME_ROLE,PASSWORD_ROLE,DB_IP,PORT,DB_NAME)
+
+
+def new_engine():
+    options = '-c statement_timeout={} -c lock_timeout={}'.format(STATEMENT_TIMEOUT, LOCK_TIMEOUT)
+    return create_engine(db_url(), pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW, pool_timeout=POOL_TIMEOUT,
+                         pool_recycle=POOL_RECYCLE, pool_pre_ping=True,
+                         connect_args={'options': options, 'application_name': 'deso_fetch'})
+
+
 def bootstrap_db():
+    global engine
     global session
+    global writer
+    global feed
     global metadata
 
     # Establishing DB connection
-    engine = create_engine('postgresql://{}:{}@{}:{}/{}'.format(USERNAME_ROLE,PASSWORD_ROLE,DB_IP,PORT,DB_NAME))
-    Session = sessionmaker(bind=engine)
-    session = Session()
+    engine = new_engine()
+    session = scoped_session(sessionmaker(bind=engine))
     metadata = MetaData(bind=engine)
 
-    if (not inspect(engine).has_table("block")):
-        Block.__table__.create(engine)
-
-    if (not inspect(engine).has_table("transaction")):
-        Transaction.__table__.create(engine)
+    # New DBs get the current schema, older ones are migrated in place
+    migrate(engine, fresh=create_tables(engine))
 
     # Running options
     for arg in sys.argv:
-        if (arg[0] == '-'):
+        if (arg[0] == '-' and arg[1:2] != '-'):  # --long options are parsed elsewhere
             for op in arg[1:]:
                 match op:
                     case 'n':  # Recreate database
 
+                        # The view of a normalized `transaction` depends on it
+                        with engine.begin() as conn:
+                            drop_view(conn)
+
+                        # Partitions go away with their parent, drop_all would drop them twice
+                        if (load_partitions(engine) is not None):
+                            Transaction.__table__.drop(engine)
+
                         metadata.reflect(bind=engine)
                         metadata.drop_all(bind=engine)
 
-                        if (not inspect(engine).has_table("block")):
-                            Block.__table__.create(engine)
-
-                        if (not inspect(engine).has_table("transaction")):
-                            Transaction.__table__.create(engine)
+                        migrate(engine, fresh=create_tables(engine))
                         break
 
-# Close DB connection
+    # Public keys stored as account ids -> the view of the keys follows the (migrated) columns
+    with engine.begin() as conn:
+        normalized = is_normalized(conn)
+        if (normalized):
+            create_view(conn)
+        offloaded = is_offloaded(conn)
+
+    feed = ChangeFeed(load_sink()) if CHANGE_FEED else None
+    writer = BulkWriter(engine, partitions=load_partitions(engine), derived=derived_hook(),
+                        accounts=AccountIds(engine) if normalized else None, raw=RawStore() if offloaded else None, feed=feed)
 
 
+# Tables kept up to date by the writer in the DB transaction of the rows it writes
+def derived_hook():
+    hooks = ([apply_derived] if DERIVED_TABLES else []) + ([apply_order_book] if ORDER_BOOK else []) + ([apply_ledger] if LEDGER else [])
+    if (not hooks):
+        return None
+
+    def apply(conn, txs):
+        for hook in hooks:
+            hook(conn, txs)
+    return apply
+
+
+# Creates the missing tables, True if the DB was empty
+def create_tables(engine):
+    fresh = not inspect(engine).has_table("transaction")
+
+    if (not inspect(engine).has_table("block")):
+        Block.__table__.create(engine)
+
+    if (not inspect(engine).has_table("transaction")):
+        if (PARTITION_SIZE and engine.dialect.name == 'postgresql'):
+            with engine.begin() as conn:
+                create_partitioned_table(conn, PARTITION_SIZE)
+        else:
+            Transaction.__table__.create(engine)
+
+        if (NORMALIZED_KEYS and engine.dialect.name == 'postgresql'):
+            with engine.begin() as conn:
+                normalize(conn)
+        if (RAW_OFFLOAD):
+            with engine.begin() as conn:
+                create_raw_table(conn)
+
+    create_derived(engine)
+    create_order_book(engine)
+    create_ledger(engine)
+    return fresh
+
+
+# Heights start - end are exactly the range of a partition not created yet (backfill loads it detached)
+def is_new_partition(start, end):
+    global engine
+    global writer
+    partitions = writer.partitions
+    if (partitions is None or start % partitions.size or end != start + partitions.size - 1):
+        return False
+    with engine.connect() as conn:
+        partitions.known = {first for first, _ in partition_bounds(conn)}   # Other workers attach ranges too
+    return start not in partitions.known
+
+
+# Parsed blocks filling that range -> loaded detached and attached, through the writer hooks
+def load_partition(start, blocks):
+    global writer
+    try:
+        writer.load_partition(start, blocks)
+    except Exception as e:
+        print(e)
+        exit(-1)
+
+
+# PartitionManager if `transaction` is partitioned, None otherwise
+def load_partitions(engine):
+    if (engine.dialect.name != 'postgresql'):
+        return None
+    with engine.connect() as conn:
+        return PartitionManager(PARTITION_SIZE).load(conn) if is_partitioned(conn) else None
+
+# A forked child must not use the sockets of the parent's connections (both processes would talk on them):
+# the pool is dropped without closing them (they stay the parent's) and the child opens its own on demand
+def _after_fork():
+    global engine
+    global session
+    if (engine is not None):
+        engine.dispose(close=False)
+        session.registry.clear()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+# Close DB connection
 def close_db():
     global session
-    session.close()
+    flush_db()
+    session.remove()
 
 
 # The block is not in the DB  -> all transactions should be insered
 def clean_insert(block_data):
-    global session
-    header = block_data['Header']
+    return clean_insert_rows(block_rows(block_data))
 
-    # Constructing block obj
-    block = Block(b_hash=header['BlockHashHex'], version=header['Version'],
-                  tx_number=len(block_data["Transactions"]), prev_hash=header['PrevBlockHashHex'],
-                  timestamp=header['TstampSecs'], b_height=header['Height'],
-                  tx_merkle_root=header['TransactionMerkleRootHex'], b_nonce=str(
-                      header['Nonce']),
-                  extra_nonce=str(header['ExtraNonce']))
 
-    # Insert block into DB
-    insert_block_in_db(block)
-
-    for tx in block_data["Transactions"]:
-        # Insert transation into DB
-        insert_tx_in_db(header, tx)
+def clean_insert_rows(parsed):
+    global writer
 
+    # Block and its transactions always end up in the same batch
     try:
-        session.commit()
+        writer.add(parsed.block, parsed.txs)
     except Exception as e:
-        session.rollback()
         print(e)
         exit(-1)
 
-    return header['PrevBlockHashHex']
+    return parsed.prev_hash
 
 
 # Block is already in the DB but some transactions miss, check which misses and add
 def dirty_insert(block_data):
-    header = block_data['Header']
+    return dirty_insert_rows(block_rows(block_data))
+
+
+# stored_tx_ids -> ids already in the DB (i.e. from a ResumePlan), looked up with one query if not given
+def dirty_insert_rows(parsed, stored_tx_ids=None):
+    global engine
+    global writer
 
-    for tx in block_data["Transactions"]:
-        if (not tx_is_in_db(tx['TransactionIDBase58Check'])):
-            # Insert transation into DB
-            insert_tx_in_db(header, tx)
+    if (stored_tx_ids is None):
+        stored_tx_ids = get_stored_tx_ids(parsed.block_hash)
+    txs = [tx for tx in parsed.txs if tx[TX_ID] not in stored_tx_ids]
 
     try:
-        session.commit()
+        writer.add(None, txs)
+        # Stored before its skipped transactions were counted (or with parsers missing since then)
+        with engine.begin() as conn:
+            conn.execute(update(Block).where(Block.block_hash == parsed.block_hash,
+                                             Block.tx_skipped.is_distinct_from(parsed.tx_skipped))
+                         .values(tx_skipped=parsed.tx_skipped))
     except Exception as e:
-        session.rollback()
         print(e)
         exit(-1)
 
-    return header['PrevBlockHashHex']
+    return parsed.prev_hash
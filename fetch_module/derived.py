@@ -0,0 +1,245 @@
+from sqlalchemy import BigInteger, Boolean, Column, Integer, MetaData, String, Table, delete, func, select, true, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from accounts import tx_source
+from bulk_writer import TX_COLUMNS
+
+
+#CONFIGURATION
+DERIVED_TABLES = True     # Keep the derived tables up to date while blocks are written (turned on later -> `python derived.py`)
+REBUILD_BATCH = 50000     # Transactions read at once when (re)building them from `transaction`
+
+#####################################################################################################################
+
+# Derived tables: what analyses rebuild again and again from raw `transaction` rows, kept up to date by the writer
+# in the same DB transaction of the rows they come from (a committed batch always has its derived state).
+#   follow_edge                 current follow graph (last Follow/unfollow of every pair)
+#   nft_owner                   current owner of every NFT serial that has been sold/transferred/burnt
+#   nft_sale_edge               seller -> buyer NFT sales (count, volume)
+#   creator_coin_position       buys/sells of every holder on every creator coin
+#   creator_coin_transfer_edge  sender -> receiver creator coin transfers (the node identifies the coin by username)
+# Blocks are not written in height order (chain walked from the tip, parallel backfill): "current" tables keep the
+# (block_height, tx_index) of the event they reflect and only newer events replace it, aggregates are plain sums.
+# Orphaned blocks (forks) are taken back by recomputing the keys they touched from the remaining transactions.
+
+metadata = MetaData()
+
+TX_TYPE = TX_COLUMNS.index('tx_type')
+
+
+# A derived table fed by the transactions of tx_types: key -> [(derived column, transaction column)],
+# values(tx) -> the other columns of the row of tx (dict of transaction columns -> values), None to skip tx
+class Stage:
+
+    def __init__(self, table, tx_types, key, values):
+        self.table = table
+        self.tx_types = tx_types
+        self.key = key
+        self.values = values
+
+    def key_of(self, tx):
+        return tuple(tx[tx_column] for _, tx_column in self.key)
+
+    def rows(self, txs):
+        for tx in txs:
+            if (tx['tx_type'] in self.tx_types and None not in self.key_of(tx)):
+                values = self.values(tx)
+                if (values is not None):
+                    yield self.key_of(tx), tx, values
+
+    def key_clause(self, keys):
+        return tuple_(*(self.table.c[column] for column, _ in self.key)).in_(keys)
+
+    def source_clause(self, transactions, keys):
+        return tuple_(*(transactions.c[column] for _, column in self.key)).in_(keys)
+
+
+# Last event wins: rows are replaced only by events at a higher (block_height, tx_index)
+class LatestState(Stage):
+
+    def apply(self, conn, txs):
+        latest = {}
+        for key, tx, values in self.rows(txs):
+            order = (tx['block_height'], -1 if tx['tx_index'] is None else tx['tx_index'])
+            if (key not in latest or order > latest[key][0]):
+                latest[key] = (order, dict(zip((column for column, _ in self.key), key)), values, tx['tx_id_base58'])
+        if (not latest):
+            return
+
+        # In key order: concurrent writers (backfill) lock the same rows in the same order -> no deadlock
+        rows = [dict(key, **values, block_height=height, tx_index=index, tx_id_base58=tx_id)
+                for _, ((height, index), key, values, tx_id) in sorted(latest.items())]
+        stmt = insert(self.table)
+        updated = {c.name: stmt.excluded[c.name] for c in self.table.columns if not c.primary_key}
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=[column for column, _ in self.key], set_=updated,
+            where=tuple_(self.table.c.block_height, self.table.c.tx_index) < tuple_(stmt.excluded.block_height, stmt.excluded.tx_index)),
+            rows)
+
+
+# Sums of the values of every event, with the heights of the first and last one
+class Aggregate(Stage):
+
+    def apply(self, conn, txs):
+        sums = {}
+        for key, tx, values in self.rows(txs):
+            row = sums.get(key)
+            if (row is None):
+                row = sums[key] = dict(zip((column for column, _ in self.key), key), first_height=tx['block_height'],
+                                       last_height=tx['block_height'], **{column: 0 for column in values})
+            for column, value in values.items():
+                row[column] += value or 0
+            row['first_height'] = min(row['first_height'], tx['block_height'])
+            row['last_height'] = max(row['last_height'], tx['block_height'])
+        if (not sums):
+            return
+
+        stmt = insert(self.table)
+        updated = {c.name: self.table.c[c.name] + stmt.excluded[c.name] for c in self.table.columns
+                   if not c.primary_key and c.name not in ('first_height', 'last_height')}
+        updated['first_height'] = func.least(self.table.c.first_height, stmt.excluded.first_height)
+        updated['last_height'] = func.greatest(self.table.c.last_height, stmt.excluded.last_height)
+        conn.execute(stmt.on_conflict_do_update(index_elements=[column for column, _ in self.key], set_=updated),
+                     [row for _, row in sorted(sums.items())])    # Key order, as LatestState
+
+
+def _latest_columns():
+    return [Column('block_height', Integer), Column('tx_index', Integer), Column('tx_id_base58', String)]
+
+
+def _aggregate_columns():
+    return [Column('first_height', Integer), Column('last_height', Integer)]
+
+
+STAGES = [
+    LatestState(Table('follow_edge', metadata,
+                      Column('follower_base58', String, primary_key=True),
+                      Column('followed_base58', String, primary_key=True, index=True),
+                      Column('is_following', Boolean),
+                      *_latest_columns()),
+                ['Follow'],
+                [('follower_base58', 'tx_transactor_base58'), ('followed_base58', 'other_us_base58')],
+                lambda tx: {'is_following': not tx['is_unfollow']}),
+
+    # Transfers move the NFT at once (pending until the receiver accepts it), burnt ones have no owner
+    LatestState(Table('nft_owner', metadata,
+                      Column('post_hash', String, primary_key=True),
+                      Column('nft_serial', Integer, primary_key=True),
+                      Column('owner_base58', String, index=True),
+                      Column('is_pending', Boolean),
+                      Column('is_burned', Boolean),
+                      *_latest_columns()),
+                ['AcceptNFTBid', 'NFTTransfer', 'NFTAcceptTransfer', 'BurnNFT'],
+                [('post_hash', 'post_hash'), ('nft_serial', 'nft_serial')],
+                lambda tx: {'AcceptNFTBid': {'owner_base58': tx['other_us_base58'], 'is_pending': False, 'is_burned': False},
+                            'NFTTransfer': {'owner_base58': tx['other_us_base58'], 'is_pending': True, 'is_burned': False},
+                            'NFTAcceptTransfer': {'owner_base58': tx['tx_transactor_base58'], 'is_pending': False, 'is_burned': False},
+                            'BurnNFT': {'owner_base58': None, 'is_pending': False, 'is_burned': True}}[tx['tx_type']]),
+
+    Aggregate(Table('nft_sale_edge', metadata,
+                    Column('seller_base58', String, primary_key=True),
+                    Column('buyer_base58', String, primary_key=True, index=True),
+                    Column('n_sales', Integer),
+                    Column('volume_nanos', BigInteger),
+                    *_aggregate_columns()),
+              ['AcceptNFTBid'],
+              [('seller_base58', 'tx_transactor_base58'), ('buyer_base58', 'other_us_base58')],
+              lambda tx: {'n_sales': 1, 'volume_nanos': tx['amount']}),
+
+    Aggregate(Table('creator_coin_position', metadata,
+                    Column('holder_base58', String, primary_key=True),
+                    Column('creator_base58', String, primary_key=True, index=True),
+                    Column('n_buys', Integer),
+                    Column('n_sells', Integer),
+                    Column('deso_spent_nanos', BigInteger),    # Buys
+                    Column('coins_sold_nanos', BigInteger),    # Sells
+                    *_aggregate_columns()),
+              ['CreatorCoin'],
+              [('holder_base58', 'tx_transactor_base58'), ('creator_base58', 'other_us_base58')],
+              lambda tx: {'n_buys': int(tx['is_buy']), 'n_sells': int(not tx['is_buy']),
+                          'deso_spent_nanos': tx['amount'] if tx['is_buy'] else 0,
+                          'coins_sold_nanos': 0 if tx['is_buy'] else tx['amount']}),
+
+    Aggregate(Table('creator_coin_transfer_edge', metadata,
+                    Column('sender_base58', String, primary_key=True),
+                    Column('receiver_base58', String, primary_key=True, index=True),
+                    Column('creator_username', String, primary_key=True),
+                    Column('n_transfers', Integer),
+                    Column('coins_nanos', BigInteger),
+                    *_aggregate_columns()),
+              ['CreatorCoinTransfer'],
+              [('sender_base58', 'tx_transactor_base58'), ('receiver_base58', 'other_us_base58'), ('creator_username', 'creator_base58')],
+              lambda tx: {'n_transfers': 1, 'coins_nanos': tx['amount']}),
+]
+
+TX_TYPES = {tx_type for stage in STAGES for tx_type in stage.tx_types}
+
+
+def create_derived(engine):
+    metadata.create_all(engine)
+
+
+def _relevant(txs):
+    return [dict(zip(TX_COLUMNS, tx)) for tx in txs if tx[TX_TYPE] in TX_TYPES]
+
+
+# Writer hook: txs -> rows (TX_COLUMNS order) being written in conn
+def apply_derived(conn, txs):
+    txs = _relevant(txs)
+    if (txs):
+        for stage in STAGES:
+            stage.apply(conn, txs)
+
+
+# Only the columns the stages read: the rebuild of migration 6 runs before later migrations add the others to the model
+SOURCE_COLUMNS = ['tx_id_base58', 'tx_type', 'block_height', 'tx_index', 'tx_transactor_base58', 'other_us_base58',
+                  'is_unfollow', 'amount', 'is_buy', 'post_hash', 'nft_serial', 'creator_base58']
+
+
+def _source_rows(conn, transactions, clause):
+    return conn.execution_options(stream_results=True).execute(
+        select(*(transactions.c[c] for c in SOURCE_COLUMNS)).where(transactions.c.tx_type.in_(TX_TYPES), clause))
+
+
+# Keys of every stage touched by the transactions of clause (before they are deleted)
+def touched_keys(conn, transactions, clause):
+    txs = [dict(row._mapping) for row in _source_rows(conn, transactions, clause)]
+    return [{key for key, _, _ in stage.rows(txs)} for stage in STAGES]
+
+
+# ...by the transactions above `height`
+def orphaned_keys(conn, height):
+    transactions = tx_source(conn)
+    return touched_keys(conn, transactions, transactions.c.block_height > height)
+
+
+# Rows of those keys are computed again from the transactions left
+def recompute(conn, keys):
+    transactions = tx_source(conn)
+    for stage, stage_keys in zip(STAGES, keys):
+        stage_keys = list(stage_keys)
+        if (not stage_keys):
+            continue
+        conn.execute(delete(stage.table).where(stage.key_clause(stage_keys)))
+        txs = [dict(row._mapping) for row in _source_rows(conn, transactions, stage.source_clause(transactions, stage_keys))]
+        stage.apply(conn, txs)
+
+
+# Every derived table from scratch (i.e. on a DB that stored transactions before they existed)
+def rebuild(conn):
+    for stage in STAGES:
+        conn.execute(delete(stage.table))
+    for batch in _source_rows(conn, tx_source(conn), true()).partitions(REBUILD_BATCH):
+        txs = [dict(row._mapping) for row in batch]
+        for stage in STAGES:
+            stage.apply(conn, txs)
+
+
+if __name__ == '__main__':
+    import databaseDTO
+
+    databaseDTO.bootstrap_db()
+    with databaseDTO.engine.begin() as conn:
+        rebuild(conn)
+        for stage in STAGES:
+            print(" {}: {} rows".format(stage.table.name, conn.execute(select(func.count()).select_from(stage.table)).scalar()))
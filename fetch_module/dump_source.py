@@ -0,0 +1,175 @@
+import json
+import os
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from block_cache import CACHE_DIR, BlockCache
+from node_client import BLOCK_INFO_PATH, LAST_BLOCK_PATH, NodeError
+from parsers import loads
+
+
+#CONFIGURATION
+SERVE_PORT = 17001     # Port of the local stand-in node (python dump_source.py serve <dump>)
+
+#####################################################################################################################
+
+# Offline stand-in of the node: full blocks come from local dumps instead of the node API.
+# A dump is a directory (or a single file) of
+#   *.json            -> one full block response per file ({"Header": ..., "Transactions": [...]})
+#   *.ndjson/*.jsonl  -> one full block response per line
+# Blocks are indexed once when the source is opened: headers are kept in memory, bodies are read
+# back from their file/offset when requested.
+
+JSON_SUFFIXES = ('.json',)
+NDJSON_SUFFIXES = ('.ndjson', '.jsonl')
+
+
+def dump_files(path):
+    if (os.path.isfile(path)):
+        return [path]
+    return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(JSON_SUFFIXES + NDJSON_SUFFIXES))
+
+
+# (offset, length) of every block stored in a dump file
+def block_spans(path):
+    if (not path.endswith(NDJSON_SUFFIXES)):
+        return [(0, os.path.getsize(path))]
+
+    spans, offset = [], 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if (line.strip()):
+                spans.append((offset, len(line)))
+            offset += len(line)
+    return spans
+
+
+# Same coroutines of NodeClient (and async context manager), so the ingestion pipeline can't tell the difference
+class DumpSource:
+    size = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.headers = {}     # hash -> header
+        self.locations = {}   # hash -> (file, offset, length)
+        self.heights = {}     # height -> hash
+        self.tip = None
+        self._files = {}
+
+        for file in dump_files(path):
+            with open(file, 'rb') as f:
+                for offset, length in block_spans(file):
+                    f.seek(offset)
+                    header = loads(f.read(length))['Header']
+                    self.headers[header['BlockHashHex']] = header
+                    self.locations[header['BlockHashHex']] = (file, offset, length)
+                    self.heights.setdefault(header['Height'], header['BlockHashHex'])
+                    if (self.tip is None or header['Height'] > self.tip['Height']):
+                        self.tip = header
+
+        if (self.tip is None):
+            raise NodeError("no block found in {}".format(path))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+    def header(self, b_hash):
+        if (b_hash not in self.headers):
+            raise NodeError("block {} is not in {}".format(b_hash, self.path))
+        return self.headers[b_hash]
+
+    def raw(self, b_hash):
+        self.header(b_hash)
+        file, offset, length = self.locations[b_hash]
+        if (file not in self._files):
+            self._files[file] = open(file, 'rb')
+        f = self._files[file]
+        f.seek(offset)
+        return f.read(length)
+
+    async def get_last_block(self):
+        return {"Header": self.tip}
+
+    async def get_header(self, b_hash):
+        return {"Header": self.header(b_hash)}
+
+    async def get_full_block(self, b_hash):
+        return loads(self.raw(b_hash))
+
+    async def get_full_block_raw(self, b_hash):
+        return self.raw(b_hash)
+
+    async def get_full_block_raw_by_height(self, height):
+        if (height not in self.heights):
+            raise NodeError("no block at height {} in {}".format(height, self.path))
+        return self.raw(self.heights[height])
+
+
+# Tiny HTTP node serving a dump with the /api/v1 and /api/v1/block contract (for tools that need a URL)
+def serve(source, port=SERVE_PORT):
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, code, body):
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if (self.path != LAST_BLOCK_PATH):
+                return self.reply(404, b'{}')
+            self.reply(200, json.dumps({"Header": source.tip}).encode())
+
+        def do_POST(self):
+            request = loads(self.rfile.read(int(self.headers['Content-Length'])))
+            if ('Height' in request and not request.get('HashHex')):
+                request['HashHex'] = source.heights.get(request['Height'])
+            if (self.path != BLOCK_INFO_PATH or request.get('HashHex') not in source.headers):
+                return self.reply(404, b'{"Error": "block not found"}')
+            b_hash = request['HashHex']
+            if (request.get('FullBlock')):
+                self.reply(200, source.raw(b_hash))
+            else:
+                self.reply(200, json.dumps({"Header": source.header(b_hash)}).encode())
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    print(" - Serving {} blocks of {} on http://127.0.0.1:{} -".format(len(source.headers), source.path, port))
+    server.serve_forever()
+
+
+# NDJSON dump (lowest height first) of the chain stored in the block cache
+def dump_cache(out_path):
+    if (not CACHE_DIR):
+        print(" - The block cache is disabled: set CACHE_DIR in block_cache.py -")
+        exit(-1)
+    with BlockCache(CACHE_DIR) as cache, open(out_path, 'wb') as out:
+        for _, b_hash in reversed(cache.chain()):
+            raw = cache.get(b_hash)
+            if (b'\n' in raw):
+                raw = json.dumps(loads(raw), separators=(',', ':')).encode()
+            out.write(raw + b'\n')
+
+
+if __name__ == '__main__':
+    # python dump_source.py serve <dump> [port] | dump <out.ndjson>
+    match sys.argv[1:]:
+        case ['serve', path]:
+            serve(DumpSource(path))
+        case ['serve', path, port]:
+            serve(DumpSource(path), int(port))
+        case ['dump', out_path]:
+            dump_cache(out_path)
+        case _:
+            print("usage: dump_source.py serve <dump> [port] | dump <out.ndjson>")
@@ -0,0 +1,175 @@
+import json
+import os
+import sys
+
+from sqlalchemy import BigInteger, Boolean, Float, Integer, Numeric, String, cast, func, select
+
+from accounts import tx_source
+from transactions import Block, Transaction
+
+try:
+    import pyarrow as pa  # Only needed to export, optional (pip install pyarrow)
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+#CONFIGURATION
+EXPORT_BATCH = 50000   # Rows per server-side cursor fetch / Parquet row group
+
+#####################################################################################################################
+
+# Columnar (Parquet) export of block/transaction for analytics, streamed through server-side cursors.
+# Layout of <out_dir>:
+#   block/h<first>-<last>.parquet
+#   transaction/tx_type=<identity>/h<first>-<last>.parquet   (hive style, one dataset per tx type)
+#   _export_state.json  -> heights already exported, next runs only add what is outside of them
+# Export after integrity_check, blocks still partial would be exported as they are.
+
+STATE_FILE = '_export_state.json'
+
+
+# Few distinct values repeated on many rows -> dictionary encoded (in Arrow and in Parquet)
+def dictionary_columns(columns):
+    return [c.key for c in columns if c.key == 'block_hash' or (c.key.endswith('_base58') and c.key != 'tx_id_base58')]
+
+
+def arrow_type(column):
+    if isinstance(column.type, BigInteger):
+        return pa.int64()
+    if isinstance(column.type, Integer):
+        return pa.int32()
+    if isinstance(column.type, Float):
+        return pa.float64()
+    if isinstance(column.type, Boolean):
+        return pa.bool_()
+    return pa.string()
+
+
+def arrow_schema(columns):
+    encoded = dictionary_columns(columns)
+    return pa.schema([(c.key, pa.dictionary(pa.int32(), pa.string()) if c.key in encoded else arrow_type(c)) for c in columns])
+
+
+# Columns of every tx type: the shared ones plus the ones of its own subclass (tx_type is the directory)
+def tx_type_columns():
+    return {mapper.polymorphic_identity: [attr.columns[0] for attr in mapper.column_attrs if attr.key != 'tx_type']
+            for mapper in Transaction.__mapper__.self_and_descendants if mapper.polymorphic_identity}
+
+
+def load_state(out_dir):
+    path = os.path.join(out_dir, STATE_FILE)
+    if (not os.path.exists(path)):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(out_dir, state):
+    path = os.path.join(out_dir, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+# Height ranges not exported yet: newer blocks (daemon) and older ones (backfill goes from the tip down)
+def pending_ranges(state, min_height, max_height):
+    if (state is None):
+        return [(min_height, max_height)]
+    ranges = []
+    if (max_height > state['high']):
+        ranges.append((state['high'] + 1, max_height))
+    if (min_height < state['low']):
+        ranges.append((min_height, state['low'] - 1))
+    return ranges
+
+
+# Streams one query into one Parquet file, EXPORT_BATCH rows at a time -> memory doesn't grow with the range
+def write_parquet(conn, query, columns, path):
+    schema = arrow_schema(columns)
+    encoded = dictionary_columns(columns)
+    result = conn.execution_options(stream_results=True, max_row_buffer=EXPORT_BATCH).execute(query)
+
+    writer, n = None, 0
+    for rows in result.partitions(EXPORT_BATCH):
+        if (writer is None):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            writer = pq.ParquetWriter(path + '.tmp', schema, use_dictionary=encoded or False, compression='zstd')
+        arrays = []
+        for i, field in enumerate(schema):
+            values = [row[i] for row in rows]
+            if (field.name in encoded):
+                arrays.append(pa.array(values, pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(values, field.type))
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        n += len(rows)
+
+    if (writer is not None):
+        writer.close()
+        os.replace(path + '.tmp', path)
+    return n
+
+
+def export_range(conn, out_dir, first, last):
+    name = 'h{}-{}.parquet'.format(first, last)
+    counts = {}
+
+    columns = list(Block.__table__.columns)
+    query = select(*columns).where(Block.block_height.between(first, last)).order_by(Block.block_height)
+    counts['block'] = write_parquet(conn, query, columns, os.path.join(out_dir, 'block', name))
+
+    transactions = tx_source(conn)
+    for identity, columns in tx_type_columns().items():
+        # uint256 amounts (NUMERIC) don't fit any Arrow integer -> decimal strings
+        columns = [cast(transactions.c[c.name], String).label(c.name) if isinstance(c.type, Numeric) and not isinstance(c.type, Float)
+                   else transactions.c[c.name] for c in columns]
+        query = select(*columns).where(transactions.c.tx_type == identity, transactions.c.block_height.between(first, last)) \
+                               .order_by(transactions.c.block_height)
+        path = os.path.join(out_dir, 'transaction', 'tx_type={}'.format(identity), name)
+        counts[identity] = write_parquet(conn, query, columns, path)
+
+    return counts
+
+
+# Incremental export, returns the exported rows per dataset
+def export(engine, out_dir):
+    if (pa is None):
+        print("Parquet export needs pyarrow (pip install pyarrow)")
+        exit(-1)
+
+    os.makedirs(out_dir, exist_ok=True)
+    state = load_state(out_dir)
+    totals = {}
+
+    with engine.connect() as conn:
+        min_height, max_height = conn.execute(select(func.min(Block.block_height), func.max(Block.block_height))).one()
+        if (min_height is None):
+            return totals
+
+        for first, last in pending_ranges(state, min_height, max_height):
+            print(" - Exporting heights {} - {} -".format(first, last))
+            for dataset, n in export_range(conn, out_dir, first, last).items():
+                totals[dataset] = totals.get(dataset, 0) + n
+
+            # Saved after every range, an interrupted export restarts from the missing one
+            state = {'low': min(first, state['low']) if state else first,
+                     'high': max(last, state['high']) if state else last}
+            save_state(out_dir, state)
+
+    return totals
+
+
+if __name__ == '__main__':
+    # python export.py <out_dir>
+    import databaseDTO
+
+    sys.argv, args = sys.argv[:1], sys.argv[1:]
+    if (len(args) != 1):
+        print("usage: export.py <out_dir>")
+        exit(-1)
+
+    databaseDTO.bootstrap_db()
+    for dataset, n in sorted(export(databaseDTO.engine, args[0]).items()):
+        if (n):
+            print(" {}: {} rows".format(dataset, n))
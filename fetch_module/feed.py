@@ -0,0 +1,277 @@
+import fcntl
+import importlib
+from abc import ABC, abstractmethod
+import json
+import os
+import time
+from decimal import Decimal
+
+from bulk_writer import BLOCK_COLUMNS, BLOCK_HASH, BLOCK_HEIGHT, TX_COLUMNS, TX_HEIGHT
+from config import setting
+from metrics import FEED_ERRORS
+
+
+#CONFIGURATION (defaults, overridden by DESO_FEED_<KEY> env vars or the [feed] section of deso.ini, see config.py)
+CHANGE_FEED = setting('feed', 'enabled', False)          # Publish every committed batch of blocks/transactions
+FEED_SINK = setting('feed', 'sink', "")                  # "" -> NDJSON log in FEED_DIR, "module:factory" -> factory() is the Sink
+FEED_DIR = setting('feed', 'dir', "feed")
+FEED_SEGMENT_BYTES = setting('feed', 'segment_bytes', 64 << 20)   # A new segment file is started past this size...
+FEED_KEEP_SEGMENTS = setting('feed', 'keep_segments', 32)         # ...and the oldest ones beyond this many are deleted (0 -> never)
+FEED_FSYNC = setting('feed', 'fsync', False)             # fsync every append (survives power loss, slower)
+FEED_RAW = setting('feed', 'raw', False)                 # Keep RawTransactionHex/SignatureHex in the records
+FEED_POLL = setting('feed', 'poll', 0.2)                 # Seconds between checks of `feed.py tail` for new records
+
+#####################################################################################################################
+
+# Change feed of what the writer commits, so consumers (fraud scoring, dashboards...) follow new data without polling the DB.
+# Records are published right after the DB transaction of their rows commits, in commit order:
+#   {"offset": n, "type": "block", "height": h, "block": {<block columns>}, "txs": [{<transaction columns>}, ...]}
+#   {"offset": n, "type": "txs", "height": h, "block_hash": ..., "txs": [...]}   missing txs added to a stored block
+#   {"offset": n, "type": "rollback", "height": h}                              blocks above h are orphaned (fork)
+#   {"offset": n, "type": "orphan", "height": h, "block_hash": ...}             that block is off the node chain (integrity_check)
+# The default sink appends them to an NDJSON log: FEED_DIR/<first offset>.ndjson segments, one record per line,
+# offsets consecutive from 0 (appends are locked, writers of several processes share it). Any other sink (a local
+# broker, a queue...) implements Sink and is configured as FEED_SINK = "module:factory".
+# A crash between the commit and the append, or a failing sink (logged and counted, ingestion goes on), loses the records
+# of that batch: `feed.py replay <height>` publishes stored blocks again (consumers dedupe by block hash / tx id).
+#   python feed.py tail [offset]       (prints the records from offset on, then follows the log)
+#   python feed.py replay <height>     (stored blocks from height up, from the DB)
+
+
+class Sink(ABC):
+
+    # records -> published in this order (dicts, offsets are the sink's business)
+    @abstractmethod
+    def publish(self, records):
+        pass
+
+    def close(self):
+        pass
+
+
+def _value(value):
+    if (isinstance(value, Decimal)):
+        value = int(value)
+    if (isinstance(value, int) and not isinstance(value, bool) and not -2**63 <= value < 2**63):
+        return str(value)    # uint256 amounts, most JSON readers lose them as numbers
+    return value
+
+
+def _record_json(record):
+    return json.dumps(record, separators=(',', ':'), default=_value)
+
+
+def _segment_name(offset):
+    return '{:020d}.ndjson'.format(offset)
+
+
+# Segment files of a log directory -> [(first offset, path)] sorted by offset
+def segments(directory):
+    found = []
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        if (name.endswith('.ndjson') and name[:-7].isdigit()):
+            found.append((int(name[:-7]), os.path.join(directory, name)))
+    return sorted(found)
+
+
+# Last complete line of a file (None if empty), a partial one after it (crashed append) is cut away
+def _last_line(f):
+    data, pos = b'', f.seek(0, os.SEEK_END)
+    while (pos > 0 and data.count(b'\n') < 2):
+        step = min(1 << 16, pos)
+        pos -= step
+        f.seek(pos)
+        data = f.read(step) + data
+    complete = data[:data.rfind(b'\n') + 1]
+    if (len(complete) < len(data)):
+        f.truncate(pos + len(complete))
+    return complete.rstrip(b'\n').rsplit(b'\n', 1)[-1] or None
+
+
+class NdjsonLog(Sink):
+
+    def __init__(self, directory=FEED_DIR, segment_bytes=FEED_SEGMENT_BYTES, keep_segments=FEED_KEEP_SEGMENTS, fsync=FEED_FSYNC):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.keep_segments = keep_segments
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+
+    # Offset of the next record and the segment to append it to, looked up under the lock (other processes append too)
+    def _head(self):
+        found = segments(self.directory)
+        if (not found):
+            return 0, os.path.join(self.directory, _segment_name(0))
+        first, path = found[-1]
+        with open(path, 'r+b') as f:
+            line = _last_line(f)
+            size = f.seek(0, os.SEEK_END)
+        offset = json.loads(line)['offset'] + 1 if line else first
+        if (size >= self.segment_bytes):
+            path = os.path.join(self.directory, _segment_name(offset))
+        return offset, path
+
+    def publish(self, records):
+        if (not records):
+            return
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            offset, path = self._head()
+            lines = []
+            for i, record in enumerate(records):
+                lines.append(_record_json(dict(offset=offset + i, **record)))
+            with open(path, 'ab') as f:
+                f.write(('\n'.join(lines) + '\n').encode())
+                if (self.fsync):
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            if (self.keep_segments):
+                for _, old in segments(self.directory)[:-self.keep_segments]:
+                    os.remove(old)
+
+
+# Records of a log from `offset` on (complete lines only), stops at its end
+def read(directory, offset=0):
+    found = segments(directory)
+    start = 0
+    for i, (first, _) in enumerate(found):
+        if (first <= offset):
+            start = i
+    for _, path in found[start:]:
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:   # Deleted by the retention meanwhile
+            continue
+        with f:
+            for line in f:
+                if (not line.endswith(b'\n')):
+                    break           # Being appended
+                record = json.loads(line)
+                if (record['offset'] >= offset):
+                    yield record
+
+
+# Follows a log: records from `offset` on (None -> only new ones), waiting for more at its end
+def tail(directory, offset=None, poll=FEED_POLL):
+    if (offset is None):
+        last = None
+        for last in read(directory, segments(directory)[-1][0] if segments(directory) else 0):
+            pass
+        offset = last['offset'] + 1 if last else 0
+    while True:
+        for record in read(directory, offset):
+            offset = record['offset'] + 1
+            yield record
+        time.sleep(poll)
+
+
+def load_sink(spec=FEED_SINK):
+    if (not spec):
+        return NdjsonLog()
+    module, _, factory = spec.partition(':')
+    try:
+        factory = getattr(importlib.import_module(module), factory)
+    except (ImportError, AttributeError) as e:
+        print("Change feed sink {} not found: {}".format(spec, e))
+        exit(-1)
+    try:
+        return factory()
+    except TypeError as e:   # i.e. a Sink not implementing publish
+        print("Change feed sink {} can't be created: {}".format(spec, e))
+        exit(-1)
+
+
+# Writer side: buffered rows (BLOCK_COLUMNS/TX_COLUMNS tuples) of a committed batch -> records of the sink.
+# strict=False -> errors of the sink are logged and counted instead of raised (the feed never stops ingestion)
+class ChangeFeed:
+
+    def __init__(self, sink, raw=FEED_RAW, strict=False):
+        self.sink = sink
+        self.strict = strict
+        self.tx_columns = [c for c in TX_COLUMNS if raw or c not in ('tx_raw_hex', 'signature_hex')]
+        self.tx_positions = [TX_COLUMNS.index(c) for c in self.tx_columns]
+        self.tx_block_hash = TX_COLUMNS.index('block_hash')
+
+    def tx_record(self, tx):
+        return {column: _value(tx[p]) for column, p in zip(self.tx_columns, self.tx_positions) if tx[p] is not None}
+
+    def batch_records(self, blocks, txs):
+        by_block = {}
+        for tx in txs:
+            by_block.setdefault(tx[self.tx_block_hash], []).append(tx)
+
+        records = []
+        for block in blocks:
+            records.append({'type': 'block', 'height': block[BLOCK_HEIGHT], 'block': dict(zip(BLOCK_COLUMNS, block)),
+                            'txs': [self.tx_record(tx) for tx in by_block.pop(block[BLOCK_HASH], [])]})
+        for block_hash, block_txs in by_block.items():
+            records.append({'type': 'txs', 'height': block_txs[0][TX_HEIGHT], 'block_hash': block_hash,
+                            'txs': [self.tx_record(tx) for tx in block_txs]})
+        return records
+
+    def _publish(self, records):
+        try:
+            self.sink.publish(records)
+        except Exception as e:
+            if (self.strict):
+                raise
+            FEED_ERRORS.inc(error=type(e).__name__)
+            print(" - Change feed: {} record(s) from height {} not published ({!r}), `feed.py replay` them -"
+                  .format(len(records), records[0]['height'], e))
+
+    def publish(self, blocks, txs):
+        records = self.batch_records(blocks, txs)
+        if (records):
+            self._publish(records)
+
+    def rollback(self, height):
+        self._publish([{'type': 'rollback', 'height': height}])
+
+    # blocks -> (hash, height) of dropped blocks
+    def orphaned(self, blocks):
+        self._publish([{'type': 'orphan', 'height': height, 'block_hash': b_hash} for b_hash, height in sorted(blocks, key=lambda b: b[1])])
+
+    def close(self):
+        self.sink.close()
+
+
+# Stored blocks from `height` up -> published again, a batch of blocks at a time
+def replay(engine, feed, height, batch=200):
+    from sqlalchemy import select
+    from accounts import tx_source
+    from transactions import Block
+
+    with engine.connect() as conn:
+        transactions = tx_source(conn)
+        heights = [h for h, in conn.execute(select(Block.block_height).where(Block.block_height >= height)
+                                            .distinct().order_by(Block.block_height))]
+        for i in range(0, len(heights), batch):
+            first, last = heights[i], heights[min(i + batch, len(heights)) - 1]
+            blocks = [tuple(row) for row in conn.execute(select(*(Block.__table__.c[c] for c in BLOCK_COLUMNS))
+                                                         .where(Block.block_height.between(first, last)).order_by(Block.block_height))]
+            txs = [tuple(row) for row in conn.execute(select(*(transactions.c[c] for c in TX_COLUMNS))
+                                                      .where(transactions.c.block_height.between(first, last))
+                                                      .order_by(transactions.c.block_height, transactions.c.tx_index))]
+            feed.publish(blocks, txs)
+    return len(heights)
+
+
+if __name__ == '__main__':
+    import sys
+
+    sys.argv, args = sys.argv[:1], sys.argv[1:]
+    match args:
+        case ['tail'] | ['tail', _]:
+            try:
+                for record in tail(FEED_DIR, int(args[1]) if len(args) == 2 else None):
+                    print(_record_json(record), flush=True)
+            except KeyboardInterrupt:
+                pass
+        case ['replay', height]:
+            import databaseDTO
+            databaseDTO.bootstrap_db()
+            print(" - {} heights published -".format(replay(databaseDTO.engine, ChangeFeed(load_sink(), strict=True), int(height))))
+        case _:
+            print("usage: feed.py tail [offset] | replay <height>")
+            exit(-1)
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import os
+import time
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from databaseDTO import abort_pending, insert_branch, max_block_h, recent_blocks, rollback_above
+from metrics import LAG_BLOCKS, LAG_SECONDS, POLL_ERRORS, ROLLBACKS, STORED_HEIGHT, TIP_HEIGHT
+from node_client import NodeError
+from parse_pool import ParsePool
+
+
+#CONFIGURATION
+POLL_MIN = 2              # Seconds between tip polls right after a new block...
+POLL_MAX = 30             # ...growing up to this one while the tip doesn't move
+POLL_GROWTH = 1.5
+MAX_REORG_DEPTH = 100     # Stored heights compared with the node chain, deeper forks stop the daemon
+BRANCH_CHUNK = 200        # New blocks kept in memory while walking back to the stored chain, written a chunk per DB transaction
+STATUS_FILE = 'daemon_status.json'
+
+#####################################################################################################################
+
+# Keeps the DB on the node's tip within seconds (the DeSo node API has no push/subscribe endpoint -> adaptive polling).
+# New blocks are walked back from the tip until a stored one is met: if that is not the highest stored block
+# the DB followed a chain the node abandoned, its orphaned blocks (and transactions) are rolled back first.
+# Ingestion lag is kept in `lag_blocks`/`lag_seconds` (and metrics) and written to STATUS_FILE after every poll.
+# A poll failing on the node or the DB is counted and retried after POLL_MAX, what it had not committed is dropped.
+class TipFollower:
+
+    def __init__(self, client, run_db, status_file=STATUS_FILE):
+        self.client = client
+        self.run_db = run_db
+        self.status_file = status_file
+        self.parse_pool = ParsePool(processes=0)  # A few blocks per poll, no need of worker processes
+        self.interval = POLL_MIN
+        self.last_tip = None
+        self.tip_height = None
+        self.stored_height = None
+        self.lag_blocks = None
+        self.lag_seconds = None   # Block timestamp -> stored in the DB
+        self.rollbacks = 0
+        self.errors = 0
+
+    async def run(self):
+        while True:
+            try:
+                moved = await self.step()
+                self.interval = POLL_MIN if moved else min(POLL_MAX, self.interval * POLL_GROWTH)
+            except (NodeError, SQLAlchemyError) as e:
+                self.errors += 1
+                POLL_ERRORS.inc(error=type(e).__name__)
+                print(" - Tip poll failed ({}), retrying in {}s -".format(e, POLL_MAX))
+                self.interval = POLL_MAX
+                await self.run_db(abort_pending)
+            self.write_status()
+            await asyncio.sleep(self.interval)
+
+    # One poll, True if the tip moved
+    async def step(self):
+        header = (await self.client.get_last_block())['Header']
+        self.tip_height = header['Height']
+        TIP_HEIGHT.set(self.tip_height)
+        if (header['BlockHashHex'] == self.last_tip):
+            return False
+
+        recent = await self.run_db(recent_blocks, MAX_REORG_DEPTH)
+        hashes, kept, ancestor = await self.new_branch(header, recent)
+
+        if (ancestor is not None and ancestor < max(recent.values())):
+            orphans = await self.run_db(rollback_above, ancestor)
+            self.rollbacks += 1
+            ROLLBACKS.inc()
+            print(" - Fork at height {}: {} orphaned blocks rolled back -".format(ancestor + 1, orphans))
+
+        # Oldest first, the DB never holds a block without its parent. Blocks not kept by the walk are fetched again
+        hashes.reverse()
+        for i in range(0, len(hashes), BRANCH_CHUNK):
+            chunk = []
+            for b_hash in hashes[i:i + BRANCH_CHUNK]:
+                parsed = kept.pop(b_hash, None)
+                if (parsed is None):
+                    parsed = await self.parse_pool.parse(await self.client.get_full_block_raw(b_hash))
+                chunk.append(parsed)
+            await self.run_db(insert_branch, chunk)
+
+        self.last_tip = header['BlockHashHex']
+        self.stored_height = await self.run_db(max_block_h)
+        self.lag_blocks = self.tip_height - self.stored_height
+        if (hashes):
+            self.lag_seconds = time.time() - header['TstampSecs']
+            LAG_SECONDS.set(self.lag_seconds)
+        STORED_HEIGHT.set(self.stored_height)
+        LAG_BLOCKS.set(self.lag_blocks)
+        return True
+
+    # Hashes of the node chain missing in the DB (tip first), the parsed blocks kept of them (the BRANCH_CHUNK
+    # oldest ones walked so far, the first to be written) and height of the stored block they start from
+    async def new_branch(self, header, recent):
+        hashes, kept = [], {}
+        curr_heigh, curr_hash = header['Height'], header['BlockHashHex']
+        floor = min(recent.values(), default=curr_heigh)
+
+        while (curr_hash not in recent):
+            if (curr_heigh < floor):
+                print(" - Fork deeper than {} blocks below height {}, run integrity_check -".format(MAX_REORG_DEPTH, floor))
+                exit(-1)
+            parsed = await self.parse_pool.parse(await self.client.get_full_block_raw(curr_hash))
+            hashes.append(curr_hash)
+            kept[curr_hash] = parsed
+            if (len(kept) > BRANCH_CHUNK):
+                del kept[hashes[-BRANCH_CHUNK - 1]]
+            if (not recent):  # Empty DB -> following starts from the tip
+                return hashes, kept, None
+            curr_heigh, curr_hash = curr_heigh - 1, parsed.prev_hash
+
+        return hashes, kept, recent[curr_hash]
+
+    def write_status(self):
+        status = {'tip_height': self.tip_height, 'stored_height': self.stored_height,
+                  'lag_blocks': self.lag_blocks, 'lag_seconds': self.lag_seconds,
+                  'poll_interval': self.interval, 'rollbacks': self.rollbacks, 'errors': self.errors, 'updated_at': time.time()}
+        with open(self.status_file + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(status, f)
+        os.replace(self.status_file + '.tmp', self.status_file)
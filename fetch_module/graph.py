@@ -0,0 +1,275 @@
+import sys
+import time
+from array import array
+
+from sqlalchemy import ARRAY, BigInteger, Column, Float, Integer, MetaData, String, Table, cast, delete, func, literal, select
+
+from accounts import tx_source
+from bulk_writer import copy_rows
+from derived import STAGES
+from transactions import Transaction
+
+try:
+    import numpy as np  # Only needed by the graph engine, optional (pip install numpy)
+except ImportError:
+    np = None
+
+
+#CONFIGURATION
+GRAPH_BATCH = 200000          # Edge rows per server-side cursor fetch
+PAGERANK_DAMPING = 0.85
+PAGERANK_TOL = 1e-9           # L1 change of the ranks under which PageRank stops...
+PAGERANK_MAX_ITER = 100       # ...or after this many iterations
+CYCLE_CHUNK = 1 << 22         # 2-paths expanded at once by the 3-cycle search (bounds its memory)
+
+#####################################################################################################################
+
+# In-process graph analytics over the ingested transactions, no external service:
+# edges of a source are aggregated by the DB (one row per directed pair), public keys are interned to dense int32 ids
+# and the graph is kept as CSR arrays (indptr/indices/weights) -> tens of millions of edges fit in a few hundred MB.
+# Degrees, PageRank, weakly connected components and short cycles (wash trading: A -> B -> A, A -> B -> C -> A)
+# are computed with vectorized numpy operations over whole edge arrays, results go back to PostgreSQL:
+#   graph_node   (graph, public_key) -> degrees, weighted degrees, pagerank, component
+#   graph_cycle  (graph, cycle_id)   -> members, length, volume and trades along the cycle
+#   python graph.py [source ...]     (default: every source)
+
+metadata = MetaData()
+
+graph_node = Table('graph_node', metadata,
+                   Column('graph', String, primary_key=True),
+                   Column('public_key', String, primary_key=True),
+                   Column('in_degree', Integer),
+                   Column('out_degree', Integer),
+                   Column('in_weight', Float),
+                   Column('out_weight', Float),
+                   Column('pagerank', Float),
+                   Column('component', Integer, index=True))     # Numbered by decreasing size, 0 -> the largest
+
+graph_cycle = Table('graph_cycle', metadata,
+                    Column('graph', String, primary_key=True),
+                    Column('cycle_id', Integer, primary_key=True),
+                    Column('length', Integer),
+                    Column('members', ARRAY(String)),     # In cycle order, the first one is the smallest id
+                    Column('volume', Float),              # Sum of the weights of its edges
+                    Column('trades', BigInteger))         # Sum of the transactions of its edges
+
+
+def _table(name):
+    return next(stage.table for stage in STAGES if stage.table.name == name)
+
+
+def _pairs(transactions, tx_type, weight):
+    src, dst = transactions.c.tx_transactor_base58, transactions.c.other_us_base58
+    return select(src, dst, cast(weight, Float), func.count()) \
+        .where(transactions.c.tx_type == tx_type, src.isnot(None), dst.isnot(None), src != dst).group_by(src, dst)
+
+
+# Source -> query of (src, dst, weight, transactions) rows, one per directed pair.
+# transactions -> table to read them from (see accounts.tx_source)
+def edge_query(source, transactions=Transaction.__table__):
+    match source:
+        case 'nft_sale':       # NFT seller -> buyer, sold volume (nanos)
+            return _pairs(transactions, 'AcceptNFTBid', func.sum(transactions.c.amount))
+        case 'transfer':       # DeSo sender -> receiver, transferred nanos (tips included)
+            return _pairs(transactions, 'BasicTransfer', func.sum(transactions.c.amount))
+        case 'creator_coin':   # Holder -> creator, trades (buys and sells, their amounts have different units)
+            return _pairs(transactions, 'CreatorCoin', func.count())
+        case 'follow':         # Current follow graph (derived table)
+            edge = _table('follow_edge').c
+            return select(edge.follower_base58, edge.followed_base58, literal(1.0), literal(1)) \
+                .where(edge.is_following, edge.follower_base58 != edge.followed_base58)
+    return None
+
+
+SOURCES = ['nft_sale', 'transfer', 'creator_coin', 'follow']
+
+
+class Graph:
+
+    # keys[id] -> public key, src/dst/weight/trades -> one entry per edge (any order)
+    def __init__(self, keys, src, dst, weight, trades):
+        self.keys = keys
+        self.n = len(keys)
+        order = np.lexsort((dst, src))
+        self.src = src[order]
+        self.indices = dst[order]       # CSR: out-neighbours of v are indices[indptr[v]:indptr[v + 1]] (sorted)
+        self.weights = weight[order]
+        self.trades = trades[order]
+        self.indptr = np.zeros(self.n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.src, minlength=self.n), out=self.indptr[1:])
+        self.edge_keys = self.src.astype(np.int64) * self.n + self.indices   # Sorted, edge lookups by binary search
+
+    @property
+    def n_edges(self):
+        return len(self.indices)
+
+    def out_degree(self):
+        return np.diff(self.indptr).astype(np.int32)
+
+    def in_degree(self):
+        return np.bincount(self.indices, minlength=self.n).astype(np.int32)
+
+    def out_weight(self):
+        return np.bincount(self.src, weights=self.weights, minlength=self.n)
+
+    def in_weight(self):
+        return np.bincount(self.indices, weights=self.weights, minlength=self.n)
+
+    # Weighted PageRank by power iteration, the rank of nodes without out-edges is spread over every node
+    def pagerank(self, damping=PAGERANK_DAMPING, tol=PAGERANK_TOL, max_iter=PAGERANK_MAX_ITER):
+        out_weight = self.out_weight()
+        dangling = out_weight == 0
+        share = self.weights / np.where(dangling, 1, out_weight)[self.src]
+        rank = np.full(self.n, 1 / self.n)
+
+        for _ in range(max_iter):
+            spread = (1 - damping + damping * rank[dangling].sum()) / self.n
+            new = np.bincount(self.indices, weights=rank[self.src] * share, minlength=self.n) * damping + spread
+            delta = np.abs(new - rank).sum()
+            rank = new
+            if (delta < tol):
+                break
+        return rank
+
+    # Weakly connected components: hooking of the higher root onto the lower one + pointer jumping,
+    # numbered by decreasing size
+    def components(self):
+        labels = np.arange(self.n)
+        while True:
+            ls, ld = labels[self.src], labels[self.indices]
+            differ = ls != ld
+            if (not differ.any()):
+                break
+            np.minimum.at(labels, np.maximum(ls, ld)[differ], np.minimum(ls, ld)[differ])
+            while True:
+                jumped = labels[labels]
+                if (np.array_equal(jumped, labels)):
+                    break
+                labels = jumped
+
+        roots, inverse, sizes = np.unique(labels, return_inverse=True, return_counts=True)
+        rank_of_root = np.empty(len(roots), dtype=np.int32)
+        rank_of_root[np.argsort(-sizes, kind='stable')] = np.arange(len(roots), dtype=np.int32)
+        return rank_of_root[inverse]
+
+    # Position of every (a, b) edge in the CSR arrays, -1 if missing
+    def find_edges(self, a, b):
+        wanted = a.astype(np.int64) * self.n + b
+        pos = np.minimum(np.searchsorted(self.edge_keys, wanted), self.n_edges - 1)
+        return np.where(self.edge_keys[pos] == wanted, pos, -1)
+
+    # A <-> B: pairs trading in both directions, each reported once (a < b)
+    def two_cycles(self):
+        back = self.find_edges(self.indices, self.src)
+        found = (back >= 0) & (self.src < self.indices)
+        edges, back = np.nonzero(found)[0], back[found]
+        return [self.src[edges], self.indices[edges]], [edges, back]
+
+    # A -> B -> C -> A, each reported once (starting from its smallest id).
+    # 2-paths are expanded from the CSR arrays CYCLE_CHUNK at a time, then the closing edge is looked up
+    def three_cycles(self):
+        degree = np.diff(self.indptr)
+        first = np.nonzero(self.src < self.indices)[0]           # A -> B with A < B
+        paths = degree[self.indices[first]]                      # B -> C continuations of each
+        ends = np.cumsum(paths)
+
+        members, edges = [[], [], []], [[], [], []]
+        start = 0
+        while (start < len(first)):
+            done = ends[start - 1] if start else 0
+            stop = max(int(np.searchsorted(ends, done + CYCLE_CHUNK, side='right')), start + 1)
+            e1 = first[start:stop]
+            counts = paths[start:stop]
+            e1 = np.repeat(e1, counts)
+            offsets = np.arange(len(e1)) - np.repeat(np.cumsum(counts) - counts, counts)
+            e2 = self.indptr[self.indices[e1]] + offsets
+            a, c = self.src[e1], self.indices[e2]
+            keep = c > a
+            e1, e2, a, c = e1[keep], e2[keep], a[keep], c[keep]
+            e3 = self.find_edges(c, a)
+            closed = e3 >= 0
+            for i, values in enumerate((a[closed], self.indices[e1[closed]], c[closed])):
+                members[i].append(values)
+            for i, values in enumerate((e1[closed], e2[closed], e3[closed])):
+                edges[i].append(values)
+            start = stop
+
+        empty = np.zeros(0, dtype=np.int64)
+        return [np.concatenate(m) if m else empty for m in members], [np.concatenate(e) if e else empty for e in edges]
+
+
+# Streams the edges of a source, interning public keys on the way
+def load_graph(conn, source):
+    ids = {}
+    src, dst, weight, trades = array('i'), array('i'), array('d'), array('q')
+    query = edge_query(source, tx_source(conn))
+    result = conn.execution_options(stream_results=True, max_row_buffer=GRAPH_BATCH).execute(query)
+    for rows in result.partitions(GRAPH_BATCH):
+        for s, d, w, t in rows:
+            src.append(ids.setdefault(s, len(ids)))
+            dst.append(ids.setdefault(d, len(ids)))
+            weight.append(w or 0)
+            trades.append(t)
+
+    keys = list(ids)
+    return Graph(keys, np.frombuffer(src, dtype=np.int32), np.frombuffer(dst, dtype=np.int32),
+                 np.frombuffer(weight, dtype=np.float64), np.frombuffer(trades, dtype=np.int64))
+
+
+def cycle_rows(graph, source, cycles, first_id):
+    members, edges = cycles
+    volume = sum(graph.weights[e] for e in edges)
+    trades = sum(graph.trades[e] for e in edges)
+    for i in range(len(members[0])):
+        yield (source, first_id + i, len(members), '{' + ','.join(graph.keys[m[i]] for m in members) + '}',
+               float(volume[i]), int(trades[i]))
+
+
+# Computes everything on the graph of a source and replaces its rows in graph_node/graph_cycle
+def analyze(engine, source):
+    start = time.perf_counter()
+    with engine.connect() as conn:
+        graph = load_graph(conn, source)
+    loaded = time.perf_counter()
+    if (not graph.n):
+        return graph, {}
+
+    in_degree, out_degree = graph.in_degree(), graph.out_degree()
+    in_weight, out_weight = graph.in_weight(), graph.out_weight()
+    pagerank = graph.pagerank()
+    component = graph.components()
+    two, three = graph.two_cycles(), graph.three_cycles()
+    computed = time.perf_counter()
+
+    with engine.begin() as conn:
+        metadata.create_all(conn)
+        conn.execute(delete(graph_node).where(graph_node.c.graph == source))
+        conn.execute(delete(graph_cycle).where(graph_cycle.c.graph == source))
+        copy_rows(conn, graph_node.name, [c.name for c in graph_node.columns],
+                  zip([source] * graph.n, graph.keys, in_degree.tolist(), out_degree.tolist(), in_weight.tolist(),
+                      out_weight.tolist(), pagerank.tolist(), component.tolist()))
+        copy_rows(conn, graph_cycle.name, [c.name for c in graph_cycle.columns],
+                  list(cycle_rows(graph, source, two, 0)) + list(cycle_rows(graph, source, three, len(two[0][0]))))
+
+    return graph, {'nodes': graph.n, 'edges': graph.n_edges, 'components': int(component.max()) + 1,
+                   'two_cycles': len(two[0][0]), 'three_cycles': len(three[0][0]),
+                   'load_s': round(loaded - start, 2), 'compute_s': round(computed - loaded, 2),
+                   'export_s': round(time.perf_counter() - computed, 2)}
+
+
+if __name__ == '__main__':
+    import databaseDTO
+
+    sys.argv, sources = sys.argv[:1], sys.argv[1:] or SOURCES
+    if (np is None):
+        print("The graph engine needs numpy (pip install numpy)")
+        exit(-1)
+    for source in sources:
+        if (source not in SOURCES):
+            print("usage: graph.py [{}]...".format('|'.join(SOURCES)))
+            exit(-1)
+
+    databaseDTO.bootstrap_db()
+    for source in sources:
+        _, stats = analyze(databaseDTO.engine, source)
+        print(" {}: {}".format(source, stats or 'no edges'))
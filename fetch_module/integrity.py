@@ -0,0 +1,74 @@
+from sqlalchemy import func
+
+from transactions import Block, Transaction
+
+
+# Outcome of an integrity check over the stored block interval (min_height - max_height)
+# gaps -> (first missing height, last missing height, hash of the last missing block)
+# partial -> (height, hash, tx_number, stored txs) of blocks not intirely inserted
+# broken_links -> (height, hash, prev hash stored by the block above it) where the hash chain breaks
+# forks -> (height, number of stored blocks) of heights stored more than once
+class IntegrityReport:
+
+    def __init__(self, min_height, max_height, gaps, partial, broken_links, forks):
+        self.min_height = min_height
+        self.max_height = max_height
+        self.gaps = gaps
+        self.partial = partial
+        self.broken_links = broken_links
+        self.forks = forks
+
+    @property
+    def ok(self):
+        return not (self.gaps or self.partial or self.broken_links or self.forks)
+
+    @property
+    def missing_blocks(self):
+        return sum(last - first + 1 for first, last, _ in self.gaps)
+
+    def __str__(self):
+        return ' Interval: {self.min_height} - {self.max_height}\n Gaps: {} ({} blocks missing)\n Partial blocks: {}\n Broken links: {}\n Forks: {}\n' \
+            .format(len(self.gaps), self.missing_blocks, len(self.partial), len(self.broken_links), len(self.forks), self=self)
+
+
+# Completeness -> one grouped query comparing block.tx_number with the stored (+ skipped) transactions
+def find_partial_blocks(session):
+    stored_txs = session.query(Transaction.block_hash, func.count().label('n')) \
+                        .group_by(Transaction.block_hash).subquery()
+    n_stored = func.coalesce(stored_txs.c.n, 0) + func.coalesce(Block.tx_skipped, 0)
+
+    return session.query(Block.block_height, Block.block_hash, Block.tx_number, n_stored) \
+                  .outerjoin(stored_txs, stored_txs.c.block_hash == Block.block_hash) \
+                  .filter(n_stored != Block.tx_number) \
+                  .order_by(Block.block_height.desc()).all()
+
+
+# Continuity -> one pass of window functions pairing every block with the next stored height
+def find_chain_issues(session):
+    by_height = dict(order_by=(Block.block_height, Block.block_hash))
+    chain = session.query(Block.block_height.label('height'), Block.block_hash.label('hash'),
+                          func.lead(Block.block_height).over(**by_height).label('next_height'),
+                          func.lead(Block.prev_block_hash).over(**by_height).label('next_prev_hash')).subquery()
+
+    issues = session.query(chain).filter((chain.c.next_height != chain.c.height + 1) |
+                                         (chain.c.next_prev_hash != chain.c.hash)) \
+                    .order_by(chain.c.height.desc())
+
+    gaps, broken_links, forks = [], [], {}
+    for height, b_hash, next_height, next_prev_hash in issues:
+        if (next_height is None):
+            continue
+        if (next_height == height):
+            forks[height] = forks.get(height, 1) + 1
+        elif (next_height > height + 1):
+            gaps.append((height + 1, next_height - 1, next_prev_hash))
+        else:
+            broken_links.append((height, b_hash, next_prev_hash))
+
+    return gaps, broken_links, sorted(forks.items(), reverse=True)
+
+
+def check_integrity(session):
+    min_height, max_height = session.query(func.min(Block.block_height), func.max(Block.block_height)).one()
+    gaps, broken_links, forks = find_chain_issues(session)
+    return IntegrityReport(min_height, max_height, gaps, find_partial_blocks(session), broken_links, forks)
@@ -0,0 +1,299 @@
+import json
+from collections import defaultdict
+
+from sqlalchemy import Column, Index, Integer, MetaData, Numeric, String, Table, delete, func, inspect, select, text
+from sqlalchemy.dialects.postgresql import insert
+
+from accounts import tx_source
+from bulk_writer import TX_COLUMNS
+
+
+#CONFIGURATION
+LEDGER = True               # Keep the ledger up to date while blocks are written (turned on later -> `python ledger.py rebuild`)
+SNAPSHOT_INTERVAL = 1000    # Heights between balance snapshots -> a point-in-time balance replays at most this many heights
+REBUILD_BATCH = 50000       # Transactions read at once when (re)building it from `transaction`
+COIN_SELL_FEE_BP = 1        # Creator coin trade fee the node takes from sell proceeds (CreatorCoinTradeFeeBasisPoints)
+
+#####################################################################################################################
+
+# Balance ledger: what every account holds of every asset, now and at any height, fed by the writer in the
+# DB transaction of the rows it comes from (resumes and dirty_insert repairs write each transaction once -> once here).
+#   ledger_delta     (account, asset, height) -> net change of the balance in that block
+#   ledger_balance   (account, asset)         -> current balance
+#   ledger_snapshot  (account, asset, height) -> balance at the end of the last height of every SNAPSHOT_INTERVAL
+#                                                with changes (height = k * SNAPSHOT_INTERVAL - 1)
+# Balance at height H: latest snapshot <= H (one index lookup) + the deltas after it up to H (see balances_at).
+# Blocks come in any order: deltas are sums, a late delta is added to the snapshots above it.
+# Assets (asset_type, asset), amounts as reported by the node:
+#   deso          ''               fees, transfers, block rewards, creator coin buys (spent) and sells (DeSo unlocked
+#                                  from the coin less COIN_SELL_FEE_BP, the fee in force isn't in the metadata; sells
+#                                  stored before migration 10 credit nothing), NFT sales (gross, royalties are only
+#                                  known as rounded percentages), bitcoin exchanges
+#   creator_coin  creator          sells (key) and transfers (the node names the coin by username there); the coins
+#                                  minted by buys aren't in the node metadata -> flows, not holdings
+#   dao_coin      creator          mints, burns, transfers (username) and limit order fills (key)
+#   nft           post:serial      +1/-1 on sales, transfers (pending ones included) and burns, serials never moved
+#                                  aren't there (the node doesn't report the copies minted to the creator)
+#   python ledger.py rebuild
+#   python ledger.py balance <public key> [height]
+
+metadata = MetaData()
+
+def _key_columns():
+    return [Column('account_base58', String, primary_key=True),
+            Column('asset_type', String, primary_key=True),
+            Column('asset', String, primary_key=True)]
+
+ledger_delta = Table('ledger_delta', metadata,
+                     *_key_columns(),
+                     Column('block_height', Integer, primary_key=True),
+                     Column('amount', Numeric(78, 0)),
+                     Index('ix_ledger_delta_block_height', 'block_height'))     # Orphaned heights
+
+ledger_balance = Table('ledger_balance', metadata,
+                       *_key_columns(),
+                       Column('balance', Numeric(78, 0)),
+                       Column('last_height', Integer),
+                       Index('ix_ledger_balance_asset', 'asset_type', 'asset'))  # Holders of an asset
+
+ledger_snapshot = Table('ledger_snapshot', metadata,
+                        *_key_columns(),
+                        Column('snapshot_height', Integer, primary_key=True),
+                        Column('balance', Numeric(78, 0)))
+
+KEY_NAMES = [column.name for column in _key_columns()]
+
+# Types with balance changes of their own (every transaction pays its fees)
+TX_TYPES = {'BasicTransfer', 'BlockReward', 'BitcoinExchange', 'CreatorCoin', 'CreatorCoinTransfer', 'AcceptNFTBid',
+            'NFTTransfer', 'BurnNFT', 'DaoCoin', 'DaoCoinTransfer', 'DaoCoinLimitOrder'}
+
+# Columns entries() reads, the rebuild selects only these (the model may be ahead of the migrated table)
+SOURCE_COLUMNS = ['tx_type', 'block_height', 'tx_transactor_base58', 'other_us_base58', 'amount', 'post_hash', 'nft_serial',
+                  'mine_fee', 'node_fee', 'node_recipient_base58', 'deso_gen', 'is_buy', 'deso_locked_diff', 'creator_base58',
+                  'dao_coins', 'dao_operation', 'dao_fills_json']
+LATER_COLUMNS = {'deso_locked_diff'}   # Added by a migration after the one rebuilding the ledger -> read if there
+
+
+def create_ledger(engine):
+    metadata.create_all(engine)
+
+
+# tx (dict of transaction columns) -> (account, asset_type, asset, amount) changes of balances
+def entries(tx):
+    transactor, other = tx['tx_transactor_base58'], tx['other_us_base58']
+    amount = tx['amount'] or 0
+    nft = '{}:{}'.format(tx['post_hash'], tx['nft_serial'])
+
+    # Paid by every transaction (block rewards include the fees of their block)
+    yield transactor, 'deso', '', -(tx['mine_fee'] or 0)
+    if (tx['node_fee']):
+        yield transactor, 'deso', '', -tx['node_fee']
+        yield tx['node_recipient_base58'], 'deso', '', tx['node_fee']
+
+    if (tx['tx_type'] not in TX_TYPES):
+        return
+    match tx['tx_type']:
+        case 'BasicTransfer':
+            yield transactor, 'deso', '', -amount
+            yield other, 'deso', '', amount
+        case 'BlockReward':
+            yield other, 'deso', '', amount
+        case 'BitcoinExchange':
+            yield transactor, 'deso', '', tx['deso_gen'] or 0
+        case 'CreatorCoin':
+            if (tx['is_buy']):
+                yield transactor, 'deso', '', -amount
+            else:
+                yield transactor, 'creator_coin', other, -amount
+                if (tx.get('deso_locked_diff')):
+                    unlocked = -tx['deso_locked_diff']
+                    yield transactor, 'deso', '', unlocked * (10000 - COIN_SELL_FEE_BP) // 10000
+        case 'CreatorCoinTransfer':
+            yield transactor, 'creator_coin', tx['creator_base58'], -amount
+            yield other, 'creator_coin', tx['creator_base58'], amount
+        case 'AcceptNFTBid':      # The owner accepts the bid of `other`
+            yield other, 'deso', '', -amount
+            yield transactor, 'deso', '', amount
+            yield transactor, 'nft', nft, -1
+            yield other, 'nft', nft, 1
+        case 'NFTTransfer':
+            yield transactor, 'nft', nft, -1
+            yield other, 'nft', nft, 1
+        case 'BurnNFT':
+            yield transactor, 'nft', nft, -1
+        case 'DaoCoin':
+            coins = int(tx['dao_coins'] or 0)
+            if (tx['dao_operation'] == 'mint'):
+                yield transactor, 'dao_coin', tx['creator_base58'], coins
+            elif (tx['dao_operation'] == 'burn'):
+                yield transactor, 'dao_coin', tx['creator_base58'], -coins
+        case 'DaoCoinTransfer':
+            coins = int(tx['dao_coins'] or 0)
+            yield transactor, 'dao_coin', tx['creator_base58'], -coins
+            yield other, 'dao_coin', tx['creator_base58'], coins
+        case 'DaoCoinLimitOrder':  # Every order filled by it, its own one included
+            for fill in json.loads(tx['dao_fills_json']) if tx['dao_fills_json'] else []:
+                yield fill['transactor'], 'dao_coin', fill['buying'], int(fill['bought'])
+                yield fill['transactor'], 'dao_coin', fill['selling'], -int(fill['sold'])
+
+
+# txs (dicts) -> {(account, asset_type, asset, height): amount}, changes netting to 0 dropped
+def deltas(txs):
+    found = defaultdict(int)
+    for tx in txs:
+        for account, asset_type, asset, amount in entries(tx):
+            if (account is not None and asset is not None and amount):
+                found[(account, asset_type, asset, tx['block_height'])] += amount
+    return {key: amount for key, amount in found.items() if amount}
+
+
+def _arrays(changes):
+    accounts, asset_types, assets, heights, amounts = zip(*((*key, amount) for key, amount in changes))
+    return {'accounts': list(accounts), 'asset_types': list(asset_types), 'assets': list(assets),
+            'heights': list(heights), 'amounts': [str(amount) for amount in amounts]}
+
+
+BATCH = ('unnest(CAST(:accounts AS varchar[]), CAST(:asset_types AS varchar[]), CAST(:assets AS varchar[]), '
+         'CAST(:heights AS integer[]), CAST(:amounts AS numeric[])) b(account_base58, asset_type, asset, block_height, amount)')
+
+SAME_KEY = 's.account_base58 = b.account_base58 AND s.asset_type = b.asset_type AND s.asset = b.asset'
+
+
+def apply_changes(conn, changes):
+    if (not changes):
+        return
+    changes = sorted(changes.items())
+
+    # Balances first: their row locks serialize concurrent writers (backfill) on the same keys until commit,
+    # taken in key order -> no deadlock
+    balances = defaultdict(lambda: [0, -1])
+    for (account, asset_type, asset, height), amount in changes:
+        balance = balances[(account, asset_type, asset)]
+        balance[0] += amount
+        balance[1] = max(balance[1], height)
+    stmt = insert(ledger_balance)
+    conn.execute(stmt.on_conflict_do_update(
+        index_elements=KEY_NAMES,
+        set_={'balance': ledger_balance.c.balance + stmt.excluded.balance,
+              'last_height': func.greatest(ledger_balance.c.last_height, stmt.excluded.last_height)}),
+        [dict(zip(KEY_NAMES, key), balance=balance, last_height=height) for key, (balance, height) in sorted(balances.items())])
+
+    stmt = insert(ledger_delta)
+    conn.execute(stmt.on_conflict_do_update(index_elements=KEY_NAMES + ['block_height'],
+                                            set_={'amount': ledger_delta.c.amount + stmt.excluded.amount}),
+                 [dict(zip(KEY_NAMES + ['block_height'], key), amount=amount) for key, amount in changes])
+
+    arrays = _arrays(changes)
+    # Snapshots at or above a change include it...
+    conn.execute(text('UPDATE ledger_snapshot u SET balance = u.balance + d.amount FROM ('
+                      'SELECT s.account_base58, s.asset_type, s.asset, s.snapshot_height, sum(b.amount) AS amount '
+                      'FROM {} JOIN ledger_snapshot s ON {} AND s.snapshot_height >= b.block_height '
+                      'GROUP BY 1, 2, 3, 4) d '
+                      'WHERE u.account_base58 = d.account_base58 AND u.asset_type = d.asset_type AND u.asset = d.asset '
+                      'AND u.snapshot_height = d.snapshot_height'.format(BATCH, SAME_KEY)), arrays)
+
+    # ...missing ones of the changed intervals are the previous snapshot + the deltas after it
+    conn.execute(text('INSERT INTO ledger_snapshot (account_base58, asset_type, asset, snapshot_height, balance) '
+                      'SELECT b.account_base58, b.asset_type, b.asset, b.snapshot_height, coalesce(p.balance, 0) + '
+                      '(SELECT coalesce(sum(d.amount), 0) FROM ledger_delta d WHERE d.account_base58 = b.account_base58 '
+                      'AND d.asset_type = b.asset_type AND d.asset = b.asset '
+                      'AND d.block_height > coalesce(p.snapshot_height, -1) AND d.block_height <= b.snapshot_height) '
+                      'FROM (SELECT DISTINCT b.account_base58, b.asset_type, b.asset, '
+                      '(b.block_height / :interval + 1) * :interval - 1 AS snapshot_height FROM {}) b '
+                      'LEFT JOIN LATERAL (SELECT s.snapshot_height, s.balance FROM ledger_snapshot s WHERE {} '
+                      'AND s.snapshot_height < b.snapshot_height ORDER BY s.snapshot_height DESC LIMIT 1) p ON true '
+                      'ON CONFLICT DO NOTHING'.format(BATCH, SAME_KEY)), dict(arrays, interval=SNAPSHOT_INTERVAL))
+
+
+# deltas() of rows in TX_COLUMNS order
+def row_deltas(txs):
+    return deltas([dict(zip(TX_COLUMNS, tx)) for tx in txs])
+
+
+# Writer hook: txs -> rows (TX_COLUMNS order) being written in conn
+def apply_ledger(conn, txs):
+    apply_changes(conn, row_deltas(txs))
+
+
+# txs (dicts) deleted from `transaction` -> their changes taken back
+def revert_ledger(conn, txs):
+    changes = deltas(txs)
+    apply_changes(conn, {key: -amount for key, amount in changes.items()})
+    if (changes):
+        conn.execute(delete(ledger_delta).where(ledger_delta.c.amount == 0))
+        conn.execute(text('UPDATE ledger_balance s SET last_height = (SELECT max(d.block_height) FROM ledger_delta d '
+                          'WHERE d.account_base58 = s.account_base58 AND d.asset_type = s.asset_type AND d.asset = s.asset) '
+                          'FROM (SELECT DISTINCT account_base58, asset_type, asset FROM {}) b WHERE {}'.format(BATCH, SAME_KEY)),
+                     _arrays(changes.items()))
+
+
+# Blocks above `height` are orphaned (called before or after their transactions are deleted)
+def rollback_ledger(conn, height):
+    params = {'height': height}
+    conn.execute(text('UPDATE ledger_balance s SET balance = s.balance - b.amount FROM ('
+                      'SELECT account_base58, asset_type, asset, sum(amount) AS amount FROM ledger_delta '
+                      'WHERE block_height > :height GROUP BY 1, 2, 3) b WHERE {}'.format(SAME_KEY)), params)
+    conn.execute(text('DELETE FROM ledger_snapshot s USING (SELECT DISTINCT account_base58, asset_type, asset FROM ledger_delta '
+                      'WHERE block_height > :height) b WHERE {} AND s.snapshot_height > :height'.format(SAME_KEY)), params)
+    conn.execute(text('UPDATE ledger_balance s SET last_height = (SELECT max(d.block_height) FROM ledger_delta d '
+                      'WHERE d.account_base58 = s.account_base58 AND d.asset_type = s.asset_type AND d.asset = s.asset '
+                      'AND d.block_height <= :height) WHERE s.last_height > :height'), params)
+    conn.execute(delete(ledger_delta).where(ledger_delta.c.block_height > height))
+
+
+# {(asset_type, asset): balance} of account at the end of `height` (None -> now), optionally of one asset type/asset
+def balances_at(conn, account, height=None, asset_type=None, asset=None):
+    filters, params = '', {'account': account, 'height': height}
+    if (asset_type is not None):
+        filters += ' AND b.asset_type = :asset_type'
+        params['asset_type'] = asset_type
+    if (asset is not None):
+        filters += ' AND b.asset = :asset'
+        params['asset'] = asset
+
+    if (height is None):
+        rows = conn.execute(text('SELECT b.asset_type, b.asset, b.balance FROM ledger_balance b '
+                                 'WHERE b.account_base58 = :account' + filters), params)
+    else:
+        rows = conn.execute(text('SELECT b.asset_type, b.asset, coalesce(p.balance, 0) + '
+                                 '(SELECT coalesce(sum(d.amount), 0) FROM ledger_delta d WHERE d.account_base58 = b.account_base58 '
+                                 'AND d.asset_type = b.asset_type AND d.asset = b.asset '
+                                 'AND d.block_height > coalesce(p.snapshot_height, -1) AND d.block_height <= :height) '
+                                 'FROM ledger_balance b LEFT JOIN LATERAL (SELECT s.snapshot_height, s.balance FROM ledger_snapshot s '
+                                 'WHERE s.account_base58 = b.account_base58 AND s.asset_type = b.asset_type AND s.asset = b.asset '
+                                 'AND s.snapshot_height <= :height ORDER BY s.snapshot_height DESC LIMIT 1) p ON true '
+                                 'WHERE b.account_base58 = :account' + filters), params)
+    return {(asset_type, asset): int(balance) for asset_type, asset, balance in rows if balance}
+
+
+# The whole ledger from scratch (i.e. on a DB that stored transactions before it existed)
+def rebuild(conn):
+    for table in (ledger_snapshot, ledger_delta, ledger_balance):
+        conn.execute(delete(table))
+    transactions = tx_source(conn)
+    present = {column['name'] for column in inspect(conn).get_columns(transactions.name)}
+    columns = [c for c in SOURCE_COLUMNS if c not in LATER_COLUMNS or c in present]
+    result = conn.execution_options(stream_results=True).execute(select(*(transactions.c[c] for c in columns)))
+    for batch in result.partitions(REBUILD_BATCH):
+        apply_changes(conn, deltas([dict(row._mapping) for row in batch]))
+
+
+if __name__ == '__main__':
+    import sys
+    import databaseDTO
+
+    sys.argv, args = sys.argv[:1], sys.argv[1:]
+    if (args[:1] == ['rebuild'] and len(args) == 1):
+        databaseDTO.bootstrap_db()
+        with databaseDTO.engine.begin() as conn:
+            rebuild(conn)
+            for table in (ledger_delta, ledger_balance, ledger_snapshot):
+                print(" {}: {} rows".format(table.name, conn.execute(select(func.count()).select_from(table)).scalar()))
+    elif (args[:1] == ['balance'] and len(args) in (2, 3)):
+        databaseDTO.bootstrap_db()
+        with databaseDTO.engine.connect() as conn:
+            for (asset_type, asset), balance in sorted(balances_at(conn, args[1], int(args[2]) if len(args) == 3 else None).items()):
+                print(" {:<13}{:<70}{}".format(asset_type, asset, balance))
+    else:
+        print("usage: ledger.py rebuild | balance <public key> [height]")
+        exit(-1)
@@ -1,89 +1,225 @@
 from multiprocessing import current_process
+import asyncio
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from threading import Thread
 import time
-import requests
-import json
-import random
 
+from block_cache import CACHE_DIR, BlockCache
 from databaseDTO import *
+from dump_source import DumpSource
+from follower import TipFollower
+from metrics import TIP_HEIGHT, start_metrics, stop_metrics
+from node_client import NODE_URLS, NodeClient, NodeError
+from node_pool import NodePool
+from parse_pool import PARSE_PROCESSES, ParsePool
+from parsers import loads
+from prefetcher import FETCH_WINDOW, FETCH_WORKERS, prefetch, walk_chain
 from progress.bar import Bar
 
 
-#Endpoints
-last_block_endp = "https://bitclout.com/api/v1?"
-block_info_endp = "https://bitclout.com/api/v1/block"
+# Every use of the DB writer (and of the session scoped to this thread) goes through this single thread,
+# so the event loop keeps downloading while a block is being inserted and inserts keep the order of jobs
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db_writer')
 
-# A custom http request that retries in case of failure with a growing interval
-def http_request(type,block_hash):
-    try_num=0
-    while(True):
-        try:
-            if(type=="lastblock"):
-                r = requests.get(last_block_endp)
-            if(type=="header"):
-                r = requests.post(block_info_endp, json={"HashHex": block_hash})
-            if(type=="fullblock"):
-                r = requests.post(block_info_endp, json={"HashHex": block_hash,"FullBlock":True})
-            return r.json()
-        except(requests.exceptions.ConnectionError, json.decoder.JSONDecodeError) as err:
-            time.sleep(2**try_num + random.random()*0.01) #Exponential
-            try_num+=1
+# Threads don't survive a fork -> the child needs a fresh executor
+def _reset_db_executor():
+    global db_executor
+    db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db_writer')
 
+os.register_at_fork(after_in_child=_reset_db_executor)
 
-# MY BEST MASTERPIECE -> ELEGANT AS F.. (V.3 - iterative fetch including an enough integrity check)
+def run_db(func, *args):
+    return asyncio.get_running_loop().run_in_executor(db_executor, func, *args)
+
+
+# Single letter running option (i.e. -r), same syntax bootstrap_db parses
+def option(op):
+    return any(arg[0] == '-' and arg[1:2] != '-' and op in arg[1:] for arg in sys.argv[1:])
+
+
+# Value of --name=value / --name value, None if not given
+def long_option(name):
+    for i, arg in enumerate(sys.argv[1:], 1):
+        if(arg.startswith('--{}='.format(name))):
+            return arg.split('=', 1)[1]
+        if(arg == '--{}'.format(name) and i + 1 < len(sys.argv)):
+            return sys.argv[i + 1]
+    return None
+
+
+# Where blocks come from: the node(s) of NODE_URLS (default), --source <url>[,<url>...] other nodes or a local
+# stand-in of one, --source <dir|file> JSON/NDJSON block dumps (offline). Several nodes are load balanced.
+def open_source():
+    source = long_option('source')
+    urls = NODE_URLS if source is None else source.split(',')
+    if(not urls[0].startswith(('http://', 'https://'))):
+        return DumpSource(source)
+    return NodePool(urls) if len(urls) > 1 else NodeClient(base_url=urls[0])
+
+
+# MY BEST MASTERPIECE -> ELEGANT AS F.. (V.4 - pipelined fetch: headers resolve the chain, full blocks are prefetched concurrently)
 
 def iterative_fetch():
-    #Check integrity of local blockchain
-    max_stored_in_db = max_block_h()
-    min_stored_in_db = min_block_h()
-
-    last_b_header = http_request("lastblock",None)['Header']
-    curr_heigh = last_b_header['Height']
-    curr_hash = last_b_header['BlockHashHex']
-
-    with Bar('Fetching:',max = curr_heigh,) as bar:
-        while(curr_heigh>0):
-            if(curr_heigh>max_stored_in_db or curr_heigh<min_stored_in_db):
-                curr_hash = clean_insert(http_request("fullblock",curr_hash))
-                #print("not yet db reached -> clean insert")
-            else:
-                if(not block_is_in_db(curr_hash)):
-                    curr_hash = clean_insert(http_request("fullblock",curr_hash))
-                    #print("this miss in db -> clean insert")
-                else:
-                    if(not block_is_intirely_inserted(curr_hash)):
-                        curr_hash = dirty_insert(http_request("fullblock",curr_hash))
-                        #print("here i have been interrupted, add the rest -> dirty insert")
-                    else:
-                        curr_hash = get_prev_block(curr_hash)
-                        #print("everything good,SKIP")
-
-            curr_heigh-=1
+    asyncio.run(_iterative_fetch())
+
+async def _iterative_fetch():
+    #Check integrity of local blockchain -> what is stored, what is half inserted (2 aggregate queries)
+    resume = await run_db(resume_plan)
+
+    async with open_source() as client:
+        last_b_header = (await client.get_last_block())['Header']
+        tip_heigh = last_b_header['Height']
+        tip_hash = last_b_header['BlockHashHex']
+        TIP_HEIGHT.set(tip_heigh)
+
+        # Stored blocks already know their parent, the others need their header
+        async def prev_hash_of(b_hash):
+            prev_hash = resume.prev_hash_of(b_hash)
+            if(prev_hash is None):
+                prev_hash = (await client.get_header(b_hash))['Header']['PrevBlockHashHex']
+            return prev_hash
+
+        async def plan():
+            async for curr_heigh, curr_hash in walk_chain(tip_heigh, tip_hash, prev_hash_of):
+                yield curr_heigh, curr_hash, resume.action(curr_hash)
+
+        await _ingest(client.get_full_block_raw, plan(), tip_heigh, resume.stored_tx_ids, FETCH_WORKERS * client.size)
+
+
+# Re-ingestion of the chain stored in the block cache (i.e. after a schema change or a parser fix),
+# no request to the node -> bounded by local disk and parsing speed
+def replay_from_cache():
+    if(not CACHE_DIR):
+        print(" - -r replays the block cache, which is disabled: set CACHE_DIR in block_cache.py -")
+        exit(-1)
+    asyncio.run(_replay_from_cache())
+
+async def _replay_from_cache():
+    resume = await run_db(resume_plan)
+    with BlockCache(CACHE_DIR) as cache:
+        chain = cache.chain()
+
+    async def plan():
+        for curr_heigh, curr_hash in chain:
+            yield curr_heigh, curr_hash, resume.action(curr_hash)
+
+    async def not_cached(b_hash):
+        raise NodeError("block {} is not in the block cache".format(b_hash))
+
+    print(" - Replaying {} cached blocks ({} - {}) -".format(len(chain), chain[-1][0] if chain else '', chain[0][0] if chain else ''))
+    await _ingest(not_cached, plan(), len(chain), resume.stored_tx_ids)
+
+
+# Download + parse (in the parse pool) run concurrently, inserts follow the order of jobs.
+# fetch_raw(key) -> coroutine returning the raw full block of a job key (its hash, or whatever fetch_raw resolves),
+# blocks already in the block cache are read from disk
+# workers -> concurrent downloads (FETCH_WORKERS per node)
+# collect -> function(parsed) taking the new blocks instead of the writer (i.e. a partition loaded at once)
+async def _ingest(fetch_raw, jobs, n_jobs, stored_tx_ids=lambda b_hash: None, workers=FETCH_WORKERS, parse_processes=PARSE_PROCESSES, collect=None):
+    async def fetch_parsed(key):
+        if(cache is not None and key in cache):
+            return await parse_pool.parse(cache.get_compressed(key), compressed=True)
+        raw = await fetch_raw(key)
+        parsed = await parse_pool.parse(raw)
+        if(cache is not None):
+            await asyncio.to_thread(cache.put, parsed.block_hash, parsed.height, parsed.prev_hash, raw)
+        return parsed
+
+    with open_cache() as cache, ParsePool(parse_processes) as parse_pool, Bar('Fetching:',max = n_jobs,) as bar:
+        async for curr_heigh, curr_hash, action, parsed in prefetch(jobs, fetch_parsed, workers, max(FETCH_WINDOW, 2 * workers)):
+            if(action=="clean" and collect is not None):
+                collect(parsed)
+            elif(action=="clean"):
+                await run_db(clean_insert_rows, parsed)
+            if(action=="dirty"):
+                await run_db(dirty_insert_rows, parsed, stored_tx_ids(curr_hash))
             bar.next()
+    await run_db(flush_db)
+
+
+def open_cache():
+    return BlockCache(CACHE_DIR) if CACHE_DIR else nullcontext()
+
+
+# Targeted repair of what an integrity report found: partial blocks are completed, gaps are refetched
+async def _repair(report):
+    async with open_source() as client:
+        async def header_prev_hash(b_hash):
+            return (await client.get_header(b_hash))['Header']['PrevBlockHashHex']
+
+        async def jobs():
+            for curr_heigh, curr_hash, _, _ in report.partial:
+                yield curr_heigh, curr_hash, "dirty"
+            for first, last, last_hash in report.gaps:
+                async for curr_heigh, curr_hash in walk_chain(last, last_hash, header_prev_hash, stop_height=first-1):
+                    yield curr_heigh, curr_hash, "clean"
+
+        await _ingest(client.get_full_block_raw, jobs(), len(report.partial) + report.missing_blocks, workers=FETCH_WORKERS * client.size)
+
+
+# Hash of the node chain at those heights
+async def _canonical_hashes(heights):
+    async with open_source() as client:
+        async def canonical(height):
+            return height, loads(await client.get_full_block_raw_by_height(height))['Header']['BlockHashHex']
+        return dict(await asyncio.gather(*(canonical(height) for height in heights)))
+
+
+# Forks and broken links -> stored blocks at their heights that are not on the node chain are dropped with their
+# descendants (databaseDTO.drop_blocks), the heights left missing are gaps for _repair
+def _drop_off_chain(report):
+    heights = {height for height, _ in report.forks}
+    for height, _, _ in report.broken_links:
+        heights.update((height, height + 1))
+    try:
+        canonical = asyncio.run(_canonical_hashes(sorted(heights)))
+    except NodeError as e:
+        print(" - Node chain not available at those heights ({}) -".format(e))
+        return 0
+    off_chain = [b_hash for height, b_hash in blocks_at(heights) if b_hash != canonical[height]]
+    return drop_blocks(off_chain) if off_chain else 0
+
 
 def integrity_check():
-    max_stored_in_db = max_block_h()
-    current_heigh = min_stored_in_db = min_block_h()
-    while(current_heigh>=min_stored_in_db):
-        if(block_is_intirely_inserted_by_height(max_stored_in_db)==False):
-            print("{} height block not entirely inserted".format(current_heigh))
-            sys.exit(-1)
-
-        current_heigh-=1
-    
-    print(" - Everything fine in block interval ({} - {}), blocks/transactions have been fully inserted! -".format(max_stored_in_db,min_stored_in_db))
+    # Grouped/window queries over the whole interval -> gaps, partial blocks, broken hash links, forks
+    report = integrity_report()
+
+    while(report.forks or report.broken_links):
+        print(" - Repairing {} forks and {} broken links -".format(len(report.forks), len(report.broken_links)))
+        dropped = _drop_off_chain(report)
+        if(not dropped):
+            break
+        print(" - {} blocks off the node chain dropped -".format(dropped))
+        report = integrity_report()
+
+    if(report.gaps or report.partial):
+        print(" - Repairing {} partial blocks and {} missing blocks -".format(len(report.partial), report.missing_blocks))
+        asyncio.run(_repair(report))
+        report = integrity_report()
+
+    # What the node can't repair (i.e. heights a dump source doesn't have) is reported, the daemon follows the tip anyway
+    if(not report.ok):
+        print(" - Integrity issues left, continuing -")
+        print(report)
+        return
+
+    print(" - Everything fine in block interval ({} - {}), blocks/transactions have been fully inserted! -".format(report.max_height,report.min_height))
 
 def start_daemon_process():
     print("- Starting Daemon Process -")
-    pid=os.fork()
+    stop_metrics()  # The daemon exposes its own
+    flush_db()      # Nothing buffered is left to the parent
+    end_read()
 
     # Psycopg DOCUMENTATION
     # The Psycopg module and the connection objects are thread-safe: many threads 
     # can access the same database....
-    # MEANING: When fork re-establish a connection to the database
-    bootstrap_db()
+    # MEANING: connections must not be shared across a fork -> the child drops the inherited pool
+    # (databaseDTO._after_fork) and opens its own connections
+    pid=os.fork()
 
     if pid:
         sys.exit(0)   
@@ -97,25 +233,14 @@ def start_daemon_process():
 
         #print("\n- Daemon Process started -")
 
-        while True:
-            #Get highest block inserted in DB
-            max_stored_in_db = max_block_h()
-
-            #Get highest block mined
-            last_b_header = http_request("lastblock",None)['Header']
-            curr_heigh = last_b_header['Height']
-            curr_hash = last_b_header['BlockHashHex']
+        start_metrics()
+        asyncio.run(_daemon_loop())
 
-            #print("DB : {} - INTERNET: {}".format(max_stored_in_db,curr_heigh))
 
-            #Insert until heighest block in DB is reached
-            while(curr_heigh>max_stored_in_db):
-                curr_hash = clean_insert(http_request("fullblock",curr_hash))
-                #print("{} inserted".format(curr_heigh))
-                curr_heigh-=1
-            
-            #Wait block time interval (Deso's standard = 5 min)
-            time.sleep(5*60)
+# Follows the node tip: adaptive polling, fork rollback, lag in daemon_status.json
+async def _daemon_loop():
+    async with open_source() as client:
+        await TipFollower(client, run_db).run()
 
 
 if __name__ == '__main__':
@@ -123,12 +248,20 @@ if __name__ == '__main__':
     #Establishing DB connection + parse argv
     bootstrap_db()
 
-    #Start fetching 
+    #Metrics endpoint/dump (if configured in metrics.py)
+    start_metrics()
+
+    #Start fetching (-r -> replay the chain stored in the block cache first)
+    if(option('r')):
+        replay_from_cache()
     iterative_fetch()
 
     #Final integrity check
     integrity_check()
 
+    #DAO order book replayed over what has been fetched (the writer only advances it near the tip)
+    catch_up_order_book()
+
     #Start Deso fecthing daemon
     start_daemon_process()
 
@@ -0,0 +1,254 @@
+import atexit
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+#CONFIGURATION
+METRICS_PORT = 0              # > 0 -> Prometheus text format on http://127.0.0.1:METRICS_PORT/metrics
+METRICS_FILE = ""             # Not empty -> JSON dump of every metric...
+METRICS_INTERVAL = 10         # ...rewritten every this many seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)   # Seconds
+
+#####################################################################################################################
+
+# In-process metrics of the hot paths (node requests, decode/parse, DB flush/commit, throughput, lag).
+# Counters, gauges and histograms are labelled like Prometheus ones; updates only take a lock,
+# exposition (HTTP endpoint and/or periodic JSON dump) runs on its own thread.
+
+REGISTRY = {}          # name -> metric
+_lock = threading.Lock()
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _prom_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if (not pairs):
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in pairs) + '}'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = {}   # label key -> value
+        REGISTRY[name] = self
+
+    def snapshot(self):
+        with _lock:
+            return [dict(key, value=self._export(value)) for key, value in self.values.items()]
+
+    def _export(self, value):
+        return value
+
+    def prometheus(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} {}'.format(self.name, self.kind)]
+        with _lock:
+            for key, value in self.values.items():
+                lines.append('{}{} {}'.format(self.name, _prom_labels(key), value))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(_label_key(labels), 0)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with _lock:
+            self.values[_label_key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=BUCKETS):
+        super().__init__(name, description)
+        self.buckets = buckets
+
+    # value -> [count per bucket (+Inf last), count, sum, max]
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with _lock:
+            h = self.values.get(key)
+            if (h is None):
+                h = self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0.0, 0.0]
+            h[0][bisect_left(self.buckets, value)] += 1
+            h[1] += 1
+            h[2] += value
+            h[3] = max(h[3], value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _export(self, value):
+        counts, count, total, highest = value
+        return {'count': count, 'sum': round(total, 6), 'mean': round(total / count, 6) if count else None,
+                'max': round(highest, 6), 'p50': self._quantile(counts, count, 0.5), 'p99': self._quantile(counts, count, 0.99)}
+
+    # Upper bound of the bucket holding the quantile
+    def _quantile(self, counts, count, q):
+        seen = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            seen += n
+            if (count and seen >= q * count):
+                return bound
+        return None
+
+    def prometheus(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} histogram'.format(self.name)]
+        with _lock:
+            for key, (counts, count, total, _) in self.values.items():
+                cumulative = 0
+                for bound, n in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += n
+                    lines.append('{}_bucket{} {}'.format(self.name, _prom_labels(key, [('le', bound)]), cumulative))
+                lines.append('{}_sum{} {}'.format(self.name, _prom_labels(key), total))
+                lines.append('{}_count{} {}'.format(self.name, _prom_labels(key), count))
+        return lines
+
+
+# -------------------------------- Metrics -----------------------------------
+
+NODE_REQUEST = Histogram('node_request_seconds', "Latency of node API requests (single attempt) by endpoint and node")
+NODE_RETRIES = Counter('node_retries_total', "Node API requests retried, by endpoint and reason")
+NODE_ERRORS = Counter('node_errors_total', "Node API requests failed for good, by endpoint")
+NODE_SCORE = Gauge('node_cost', "Expected cost of a request to a node of the pool (latency, load, errors)")
+TIP_DISAGREEMENTS = Counter('tip_disagreements_total', "Tip polls where nodes reported different blocks at the same height")
+DECODE = Histogram('json_decode_seconds', "JSON decoding of a full block")
+PARSE = Histogram('parse_seconds', "Mapping of a decoded full block to rows")
+DB_FLUSH = Histogram('db_flush_seconds', "Writing a batch of rows (COPY/executemany), commit excluded")
+DB_COMMIT = Histogram('db_commit_seconds', "Commit of a batch")
+BLOCKS = Counter('blocks_inserted_total', "Blocks written to the DB")
+TXS = Counter('txs_inserted_total', "Transactions written to the DB")
+FEED_ERRORS = Counter('feed_publish_errors_total', "Committed batches/rollbacks the change feed sink failed to publish, by error")
+UNKNOWN_TX_TYPES = Gauge('unknown_tx_types', "Transactions skipped because their TxnType has no parser, by type")
+TIP_HEIGHT = Gauge('node_tip_height', "Height of the node tip at the last poll")
+STORED_HEIGHT = Gauge('stored_height', "Highest block stored in the DB")
+LAG_BLOCKS = Gauge('tip_lag_blocks', "Node tip height - highest stored height")
+LAG_SECONDS = Gauge('tip_lag_seconds', "Seconds between the tip block timestamp and its insertion")
+ROLLBACKS = Counter('fork_rollbacks_total', "Forks whose orphaned blocks have been rolled back")
+POLL_ERRORS = Counter('tip_poll_errors_total', "Tip polls failed on a node or DB error, by error")
+
+collectors = []   # Functions refreshing metrics computed on demand, run before every exposition
+
+
+def collect():
+    for func in collectors:
+        func()
+
+
+def prometheus_text():
+    collect()
+    lines = []
+    for metric in REGISTRY.values():
+        lines.extend(metric.prometheus())
+    return '\n'.join(lines) + '\n'
+
+
+# Every metric plus blocks/s and txs/s since the previous snapshot
+_last_rates = [time.time(), 0, 0]
+
+def snapshot():
+    collect()
+    now = time.time()
+    blocks, txs = sum(BLOCKS.values.values()), sum(TXS.values.values())
+    elapsed = max(now - _last_rates[0], 1e-9)
+    rates = {'blocks_per_s': round((blocks - _last_rates[1]) / elapsed, 2), 'txs_per_s': round((txs - _last_rates[2]) / elapsed, 2)}
+    _last_rates[:] = [now, blocks, txs]
+    return {'timestamp': now, 'pid': os.getpid(), 'rates': rates,
+            'metrics': {name: metric.snapshot() for name, metric in REGISTRY.items()}}
+
+
+def dump(path=None):
+    path = path or METRICS_FILE
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(snapshot(), f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+# ------------------------------- Exposition ---------------------------------
+
+_server = None
+_dumper = None
+_dump_at_exit = False
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if (self.path == '/metrics'):
+            body, content_type = prometheus_text().encode(), 'text/plain; version=0.0.4'
+        elif (self.path == '/metrics.json'):
+            body, content_type = json.dumps(snapshot()).encode(), 'application/json'
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _dump_loop(stop):
+    while (not stop.wait(METRICS_INTERVAL)):
+        dump()
+
+
+# Starts what is configured (nothing by default), threads are daemons
+def start_metrics(port=None):
+    global _server, _dumper, _dump_at_exit
+    port = METRICS_PORT if port is None else port
+
+    if (port and _server is None):
+        _server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        threading.Thread(target=_server.serve_forever, name='metrics_http', daemon=True).start()
+
+    if (METRICS_FILE and _dumper is None):
+        _dumper = threading.Event()
+        threading.Thread(target=_dump_loop, args=(_dumper,), name='metrics_dump', daemon=True).start()
+        if (not _dump_at_exit):
+            atexit.register(dump)
+            _dump_at_exit = True
+
+
+# Before a fork: the daemon child starts its own exposition, the port has to be free
+def stop_metrics():
+    global _server, _dumper
+    if (_server is not None):
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+    if (_dumper is not None):
+        _dumper.set()
+        _dumper = None
@@ -0,0 +1,154 @@
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, text
+
+
+# Versioned, in-place schema changes of block/transaction (no need to drop everything with -n).
+# Fresh databases are created from the models (transactions.py) and only stamped with the last version,
+# older ones get every pending migration applied in order, each one in its own DB transaction.
+
+schema_version = Table('schema_version', MetaData(),
+                       Column('version', Integer, primary_key=True),
+                       Column('description', String),
+                       Column('applied_at', DateTime))
+
+MIGRATIONS = []  # (version, description, function(conn))
+
+
+def migration(version, description):
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return register
+
+
+# The first model stored no discriminator: existing rows get it from their raw transaction
+# (the later migrations rebuild derived tables and the ledger by tx_type)
+@migration(1, "transaction.tx_type polymorphic discriminator")
+def add_tx_type(conn):
+    from parsers import raw_tx_identity
+
+    conn.execute(text('ALTER TABLE "transaction" ADD COLUMN IF NOT EXISTS tx_type VARCHAR'))
+    rows = conn.execution_options(stream_results=True).execute(
+        text('SELECT tx_id_base58, tx_raw_hex FROM "transaction" WHERE tx_type IS NULL AND tx_raw_hex IS NOT NULL'))
+    for batch in rows.partitions(50000):
+        typed = [(tx_id, raw_tx_identity(raw)) for tx_id, raw in batch]
+        typed = [(tx_id, tx_type) for tx_id, tx_type in typed if tx_type is not None]
+        if (typed):
+            ids, tx_types = zip(*typed)
+            conn.execute(text('UPDATE "transaction" t SET tx_type = b.tx_type '
+                              'FROM unnest(CAST(:ids AS varchar[]), CAST(:tx_types AS varchar[])) b(tx_id_base58, tx_type) '
+                              'WHERE t.tx_id_base58 = b.tx_id_base58'), {'ids': list(ids), 'tx_types': list(tx_types)})
+
+
+# DeSo amounts were stored as float DeSo (nanos / 10**9) -> exact integer nanos
+NANOS_COLUMNS = ['mine_fee', 'node_fee', 'amount', 'btc_spent', 'deso_gen']
+
+@migration(2, "nano amounts as BIGINT instead of FLOAT")
+def nanos_to_bigint(conn):
+    for column in NANOS_COLUMNS:
+        conn.execute(text('ALTER TABLE "transaction" ALTER COLUMN {0} TYPE BIGINT USING round({0} * 1e9)::bigint'.format(column)))
+
+
+# Same names SQLAlchemy gives to index=True columns, so fresh and migrated DBs match
+INDEXES = [('block', 'block_height'),
+           ('transaction', 'block_hash'),
+           ('transaction', 'tx_transactor_base58'),
+           ('transaction', 'post_hash'),
+           ('transaction', 'nft_hash'),
+           ('transaction', 'tx_type')]
+
+@migration(3, "indexes on block heights, tx block hashes and analytic access paths")
+def add_indexes(conn):
+    for table, column in INDEXES:
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_{0}_{1} ON "{0}" ({1})'.format(table, column)))
+
+
+@migration(4, "transaction.block_height (denormalized, range scans and partitioning)")
+def add_tx_block_height(conn):
+    conn.execute(text('ALTER TABLE "transaction" ADD COLUMN IF NOT EXISTS block_height INTEGER'))
+    conn.execute(text('UPDATE "transaction" t SET block_height = b.block_height FROM block b '
+                      'WHERE b.block_hash = t.block_hash AND t.block_height IS NULL'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_transaction_block_height ON "transaction" (block_height)'))
+
+
+@migration(5, "transaction.tx_index (order of the transactions of a block)")
+def add_tx_index(conn):
+    conn.execute(text('ALTER TABLE "transaction" ADD COLUMN IF NOT EXISTS tx_index INTEGER'))
+
+
+# Tables are created with the others (databaseDTO.create_tables), existing transactions fill them here
+@migration(6, "derived tables (follow graph, NFT owners and sales, creator coin flows)")
+def fill_derived(conn):
+    from derived import rebuild
+    rebuild(conn)
+
+
+# DAO txs stored before keep NULLs there, `python order_book.py refetch` has them parsed again
+DAO_COLUMNS = [('dao_coins', 'NUMERIC(78, 0)'), ('dao_operation', 'VARCHAR'), ('dao_transfer_restriction', 'VARCHAR'),
+               ('buying_coin_base58', 'VARCHAR'), ('selling_coin_base58', 'VARCHAR'), ('dao_exchange_rate', 'NUMERIC(78, 0)'),
+               ('dao_fills_json', 'VARCHAR')]
+
+@migration(7, "DAO coin and limit order columns")
+def add_dao_columns(conn):
+    for column, sql_type in DAO_COLUMNS:
+        conn.execute(text('ALTER TABLE "transaction" ADD COLUMN IF NOT EXISTS {} {}'.format(column, sql_type)))
+
+
+@migration(8, "balance ledger (deltas, current balances, snapshots)")
+def fill_ledger(conn):
+    from ledger import rebuild
+    rebuild(conn)
+
+
+# Blocks stored before keep NULL (-> 0): those with unknown TxnTypes look partial, the repair of
+# integrity_check fetches them again and sets it (databaseDTO.dirty_insert_rows)
+@migration(9, "block.tx_skipped (transactions of unknown TxnType not stored)")
+def add_tx_skipped(conn):
+    conn.execute(text('ALTER TABLE block ADD COLUMN IF NOT EXISTS tx_skipped INTEGER'))
+
+
+# Rows stored before keep NULL: their sells credit no DeSo in the ledger until they are fetched again
+@migration(10, "transaction.deso_locked_diff (DeSo unlocked by creator coin sells)")
+def add_deso_locked_diff(conn):
+    conn.execute(text('ALTER TABLE "transaction" ADD COLUMN IF NOT EXISTS deso_locked_diff BIGINT'))
+
+
+def last_version():
+    return max(version for version, _, _ in MIGRATIONS)
+
+
+def applied_versions(engine):
+    if (not inspect(engine).has_table('schema_version')):
+        return []
+    with engine.connect() as conn:
+        return conn.execute(schema_version.select().order_by(schema_version.c.version)).fetchall()
+
+
+def _stamp(conn, version, description):
+    conn.execute(schema_version.insert().values(version=version, description=description, applied_at=datetime.utcnow()))
+
+
+# fresh -> tables have just been created from the models, nothing to migrate
+def migrate(engine, fresh=False):
+    schema_version.create(engine, checkfirst=True)
+    done = {row.version for row in applied_versions(engine)}
+
+    for version, description, func in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if (version in done):
+            continue
+        with engine.begin() as conn:
+            if (not fresh):
+                print(" - Migrating schema to v{}: {} -".format(version, description))
+                func(conn)
+            _stamp(conn, version, description)
+
+
+if __name__ == '__main__':
+    # Connecting already brings the schema to the last version
+    from databaseDTO import bootstrap_db
+    import databaseDTO
+
+    bootstrap_db()
+    for row in applied_versions(databaseDTO.engine):
+        print(" v{} {} ({})".format(row.version, row.description, row.applied_at))
@@ -0,0 +1,127 @@
+import asyncio
+import random
+
+import httpx
+
+from metrics import DECODE, NODE_ERRORS, NODE_REQUEST, NODE_RETRIES
+from parsers import loads
+
+try:
+    import h2  # HTTP/2 support is optional (httpx[http2])
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+
+#CONFIGURATION
+NODE_URL = "https://bitclout.com"
+NODE_URLS = [NODE_URL]    # More nodes -> requests are balanced among them (NodePool)
+LAST_BLOCK_PATH = "/api/v1"
+BLOCK_INFO_PATH = "/api/v1/block"
+
+MAX_CONNECTIONS = 32      # Keep-alive pool shared by every coroutine using the client
+REQUEST_TIMEOUT = 30      # Seconds, per single attempt
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 0.5        # Seconds, doubled at every failed attempt...
+BACKOFF_CAP = 30          # ...up to this value (then jittered)
+
+#####################################################################################################################
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class NodeError(Exception):
+    pass
+
+
+# The node answered with a client error (4xx): the request itself is wrong (i.e. unknown block hash), not the node
+class NodeRequestError(NodeError):
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+# Async client of a DeSo node API, one instance per event loop.
+# Connections are pooled and kept alive (HTTP/2 if available), failed requests are retried
+# with a capped and jittered exponential backoff until MAX_ATTEMPTS is reached.
+class NodeClient:
+    size = 1  # Nodes behind the client
+
+    def __init__(self, base_url=NODE_URL, max_connections=MAX_CONNECTIONS, timeout=REQUEST_TIMEOUT, max_attempts=MAX_ATTEMPTS):
+        self.base_url = base_url
+        self.max_attempts = max_attempts
+        self._http = httpx.AsyncClient(base_url=base_url, http2=HTTP2, timeout=timeout,
+                                       limits=httpx.Limits(max_connections=max_connections,
+                                                           max_keepalive_connections=max_connections))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self._http.aclose()
+
+    async def get_last_block(self):
+        return await self._request("lastblock", "GET", LAST_BLOCK_PATH)
+
+    async def get_header(self, b_hash):
+        return await self._request("header", "POST", BLOCK_INFO_PATH, {"HashHex": b_hash})
+
+    async def get_full_block(self, b_hash):
+        return await self._request("fullblock", "POST", BLOCK_INFO_PATH, {"HashHex": b_hash, "FullBlock": True})
+
+    # Undecoded response body, decoding is left to the parse stage
+    async def get_full_block_raw(self, b_hash):
+        return await self._request("fullblock", "POST", BLOCK_INFO_PATH, {"HashHex": b_hash, "FullBlock": True}, raw=True)
+
+    # Block of the node's main chain at that height
+    async def get_full_block_raw_by_height(self, height):
+        return await self._request("fullblock", "POST", BLOCK_INFO_PATH, {"Height": height, "FullBlock": True}, raw=True)
+
+    # endpoint -> label of the request in metrics
+    async def _request(self, endpoint, method, path, payload=None, raw=False):
+        last_err = None
+
+        for attempt in range(self.max_attempts):
+            retry_after = None
+            try:
+                with NODE_REQUEST.time(endpoint=endpoint, node=self.base_url):
+                    r = await self._http.request(method, path, json=payload)
+                if r.status_code in RETRY_STATUS:
+                    retry_after = _retry_after(r)
+                    reason = r.status_code
+                    last_err = NodeError("{} {} -> HTTP {}".format(method, path, r.status_code))
+                elif r.status_code >= 400:
+                    # Client errors (i.e. unknown block hash) won't be fixed by retrying
+                    NODE_ERRORS.inc(endpoint=endpoint)
+                    raise NodeRequestError("{} {} -> HTTP {}: {}".format(method, path, r.status_code, r.text[:200]), r.status_code)
+                elif raw:
+                    return r.content
+                else:
+                    with DECODE.time():
+                        return loads(r.content)
+            except (httpx.TransportError, ValueError) as err:  # ValueError -> truncated/invalid JSON
+                reason = type(err).__name__
+                last_err = err
+
+            if attempt + 1 < self.max_attempts:
+                NODE_RETRIES.inc(endpoint=endpoint, reason=reason)
+                await asyncio.sleep(retry_after if retry_after is not None else backoff(attempt))
+
+        NODE_ERRORS.inc(endpoint=endpoint)
+        raise NodeError("{} {} failed after {} attempts".format(method, path, self.max_attempts)) from last_err
+
+
+# Full jitter: uniform in [0, min(cap, base*2^attempt)]
+def backoff(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def _retry_after(response):
+    try:
+        return min(float(response.headers["Retry-After"]), BACKOFF_CAP)
+    except (KeyError, ValueError):
+        return None
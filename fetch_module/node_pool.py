@@ -0,0 +1,145 @@
+import asyncio
+import time
+from collections import Counter
+
+from metrics import NODE_RETRIES, NODE_SCORE, TIP_DISAGREEMENTS
+from node_client import MAX_ATTEMPTS, MAX_CONNECTIONS, NODE_URLS, REQUEST_TIMEOUT, NodeClient, NodeError, NodeRequestError, backoff
+
+
+#CONFIGURATION
+EWMA_ALPHA = 0.2          # Weight of the last request in the latency/error averages of a node
+ERROR_PENALTY = 10        # Cost multiplier of a node always failing (scaled by its error rate)
+COOLDOWN_ERRORS = 1       # Consecutive failures after which a node rests for a (growing, jittered) backoff
+
+#####################################################################################################################
+
+
+# Health of one node: smoothed latency and error rate, requests in flight, cool down after failures
+class NodeState:
+
+    def __init__(self, client):
+        self.client = client
+        self.latency = 0.5     # Seconds, optimistic start so every node gets tried
+        self.errors = 0.0      # Smoothed failure ratio (0 - 1)
+        self.failures = 0      # Consecutive
+        self.inflight = 0
+        self.cooldown_until = 0.0
+
+    @property
+    def url(self):
+        return self.client.base_url
+
+    # Expected cost of sending it one more request: slow, busy and failing nodes cost more
+    def cost(self):
+        return self.latency * (1 + self.inflight) * (1 + ERROR_PENALTY * self.errors)
+
+    def succeeded(self, seconds):
+        self.latency += EWMA_ALPHA * (seconds - self.latency)
+        self.errors -= EWMA_ALPHA * self.errors
+        self.failures = 0
+        NODE_SCORE.set(round(self.cost(), 4), node=self.url)
+
+    def failed(self):
+        self.errors += EWMA_ALPHA * (1 - self.errors)
+        self.failures += 1
+        if (self.failures >= COOLDOWN_ERRORS):
+            self.cooldown_until = time.monotonic() + backoff(self.failures - COOLDOWN_ERRORS)
+        NODE_SCORE.set(round(self.cost(), 4), node=self.url)
+
+
+# NodeClient over several nodes (same coroutines): every request goes to the cheapest node at that moment,
+# a failed one is retried on another node. Tips are asked to every node and cross-checked.
+class NodePool:
+
+    def __init__(self, urls=NODE_URLS, max_connections=MAX_CONNECTIONS, timeout=REQUEST_TIMEOUT, max_attempts=MAX_ATTEMPTS):
+        # Retries are made by the pool (possibly on another node), a single attempt per client
+        self.nodes = [NodeState(NodeClient(url, max_connections, timeout, max_attempts=1)) for url in urls]
+        self.max_attempts = max_attempts
+
+    @property
+    def size(self):
+        return len(self.nodes)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        for node in self.nodes:
+            await node.client.close()
+
+    # Cheapest node not cooling down (and not already tried for this request, if possible)
+    async def pick(self, tried):
+        while True:
+            now = time.monotonic()
+            ready = [node for node in self.nodes if node.cooldown_until <= now]
+            if (ready):
+                fresh = [node for node in ready if node not in tried]
+                return min(fresh or ready, key=NodeState.cost)
+            await asyncio.sleep(min(node.cooldown_until for node in self.nodes) - now)
+
+    async def _call(self, name, *args):
+        tried, last_err = set(), None
+
+        for attempt in range(self.max_attempts):
+            node = await self.pick(tried)
+            tried.add(node)
+            node.inflight += 1
+            start = time.perf_counter()
+            try:
+                result = await getattr(node.client, name)(*args)
+            except NodeRequestError:
+                raise              # Any node would answer the same, and this one is fine
+            except NodeError as err:
+                node.failed()
+                last_err = err
+                NODE_RETRIES.inc(endpoint=name, reason='failover')
+                continue
+            finally:
+                node.inflight -= 1
+            node.succeeded(time.perf_counter() - start)
+            return result
+
+        raise NodeError("{}{} failed after {} attempts".format(name, args, self.max_attempts)) from last_err
+
+    async def get_header(self, b_hash):
+        return await self._call('get_header', b_hash)
+
+    async def get_full_block(self, b_hash):
+        return await self._call('get_full_block', b_hash)
+
+    async def get_full_block_raw(self, b_hash):
+        return await self._call('get_full_block_raw', b_hash)
+
+    async def get_full_block_raw_by_height(self, height):
+        return await self._call('get_full_block_raw_by_height', height)
+
+    # Tip of every node: the one most nodes agree on wins (ties -> the highest), disagreements are reported
+    async def get_last_block(self):
+        async def tip(node):
+            start = time.perf_counter()
+            try:
+                response = await node.client.get_last_block()
+            except NodeError:
+                node.failed()
+                return None
+            node.succeeded(time.perf_counter() - start)
+            return response
+
+        responses = [r for r in await asyncio.gather(*(tip(node) for node in self.nodes)) if r is not None]
+        if (not responses):
+            return await self._call('get_last_block')
+
+        votes = Counter(r['Header']['BlockHashHex'] for r in responses)
+        best = max(responses, key=lambda r: (votes[r['Header']['BlockHashHex']], r['Header']['Height']))
+
+        heights = {}
+        for r in responses:
+            heights.setdefault(r['Header']['Height'], set()).add(r['Header']['BlockHashHex'])
+        if (any(len(hashes) > 1 for hashes in heights.values())):
+            TIP_DISAGREEMENTS.inc()
+            print(" - Nodes disagree on the tip: {} -".format({h: sorted(hashes) for h, hashes in heights.items()}))
+
+        return best
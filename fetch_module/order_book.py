@@ -0,0 +1,317 @@
+import json
+
+from sqlalchemy import Boolean, Column, Integer, MetaData, Numeric, String, Table, and_, delete, func, or_, select, text, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+
+from accounts import tx_source
+from bulk_writer import TX_COLUMNS
+from transactions import Block
+
+
+#CONFIGURATION
+ORDER_BOOK = True          # Keep the DAO coin order book up to date while blocks are written (turned on later -> `python order_book.py advance`)
+ADVANCE_HEIGHTS = 10000    # Heights replayed at most by one advance (catch_up/CLI, a DB transaction each)
+WRITER_ADVANCE_HEIGHTS = 200   # ...and by the writer on every flush, inside its DB transaction
+
+#####################################################################################################################
+
+# DAO coin order book rebuilt from the limit order transactions, replayed in chain order
+# ((block_height, tx_index), from the lowest stored height up to the highest one with no gap below it):
+#   dao_order         resting orders: id (the tx placing it), owner, pair, scaled exchange rate, quantity left to buy
+#   dao_coin_fill     every fill reported by limit order txs, with the resting order it was matched to
+#   dao_book_level    aggregated depth: (buying, selling, exchange rate) -> quantity, orders
+#   dao_book_state    height replayed up to (the writer and the CLI advance from there)
+#   dao_book_stale    heights limit orders were written at, taken by the next advance (stale if <= replayed height)
+# The node reports fills by owner and pair, not by order id: a fill is matched to the owner's best priced (then oldest)
+# resting order of that pair. Orders are taken as good-til-cancelled, rate 0 ones (market) never rest.
+# Cancels don't say which order they cancel in the node metadata: they are ignored, the order stays until filled.
+# Limit orders written below the replayed height (forks, blocks fetched from the tip down, backfill) mark the book stale,
+# the next catch_up (end of main.py's fetch and of a backfill, after a fork rollback) replays it again from the lowest
+# stored height. The writer itself only advances a book that is not stale, a few heights per flush. Writers record the
+# heights they wrote orders at with plain inserts, never waiting on the state row a long replay holds: the advance
+# holding it takes them (those committed after it read its events are taken by the next one).
+#   python order_book.py advance|status
+#   python order_book.py refetch   (DAO txs stored before their metadata was parsed are fetched again by main.py)
+
+metadata = MetaData()
+
+dao_order = Table('dao_order', metadata,
+                  Column('order_id', String, primary_key=True),             # tx_id_base58 of the limit order
+                  Column('transactor_base58', String, index=True),
+                  Column('buying_coin_base58', String),
+                  Column('selling_coin_base58', String),
+                  Column('exchange_rate', Numeric(78, 0)),                  # Coins to sell per coin to buy, scaled by 10**38
+                  Column('quantity_remaining', Numeric(78, 0)),             # Base units of the buying coin
+                  Column('block_height', Integer),
+                  Column('tx_index', Integer))
+
+dao_coin_fill = Table('dao_coin_fill', metadata,
+                      Column('tx_id_base58', String, primary_key=True),
+                      Column('fill_index', Integer, primary_key=True),
+                      Column('block_height', Integer, index=True),
+                      Column('transactor_base58', String, index=True),
+                      Column('buying_coin_base58', String),
+                      Column('selling_coin_base58', String),
+                      Column('bought', Numeric(78, 0)),
+                      Column('sold', Numeric(78, 0)),
+                      Column('is_fulfilled', Boolean),
+                      Column('order_id', String))       # Resting order it was matched to (None: the tx's own order/unknown)
+
+dao_book_level = Table('dao_book_level', metadata,
+                       Column('buying_coin_base58', String, primary_key=True),
+                       Column('selling_coin_base58', String, primary_key=True),
+                       Column('exchange_rate', Numeric(78, 0), primary_key=True),
+                       Column('quantity', Numeric(78, 0)),
+                       Column('n_orders', Integer))
+
+dao_book_state = Table('dao_book_state', metadata,
+                       Column('id', Integer, primary_key=True),
+                       Column('processed_height', Integer))       # None -> stale, replayed from scratch by the next advance
+
+dao_book_stale = Table('dao_book_stale', metadata,
+                       Column('block_height', Integer))           # No key: concurrent inserts never wait on each other
+
+TX_TYPE = TX_COLUMNS.index('tx_type')
+TX_HEIGHT = TX_COLUMNS.index('block_height')
+
+PAIR = (dao_order.c.buying_coin_base58, dao_order.c.selling_coin_base58)
+
+
+def create_order_book(engine):
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_dao_order_book ON dao_order (buying_coin_base58, selling_coin_base58, exchange_rate)'))
+        conn.execute(insert(dao_book_state).values(id=1, processed_height=None).on_conflict_do_nothing())
+
+
+# Locks the state row -> replayed height (None: nothing yet), False if another writer holds it and wait is False
+def _lock_state(conn, wait):
+    query = select(dao_book_state.c.processed_height).where(dao_book_state.c.id == 1)
+    row = conn.execute(query.with_for_update() if wait else query.with_for_update(skip_locked=True)).first()
+    return False if row is None else row[0]
+
+
+def _reset(conn):
+    for table in (dao_order, dao_coin_fill, dao_book_level):
+        conn.execute(delete(table))
+    conn.execute(update(dao_book_state).where(dao_book_state.c.id == 1).values(processed_height=None))
+
+
+# Highest height up to `limit` reachable from `start` without a missing block
+def _contiguous_top(conn, start, limit):
+    if (conn.execute(select(Block.block_height).where(Block.block_height == start + 1).limit(1)).first() is None):
+        return start
+    gap = conn.execute(text('SELECT min(b.block_height) FROM block b WHERE b.block_height > :start AND b.block_height < :limit '
+                            'AND NOT EXISTS (SELECT 1 FROM block n WHERE n.block_height = b.block_height + 1)'),
+                       {'start': start, 'limit': limit}).scalar()
+    return limit if gap is None else gap
+
+
+def _events(conn, first, last):
+    transactions = tx_source(conn)
+    c = transactions.c
+    return conn.execute(select(c.tx_id_base58, c.block_height, c.tx_index, c.tx_transactor_base58, c.buying_coin_base58,
+                               c.selling_coin_base58, c.dao_exchange_rate, c.dao_coins, c.dao_fills_json)
+                        .where(c.tx_type == 'DaoCoinLimitOrder', c.block_height.between(first, last))
+                        .order_by(c.block_height, c.tx_index)).fetchall()
+
+
+def _fills(event):
+    return json.loads(event.dao_fills_json) if event.dao_fills_json else []
+
+
+# Replays the limit orders of (start, last] on the resting orders of the pairs they touch
+class Replay:
+
+    def __init__(self, conn, events):
+        self.conn = conn
+        self.pairs = set()
+        for event in events:
+            self.pairs.add((event.buying_coin_base58, event.selling_coin_base58))
+            self.pairs.update((fill['buying'], fill['selling']) for fill in _fills(event))
+        self.pairs.discard((None, None))
+
+        self.orders = {}       # order_id -> row dict
+        if (self.pairs):
+            for row in conn.execute(select(dao_order).where(tuple_(*PAIR).in_(list(self.pairs)))):
+                self.orders[row.order_id] = dict(row._mapping, exchange_rate=int(row.exchange_rate),
+                                                 quantity_remaining=int(row.quantity_remaining))
+        self.loaded = {order_id: order['quantity_remaining'] for order_id, order in self.orders.items()}
+        self.fills = []
+
+    # Owner's order the node filled: best rate for the taker (highest coins to sell per coin to buy), then oldest
+    def maker_order(self, transactor, buying, selling):
+        candidates = [o for o in self.orders.values() if o['transactor_base58'] == transactor
+                      and o['buying_coin_base58'] == buying and o['selling_coin_base58'] == selling]
+        if (not candidates):
+            return None
+        return min(candidates, key=lambda o: (-o['exchange_rate'], o['block_height'], o['tx_index'] if o['tx_index'] is not None else -1))
+
+    def apply(self, event):
+        quantity = int(event.dao_coins or 0)
+        own = None
+        for i, fill in enumerate(_fills(event)):
+            bought, sold = int(fill['bought']), int(fill['sold'])
+            order_id = None
+            if (own is None and fill['transactor'] == event.tx_transactor_base58
+                    and (fill['buying'], fill['selling']) == (event.buying_coin_base58, event.selling_coin_base58)):
+                own = fill
+            else:
+                order = self.maker_order(fill['transactor'], fill['buying'], fill['selling'])
+                if (order is not None):
+                    order_id = order['order_id']
+                    order['quantity_remaining'] -= bought
+                    if (fill['fulfilled'] or order['quantity_remaining'] <= 0):
+                        del self.orders[order_id]
+            self.fills.append({'tx_id_base58': event.tx_id_base58, 'fill_index': i, 'block_height': event.block_height,
+                               'transactor_base58': fill['transactor'], 'buying_coin_base58': fill['buying'],
+                               'selling_coin_base58': fill['selling'], 'bought': bought, 'sold': sold,
+                               'is_fulfilled': fill['fulfilled'], 'order_id': order_id})
+
+        remaining = quantity - (int(own['bought']) if own is not None else 0)
+        if (event.dao_exchange_rate and remaining > 0 and not (own is not None and own['fulfilled'])):
+            self.orders[event.tx_id_base58] = {'order_id': event.tx_id_base58, 'transactor_base58': event.tx_transactor_base58,
+                                               'buying_coin_base58': event.buying_coin_base58,
+                                               'selling_coin_base58': event.selling_coin_base58,
+                                               'exchange_rate': int(event.dao_exchange_rate), 'quantity_remaining': remaining,
+                                               'block_height': event.block_height, 'tx_index': event.tx_index}
+
+    def write(self):
+        gone = [order_id for order_id in self.loaded if order_id not in self.orders]
+        if (gone):
+            self.conn.execute(delete(dao_order).where(dao_order.c.order_id.in_(gone)))
+        changed = [order for order_id, order in self.orders.items() if self.loaded.get(order_id) != order['quantity_remaining']]
+        if (changed):
+            stmt = insert(dao_order)
+            self.conn.execute(stmt.on_conflict_do_update(
+                index_elements=['order_id'], set_={'quantity_remaining': stmt.excluded.quantity_remaining}), changed)
+        if (self.fills):
+            self.conn.execute(insert(dao_coin_fill).on_conflict_do_nothing(), self.fills)
+
+        # Depth of the touched pairs from their resting orders
+        if (self.pairs):
+            pairs = list(self.pairs)
+            level = dao_book_level.c
+            self.conn.execute(delete(dao_book_level).where(tuple_(level.buying_coin_base58, level.selling_coin_base58).in_(pairs)))
+            self.conn.execute(insert(dao_book_level).from_select(
+                ['buying_coin_base58', 'selling_coin_base58', 'exchange_rate', 'quantity', 'n_orders'],
+                select(*PAIR, dao_order.c.exchange_rate, func.sum(dao_order.c.quantity_remaining), func.count())
+                .where(tuple_(*PAIR).in_(pairs)).group_by(*PAIR, dao_order.c.exchange_rate)))
+
+
+# Replays the next stored heights, at most `heights` of them -> heights replayed (0: up to date or locked elsewhere).
+# A stale book is emptied first and replayed from the lowest stored height
+def advance(conn, heights=ADVANCE_HEIGHTS, wait=False):
+    processed = _lock_state(conn, wait)
+    if (processed is False):
+        return 0
+    marks = [height for height, in conn.execute(delete(dao_book_stale).returning(dao_book_stale.c.block_height))]
+    if (marks and processed is not None and min(marks) <= processed):
+        processed = None
+    start = processed
+    if (start is None):
+        _reset(conn)
+        lowest = conn.execute(select(func.min(Block.block_height))).scalar()
+        if (lowest is None):
+            return 0
+        start = lowest - 1
+    last = _contiguous_top(conn, start, start + heights)
+    if (last <= start):
+        return 0
+
+    events = _events(conn, start + 1, last)
+    if (events):
+        replay = Replay(conn, events)
+        for event in events:
+            replay.apply(event)
+        replay.write()
+    conn.execute(update(dao_book_state).where(dao_book_state.c.id == 1).values(processed_height=last))
+    return last - start
+
+
+def _processed(conn):
+    return conn.execute(select(dao_book_state.c.processed_height).where(dao_book_state.c.id == 1)).scalar()
+
+
+# The book no longer reflects the chain above `height` -> stale for the next advance if it replayed past it
+# (a plain insert, the replay is catch_up's)
+def reset_above(conn, height):
+    conn.execute(insert(dao_book_stale).values(block_height=height + 1))
+
+
+# Writer hook: limit orders written at or below the replayed height mark the book stale, a book that is not
+# stale advances over the new heights (a few per flush, catch_up does the rest)
+def apply_order_book(conn, txs):
+    orders = [tx[TX_HEIGHT] for tx in txs if tx[TX_TYPE] == 'DaoCoinLimitOrder']
+    if (orders):
+        reset_above(conn, min(orders) - 1)
+    processed = _processed(conn)
+    if (processed is not None and not (orders and min(orders) <= processed)):
+        advance(conn, WRITER_ADVANCE_HEIGHTS)
+
+
+# Replays every stored height not replayed yet (a stale book from scratch), a DB transaction per ADVANCE_HEIGHTS
+def catch_up(engine, verbose=False):
+    total = 0
+    while True:
+        with engine.begin() as conn:
+            done = advance(conn, wait=True)
+        if (not done):
+            return total
+        total += done
+        if (verbose):
+            print(" {} heights replayed".format(done))
+
+
+def _stale(c):
+    return or_(and_(c.tx_type == 'DaoCoin', c.dao_operation.is_(None)),
+               and_(c.tx_type == 'DaoCoinTransfer', c.dao_coins.is_(None)),
+               and_(c.tx_type == 'DaoCoinLimitOrder', c.buying_coin_base58.is_(None), c.selling_coin_base58.is_(None)))
+
+
+# DAO txs stored before their metadata was parsed (migration 7) -> deleted, resume/integrity fetch them again.
+# What they brought to the derived tables and the ledger is taken back (the writer applies them again when refetched)
+def refetch(conn):
+    from transactions import Transaction
+    from derived import recompute, touched_keys
+    from ledger import SOURCE_COLUMNS, revert_ledger
+    from raw_store import is_offloaded, transaction_raw
+
+    transactions = tx_source(conn)
+    derived_keys = touched_keys(conn, transactions, _stale(transactions.c))
+    stale_txs = [dict(row._mapping) for row in conn.execute(select(*(transactions.c[c] for c in SOURCE_COLUMNS))
+                                                                 .where(_stale(transactions.c)))]
+
+    c = Transaction.__table__.c
+    if (is_offloaded(conn)):
+        conn.execute(delete(transaction_raw).where(transaction_raw.c.tx_id_base58.in_(select(c.tx_id_base58).where(_stale(c)))))
+    n = conn.execute(delete(Transaction.__table__).where(_stale(c))).rowcount
+    recompute(conn, derived_keys)
+    revert_ledger(conn, stale_txs)
+    reset_above(conn, -1)
+    return n
+
+
+if __name__ == '__main__':
+    import sys
+    import databaseDTO
+
+    sys.argv, args = sys.argv[:1], sys.argv[1:]
+    if (args not in (['advance'], ['status'], ['refetch'])):
+        print("usage: order_book.py advance|status|refetch")
+        exit(-1)
+
+    databaseDTO.bootstrap_db()
+    create_order_book(databaseDTO.engine)
+    match args[0]:
+        case 'advance':
+            catch_up(databaseDTO.engine, verbose=True)
+        case 'refetch':
+            with databaseDTO.engine.begin() as conn:
+                print(" - {} DAO transactions deleted, run main.py to fetch them again -".format(refetch(conn)))
+            exit(0)
+
+    with databaseDTO.engine.connect() as conn:
+        print(" replayed up to height {}".format(conn.execute(select(dao_book_state.c.processed_height)).scalar()))
+        for table in (dao_order, dao_coin_fill, dao_book_level, dao_book_stale):
+            print(" {}: {} rows".format(table.name, conn.execute(select(func.count()).select_from(table)).scalar()))
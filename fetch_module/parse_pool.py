@@ -0,0 +1,76 @@
+import asyncio
+import multiprocessing
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import parsers
+from bulk_writer import block_rows
+from metrics import DECODE, PARSE, UNKNOWN_TX_TYPES, collectors
+from parsers import loads
+
+
+#CONFIGURATION
+PARSE_PROCESSES = os.cpu_count() or 1   # 0 -> parse on a thread of the main process
+
+#####################################################################################################################
+
+
+def decode(raw, compressed=False):
+    return loads(zlib.decompress(raw) if compressed else raw)
+
+
+# raw response bytes (zlib compressed ones from the block cache) -> rows, plus (decode, parse) seconds
+def timed_parse(raw, compressed=False):
+    start = time.perf_counter()
+    block_data = decode(raw, compressed)
+    decoded = time.perf_counter()
+    return block_rows(block_data), (decoded - start, time.perf_counter() - decoded)
+
+
+# Runs inside a worker, the unknown TxnTypes met meanwhile go back to the parent too
+def parse_raw_block(raw, compressed=False):
+    parsed, timings = timed_parse(raw, compressed)
+    unknown = dict(parsers.unknown_tx_types)
+    parsers.unknown_tx_types.clear()
+    return parsed, timings, unknown
+
+
+def _collect_unknown():
+    for tx_type, n in parsers.unknown_tx_types.items():
+        UNKNOWN_TX_TYPES.set(n, tx_type=tx_type)
+
+collectors.append(_collect_unknown)
+
+
+# Optional stage between download and insert: JSON decoding and tx mapping of full blocks
+# are spread over a pool of processes, only compact ParsedBlock rows come back to the writer.
+class ParsePool:
+
+    def __init__(self, processes=PARSE_PROCESSES):
+        # spawn -> workers don't inherit the event loop, DB connections and threads of the parent
+        self._pool = None
+        if processes:
+            self._pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+
+    async def parse(self, raw, compressed=False):
+        if self._pool is None:
+            parsed, (decode_s, parse_s) = await asyncio.to_thread(timed_parse, raw, compressed)
+        else:
+            parsed, (decode_s, parse_s), unknown = await asyncio.get_running_loop().run_in_executor(self._pool, parse_raw_block, raw, compressed)
+            parsers.unknown_tx_types.update(unknown)
+
+        DECODE.observe(decode_s)
+        PARSE.observe(parse_s)
+        return parsed
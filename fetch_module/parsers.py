@@ -0,0 +1,356 @@
+import json
+import math
+from collections import Counter
+
+try:
+    import orjson  # Much faster decoding of big blocks, optional
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+
+# TX SEMANTIC PARSING -> one pure function per TxnType
+# Every parser turns the node's JSON of a transaction into a flat dict of `transaction` columns,
+# no ORM object is built so parsing can run anywhere (worker processes too) and feed any writer.
+
+PARSERS = {}                # TxnType -> (polymorphic identity, parser)
+unknown_tx_types = Counter()  # TxnType -> times it has been met without a parser
+
+
+def parser(tx_type, identity):
+    def register(func):
+        PARSERS[tx_type] = (identity, func)
+        return func
+    return register
+
+
+def parse_header(header, tx_number, tx_skipped=0):
+    return {'block_hash': header['BlockHashHex'], 'version': header['Version'],
+            'tx_number': tx_number, 'tx_skipped': tx_skipped, 'prev_block_hash': header['PrevBlockHashHex'],
+            'timestamp': header['TstampSecs'], 'block_height': header['Height'],
+            'tx_merkle_root': header['TransactionMerkleRootHex'], 'block_nonce': str(header['Nonce']),
+            'extra_nonce': str(header['ExtraNonce'])}
+
+
+# Returns the row of tx (tx_index-th of block_hash at block_height) or None if its TxnType is unknown
+def parse_tx(tx, block_hash, block_height, tx_index=None):
+    metadata = tx['TransactionMetadata']
+    tx_type = metadata['TxnType']
+
+    try:
+        identity, parse = PARSERS[tx_type]
+    except KeyError:
+        unknown_tx_types[tx_type] += 1
+        return None
+
+    row = {'tx_id_base58': tx['TransactionIDBase58Check'],
+           'tx_raw_hex': tx.get('RawTransactionHex'),
+           'signature_hex': tx.get('SignatureHex'),
+           'tx_transactor_base58': metadata['TransactorPublicKeyBase58Check'],
+           'block_hash': block_hash,
+           'block_height': block_height,
+           'tx_index': tx_index,
+           'mine_fee': metadata['BasicTransferTxindexMetadata']['FeeNanos'],
+           'tx_type': identity}
+
+    parse(row, tx.get('Outputs') or [], metadata)
+    return row
+
+
+# ------------------------------- Shared logic -------------------------------
+
+def affected_key(metadata, index):
+    return metadata["AffectedPublicKeys"][index]["PublicKeyBase58Check"]
+
+
+# A transaction submitted through a custom node (official nodes excluded) pays it a fee with its first output
+def node_fee(row, outputs, metadata, on_custom_node):
+    row['on_custom_node'] = on_custom_node
+    if (on_custom_node):
+        row['node_fee'] = outputs[0]['AmountNanos']
+        row['node_recipient_base58'] = affected_key(metadata, 0)
+
+
+# Most txs have [node output] + [other user] + change -> the other user follows the node (if any)
+def node_fee_and_other(row, outputs, metadata, n_outputs=3):
+    on_custom_node = len(outputs) == n_outputs
+    node_fee(row, outputs, metadata, on_custom_node)
+    row['other_us_base58'] = affected_key(metadata, 2 if on_custom_node else 1)
+
+
+# NFT txs have a variable number of outputs, count the basic transfers among the affected keys instead
+def nft_on_custom_node(metadata):
+    return sum(1 for key in metadata["AffectedPublicKeys"] if key["Metadata"] == "BasicTransferOutput") == 2
+
+
+# -------------------------------- Parsers -----------------------------------
+
+@parser("BASIC_TRANSFER", "BasicTransfer")
+def basic_transfer(row, outputs, metadata):
+    transfer = metadata["BasicTransferTxindexMetadata"]
+
+    # Differ tips from transfers
+    row['is_a_tip'] = transfer["DiamondLevel"] != 0
+    if (row['is_a_tip']):
+        row['post_hash'] = transfer["PostHashHex"]
+
+    on_custom_node = len(outputs) == 3
+    node_fee(row, outputs, metadata, on_custom_node)
+    i = 1 if on_custom_node else 0
+    row['other_us_base58'] = affected_key(metadata, i)
+    row['amount'] = outputs[i]['AmountNanos']
+
+
+@parser("UPDATE_PROFILE", "UpdateProfile")
+def update_profile(row, outputs, metadata):
+    node_fee(row, outputs, metadata, len(outputs) == 2)
+
+    profile = metadata["UpdateProfileTxindexMetadata"]
+    row['n_username'] = profile["NewUsername"]
+    row['n_founder_reward'] = profile["NewCreatorBasisPoints"] / 100
+    row['n_is_hidden'] = profile["IsHidden"]
+
+
+@parser("FOLLOW", "Follow")
+def follow(row, outputs, metadata):
+    node_fee_and_other(row, outputs, metadata)
+    row['is_unfollow'] = metadata["FollowTxindexMetadata"]["IsUnfollow"]
+
+
+@parser("CREATOR_COIN", "CreatorCoin")
+def creator_coin(row, outputs, metadata):
+    node_fee_and_other(row, outputs, metadata)
+
+    coin = metadata["CreatorCoinTxindexMetadata"]
+    row['is_buy'] = coin["OperationType"] == "buy"
+    if (row['is_buy']):  # BUY
+        row['amount'] = coin["DeSoToSellNanos"]
+    else:  # SELL
+        row['amount'] = coin["CreatorCoinToSellNanos"]
+    row['deso_locked_diff'] = coin.get("DESOLockedNanosDiff")  # Not reported by old nodes
+
+
+@parser("SUBMIT_POST", "SubmitPost")
+def submit_post(row, outputs, metadata):
+    row['is_repost'] = True
+
+    if (len(outputs) == 3):
+        node_fee_and_other(row, outputs, metadata)
+    else:
+        node_fee(row, outputs, metadata, False)
+        if (len(outputs) > 1):
+            row['other_us_base58'] = affected_key(metadata, 1)
+        else:
+            row['is_repost'] = False
+
+    post = metadata["SubmitPostTxindexMetadata"]
+    row['submitted_post_hash'] = post["PostHashBeingModifiedHex"]
+    row['post_hash'] = post["ParentPostHashHex"]
+
+
+@parser("LIKE", "Like")
+def like(row, outputs, metadata):
+    node_fee_and_other(row, outputs, metadata)
+    row['is_unlike'] = metadata["LikeTxindexMetadata"]["IsUnlike"]
+    row['post_hash'] = metadata["LikeTxindexMetadata"]["PostHashHex"]
+
+
+@parser("BLOCK_REWARD", "BlockReward")
+def block_reward(row, outputs, metadata):
+    on_custom_node = len(outputs) == 2
+    node_fee(row, outputs, metadata, on_custom_node)
+    i = 1 if on_custom_node else 0
+    row['other_us_base58'] = affected_key(metadata, i)
+    row['amount'] = outputs[i]["AmountNanos"]
+
+
+@parser("BITCOIN_EXCHANGE", "BitcoinExchange")
+def bitcoin_exchange(row, outputs, metadata):
+    node_fee(row, outputs, metadata, len(outputs) == 2)
+
+    exchange = metadata["BitcoinExchangeTxindexMetadata"]
+    row['btc_addr'] = exchange['BitcoinSpendAddress']
+    row['btc_spent'] = exchange['SatoshisBurned']
+    row['deso_gen'] = exchange["NanosCreated"]
+
+
+@parser("PRIVATE_MESSAGE", "PrivateMessage")
+def private_message(row, outputs, metadata):
+    node_fee_and_other(row, outputs, metadata)
+    row['msg_time'] = metadata["PrivateMessageTxindexMetadata"]["TimestampNanos"] // 10**9
+
+
+@parser("MESSAGING_GROUP", "MessagingGroup")
+def messaging_group(row, outputs, metadata):
+    node_fee(row, outputs, metadata, len(outputs) == 2)
+
+
+@parser("CREATOR_COIN_TRANSFER", "CreatorCoinTransfer")
+def creator_coin_transfer(row, outputs, metadata):
+    node_fee_and_other(row, outputs, metadata)
+
+    transfer = metadata['CreatorCoinTransferTxindexMetadata']
+    row['creator_base58'] = transfer['CreatorUsername']
+    row['amount'] = transfer['CreatorCoinToTransferNanos']
+
+
+@parser("AUTHORIZE_DERIVED_KEY", "AutorizeDerivatedKey")
+def authorize_derived_key(row, outputs, metadata):
+    node_fee(row, outputs, metadata, len(outputs) == 2)
+
+
+@parser("NFT_BID", "NftBid")
+def nft_bid(row, outputs, metadata):
+    node_fee_and_other(row, outputs, metadata)
+
+    bid = metadata['NFTBidTxindexMetadata']
+    row['amount'] = bid['BidAmountNanos']
+    row['post_hash'] = bid['NFTPostHashHex']
+    row['nft_serial'] = bid['SerialNumber']
+
+
+@parser("ACCEPT_NFT_BID", "AcceptNFTBid")
+def accept_nft_bid(row, outputs, metadata):
+    on_custom_node = nft_on_custom_node(metadata)
+    node_fee(row, outputs, metadata, on_custom_node)
+    row['other_us_base58'] = affected_key(metadata, 2 if on_custom_node else 1)
+
+    accept = metadata['AcceptNFTBidTxindexMetadata']
+    royalties = accept['NFTRoyaltiesMetadata']
+    bid_nanos = accept['BidAmountNanos']
+
+    row['amount'] = bid_nanos
+    row['post_hash'] = accept['NFTPostHashHex']
+    row['nft_serial'] = accept['SerialNumber']
+    row['creator_base58'] = royalties['CreatorPublicKeyBase58Check']
+    if (bid_nanos):
+        row['coin_bonus_perc'] = math.ceil(royalties['CreatorCoinRoyaltyNanos'] / bid_nanos * 100)
+        row['creator_bonus_perc'] = math.ceil(royalties['CreatorRoyaltyNanos'] / bid_nanos * 100)
+
+
+@parser("CREATE_NFT", "CreateNFT")
+def create_nft(row, outputs, metadata):
+    node_fee(row, outputs, metadata, nft_on_custom_node(metadata))
+    row['post_hash'] = metadata['CreateNFTTxindexMetadata']['NFTPostHashHex']
+
+
+@parser("UPDATE_NFT", "UpdateNFT")
+def update_nft(row, outputs, metadata):
+    node_fee(row, outputs, metadata, nft_on_custom_node(metadata))
+    row['on_sale'] = metadata["UpdateNFTTxindexMetadata"]["IsForSale"]
+    row['post_hash'] = metadata['UpdateNFTTxindexMetadata']['NFTPostHashHex']
+
+
+@parser("BURN_NFT", "BurnNFT")
+def burn_nft(row, outputs, metadata):
+    node_fee(row, outputs, metadata, nft_on_custom_node(metadata))
+    row['post_hash'] = metadata['BurnNFTTxindexMetadata']['NFTPostHashHex']
+    row['nft_serial'] = metadata['BurnNFTTxindexMetadata']['SerialNumber']
+
+
+@parser("NFT_TRANSFER", "NFTTransfer")
+def nft_transfer(row, outputs, metadata):
+    on_custom_node = nft_on_custom_node(metadata)
+    node_fee(row, outputs, metadata, on_custom_node)
+    row['other_us_base58'] = affected_key(metadata, 1 if on_custom_node else 0)
+    row['post_hash'] = metadata['NFTTransferTxindexMetadata']['NFTPostHashHex']
+    row['nft_serial'] = metadata['NFTTransferTxindexMetadata']['SerialNumber']
+
+
+@parser("ACCEPT_NFT_TRANSFER", "NFTAcceptTransfer")
+def accept_nft_transfer(row, outputs, metadata):
+    node_fee(row, outputs, metadata, nft_on_custom_node(metadata))
+    row['post_hash'] = metadata['AcceptNFTTransferTxindexMetadata']['NFTPostHashHex']
+    row['nft_serial'] = metadata['AcceptNFTTransferTxindexMetadata']['SerialNumber']
+
+
+# uint256 amounts of the node JSON: "0x..." hex or decimal strings, plain numbers or [4]uint64 words (little endian)
+def uint256(value):
+    if (value is None):
+        return None
+    if (isinstance(value, list)):
+        return sum(word << (64 * i) for i, word in enumerate(value))
+    if (isinstance(value, str)):
+        return int(value, 16) if value.startswith('0x') else int(value)
+    return int(value)
+
+
+@parser("DAO_COIN", "DaoCoin")
+def dao_coin(row, outputs, metadata):
+    node_fee_and_other(row, outputs, metadata)
+
+    dao = metadata['DAOCoinTxindexMetadata']
+    row['creator_base58'] = dao['CreatorUsername']
+    row['dao_operation'] = dao['OperationType']
+    row['dao_transfer_restriction'] = dao.get('TransferRestrictionStatus') or None
+    if (dao['OperationType'] == 'mint'):
+        row['dao_coins'] = uint256(dao.get('CoinsToMintNanos'))
+    elif (dao['OperationType'] == 'burn'):
+        row['dao_coins'] = uint256(dao.get('CoinsToBurnNanos'))
+
+
+@parser("DAO_COIN_TRANSFER", "DaoCoinTransfer")
+def dao_coin_transfer(row, outputs, metadata):
+    node_fee_and_other(row, outputs, metadata)
+
+    transfer = metadata['DAOCoinTransferTxindexMetadata']
+    row['creator_base58'] = transfer['CreatorUsername']
+    row['dao_coins'] = uint256(transfer.get('DAOCoinToTransferNanos'))
+
+
+@parser("DAO_COIN_LIMIT_ORDER", "DaoCoinLimitOrder")
+def dao_coin_limit_order(row, outputs, metadata):
+    node_fee(row, outputs, metadata, len(outputs) == 3)
+
+    order = metadata['DAOCoinLimitOrderTxindexMetadata']
+    row['buying_coin_base58'] = order.get('BuyingDAOCoinCreatorPublicKey')
+    row['selling_coin_base58'] = order.get('SellingDAOCoinCreatorPublicKey')
+    row['dao_exchange_rate'] = uint256(order.get('ScaledExchangeRateCoinsToSellPerCoinToBuy'))
+    row['dao_coins'] = uint256(order.get('QuantityToFillInBaseUnits'))
+
+    # Quantities as strings: uint256 doesn't fit JSON numbers
+    fills = [{'transactor': fill['TransactorPublicKeyBase58Check'],
+              'buying': fill['BuyingDAOCoinCreatorPublicKey'], 'selling': fill['SellingDAOCoinCreatorPublicKey'],
+              'bought': str(uint256(fill['CoinQuantityInBaseUnitsBought'])), 'sold': str(uint256(fill['CoinQuantityInBaseUnitsSold'])),
+              'fulfilled': fill['IsFulfilled']}
+             for fill in order.get('FilledDAOCoinLimitOrdersMetadata') or []]
+    row['dao_fills_json'] = json.dumps(fills, separators=(',', ':')) if fills else None
+
+
+# ------------------------------ Raw transactions ------------------------------
+
+# TxnType numbers of the binary encoding (core lib/network.go) -> TxnType names of the node JSON
+TXN_TYPE_NUMBERS = {1: "BLOCK_REWARD", 2: "BASIC_TRANSFER", 3: "BITCOIN_EXCHANGE", 4: "PRIVATE_MESSAGE", 5: "SUBMIT_POST",
+                    6: "UPDATE_PROFILE", 8: "UPDATE_BITCOIN_USD_EXCHANGE_RATE", 9: "FOLLOW", 10: "LIKE", 11: "CREATOR_COIN",
+                    12: "SWAP_IDENTITY", 13: "UPDATE_GLOBAL_PARAMS", 14: "CREATOR_COIN_TRANSFER", 15: "CREATE_NFT",
+                    16: "UPDATE_NFT", 17: "ACCEPT_NFT_BID", 18: "NFT_BID", 19: "NFT_TRANSFER", 20: "ACCEPT_NFT_TRANSFER",
+                    21: "BURN_NFT", 22: "AUTHORIZE_DERIVED_KEY", 23: "MESSAGING_GROUP", 24: "DAO_COIN",
+                    25: "DAO_COIN_TRANSFER", 26: "DAO_COIN_LIMIT_ORDER"}
+
+
+def _uvarint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if (byte < 0x80):
+            return value, pos
+        shift += 7
+
+
+# Polymorphic identity of a RawTransactionHex (its TxnType follows the inputs and outputs),
+# None if it can't be decoded or the TxnType has no parser
+def raw_tx_identity(raw_hex):
+    try:
+        data = bytes.fromhex(raw_hex)
+        n, pos = _uvarint(data, 0)
+        for _ in range(n):
+            _, pos = _uvarint(data, pos + 32)    # Input: TxID, output index
+        n, pos = _uvarint(data, pos)
+        for _ in range(n):
+            _, pos = _uvarint(data, pos + 33)    # Output: public key, amount
+        tx_type, _ = _uvarint(data, pos)
+    except (ValueError, IndexError):
+        return None
+    return PARSERS.get(TXN_TYPE_NUMBERS.get(tx_type), (None, None))[0]
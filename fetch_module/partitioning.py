@@ -0,0 +1,140 @@
+import re
+import sys
+
+from sqlalchemy import text
+from sqlalchemy.schema import CreateTable
+
+from bulk_writer import TX_COLUMNS
+from transactions import Transaction
+
+
+#CONFIGURATION
+PARTITION_SIZE = 0   # Block heights per `transaction` partition (i.e. 50000), 0 -> plain table
+
+#####################################################################################################################
+
+# Optional native PostgreSQL range partitioning of `transaction` by block_height.
+# Partitions are created on demand by the writer. A whole range written at once (a shard-aligned backfill range,
+# the conversion of a plain table) is loaded detached and attached afterwards: rows go into a bare table with the
+# CHECK of the range (no index maintained row by row, ATTACH skips its validation scan, indexes are built once).
+# Old ranges can be detached to be archived/vacuumed on their own.
+
+
+def partition_name(start):
+    return 'transaction_h{}'.format(start)
+
+
+def is_partitioned(conn):
+    return conn.execute(text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('transaction'))")).scalar()
+
+
+# (lower, upper) bounds of the existing partitions
+def partition_bounds(conn):
+    bounds = conn.execute(text("SELECT pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                               "WHERE i.inhparent = to_regclass('transaction')")).scalars()
+    return sorted(tuple(int(v) for v in re.findall(r'\((-?\d+)\)', b)) for b in bounds)
+
+
+# Same DDL of the model, but partitioned -> block_height has to be part of the primary key.
+# The partition size is kept as table comment, so it is known before the first partition exists.
+def create_partitioned_table(conn, size):
+    ddl = str(CreateTable(Transaction.__table__).compile(conn))
+    ddl = ddl.replace('PRIMARY KEY (tx_id_base58)', 'PRIMARY KEY (tx_id_base58, block_height)')
+    conn.execute(text(ddl.rstrip().rstrip(';') + ' PARTITION BY RANGE (block_height)'))
+    conn.execute(text("COMMENT ON TABLE \"transaction\" IS 'PARTITION_SIZE={}'".format(size)))
+
+    for index in Transaction.__table__.indexes:
+        index.create(conn)
+
+
+def _range_check(start, end):
+    return 'block_height IS NOT NULL AND block_height >= {} AND block_height < {}'.format(start, end)
+
+
+class PartitionManager:
+
+    def __init__(self, size=PARTITION_SIZE):
+        self.size = size
+        self.known = set()
+
+    # Partition size follows the one the table has been created with
+    def load(self, conn):
+        comment = conn.execute(text("SELECT obj_description(to_regclass('transaction'), 'pg_class')")).scalar() or ''
+        size = re.search(r'PARTITION_SIZE=(\d+)', comment)
+        if (size):
+            self.size = int(size.group(1))
+        self.known = {start for start, _ in partition_bounds(conn)}
+        return self
+
+    def start_of(self, height):
+        return height // self.size * self.size
+
+    # Creates the partitions holding the given heights, if missing
+    def ensure(self, conn, heights):
+        for start in {self.start_of(h) for h in heights} - self.known:
+            conn.execute(text('CREATE TABLE IF NOT EXISTS {} PARTITION OF "transaction" FOR VALUES FROM ({}) TO ({})'
+                              .format(partition_name(start), start, start + self.size)))
+            self.known.add(start)
+
+    # Bare table of the range starting at `start` (not yet a partition) -> its name, rows are loaded into it...
+    def create_detached(self, conn, start):
+        name = partition_name(start)
+        conn.execute(text('CREATE TABLE {} (LIKE "transaction" INCLUDING DEFAULTS)'.format(name)))
+        conn.execute(text('ALTER TABLE {0} ADD CONSTRAINT {0}_range CHECK ({1})'.format(name, _range_check(start, start + self.size))))
+        return name
+
+    # ...then it becomes the partition of the range
+    def attach(self, conn, start):
+        conn.execute(text('ALTER TABLE "transaction" ATTACH PARTITION {} FOR VALUES FROM ({}) TO ({})'
+                          .format(partition_name(start), start, start + self.size)))
+        self.known.add(start)
+
+    # The range leaves `transaction` but its table is kept (archive, dump, drop...)
+    def detach_partition(self, engine, start):
+        with engine.begin() as conn:
+            conn.execute(text('ALTER TABLE "transaction" DETACH PARTITION {}'.format(partition_name(start))))
+        self.known.discard(start)
+
+
+# One-off conversion of a plain `transaction` table, in a single DB transaction: every range is loaded detached
+# (INSERT ... SELECT of its rows) and attached. The writer hooks (derived tables, ledger, feed) are not run again:
+# these rows went through them when they were first written
+def convert_to_partitioned(engine, size):
+    partitions = PartitionManager(size)
+
+    with engine.begin() as conn:
+        conn.execute(text('ALTER TABLE "transaction" RENAME TO transaction_plain'))
+        conn.execute(text('ALTER TABLE transaction_plain RENAME CONSTRAINT transaction_pkey TO transaction_plain_pkey'))
+        for index in Transaction.__table__.indexes:
+            conn.execute(text('DROP INDEX IF EXISTS {}'.format(index.name)))
+
+        create_partitioned_table(conn, size)
+
+        low, high = conn.execute(text('SELECT min(block_height), max(block_height) FROM transaction_plain')).one()
+        columns = ', '.join(TX_COLUMNS)
+        for start in range(partitions.start_of(low), high + 1, size) if low is not None else []:
+            name = partitions.create_detached(conn, start)
+            conn.execute(text('INSERT INTO {1} ({0}) SELECT {0} FROM transaction_plain WHERE block_height >= :start AND block_height < :end'
+                              .format(columns, name)), {'start': start, 'end': start + size})
+            partitions.attach(conn, start)
+        conn.execute(text('DROP TABLE transaction_plain'))
+
+    return partitions
+
+
+if __name__ == '__main__':
+    # python partitioning.py convert <size> | detach <start>
+    import databaseDTO
+
+    sys.argv, args = sys.argv[:1], sys.argv[1:]
+    databaseDTO.bootstrap_db()
+
+    match args:
+        case ['convert', size]:
+            convert_to_partitioned(databaseDTO.engine, int(size))
+        case ['detach', start]:
+            with databaseDTO.engine.connect() as conn:
+                partitions = PartitionManager().load(conn)
+            partitions.detach_partition(databaseDTO.engine, int(start))
+        case _:
+            print("usage: partitioning.py convert <size> | detach <start>")
@@ -0,0 +1,80 @@
+import asyncio
+from collections import deque
+
+
+#CONFIGURATION
+FETCH_WORKERS = 8         # Full blocks downloaded concurrently
+FETCH_WINDOW = 64         # Max blocks downloaded (or in download) but not yet consumed -> backpressure
+HEADER_LOOKAHEAD = 1024   # Max resolved (height,hash) pairs waiting to be scheduled
+
+#####################################################################################################################
+
+_END = object()
+
+
+# Resolves the hash chain from (tip_height,tip_hash) down to stop_height (excluded) in a background task.
+# prev_hash_of(b_hash) is a coroutine returning the PrevBlockHashHex of b_hash (header request, DB lookup...)
+async def walk_chain(tip_height, tip_hash, prev_hash_of, stop_height=0, lookahead=HEADER_LOOKAHEAD):
+    resolved = asyncio.Queue(maxsize=lookahead)
+
+    async def walker():
+        height, b_hash = tip_height, tip_hash
+        try:
+            while height > stop_height:
+                await resolved.put((height, b_hash))
+                b_hash = await prev_hash_of(b_hash)
+                height -= 1
+            await resolved.put(_END)
+        except Exception as e:
+            await resolved.put(e)
+
+    task = asyncio.create_task(walker())
+
+    try:
+        while True:
+            item = await resolved.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        task.cancel()
+
+
+# Downloads blocks with a bounded number of concurrent fetches and yields them back in the same order of jobs.
+# jobs -> async iterable of (height, b_hash, action), blocks are fetched only if action != "skip"
+# yields -> (height, b_hash, action, block_data) where block_data is None for skipped jobs
+# At most `window` jobs are in flight, so a slow consumer (the insert stage) stops the downloads
+async def prefetch(jobs, fetch, workers=FETCH_WORKERS, window=FETCH_WINDOW):
+    limit = asyncio.Semaphore(workers)
+    pending = deque()
+
+    async def download(b_hash):
+        async with limit:
+            return await fetch(b_hash)
+
+    try:
+        async for height, b_hash, action in jobs:
+            task = None if action == "skip" else asyncio.create_task(download(b_hash))
+            pending.append((height, b_hash, action, task))
+
+            while len(pending) >= window or (pending and _is_ready(pending[0])):
+                yield await _collect(pending.popleft())
+
+        while pending:
+            yield await _collect(pending.popleft())
+    finally:
+        for _, _, _, task in pending:
+            if task is not None:
+                task.cancel()
+
+
+def _is_ready(job):
+    task = job[3]
+    return task is None or task.done()
+
+
+async def _collect(job):
+    height, b_hash, action, task = job
+    return height, b_hash, action, (None if task is None else await task)
@@ -0,0 +1,122 @@
+import zlib
+
+from sqlalchemy import Boolean, Column, Integer, LargeBinary, MetaData, String, Table, inspect, select, text
+
+from bulk_writer import TX_COLUMNS
+from transactions import Transaction
+
+
+#CONFIGURATION
+RAW_OFFLOAD = False       # New DBs (and -n) keep raw transactions/signatures as binary in `transaction_raw`
+RAW_COMPRESSION = 0       # zlib level of offloaded raw transactions (0 -> none), kept only when it is smaller
+
+#####################################################################################################################
+
+# Optional offload of RawTransactionHex/SignatureHex, by far the widest and least read columns of `transaction`:
+# the writer decodes the hex and stores the bytes (half the size, optionally compressed) in `transaction_raw`,
+# keyed by tx_id_base58, while `transaction` rows keep NULLs there -> the hot heap stays small and cache resident.
+# They are read on demand with load_raw() (either layout). Raw full blocks can also be kept on disk by the block cache.
+#   python raw_store.py offload   (moves the hex of an existing DB, then VACUUM FULL "transaction" to reclaim space)
+
+metadata = MetaData()
+
+transaction_raw = Table('transaction_raw', metadata,
+                        Column('tx_id_base58', String, primary_key=True),
+                        Column('block_height', Integer, index=True),   # Orphaned blocks are deleted by height
+                        Column('raw', LargeBinary),
+                        Column('signature', LargeBinary),
+                        Column('compressed', Boolean))                 # raw is zlib compressed
+
+RAW_COLUMNS = [c.name for c in transaction_raw.columns]
+
+TX_ID = TX_COLUMNS.index('tx_id_base58')
+TX_HEIGHT = TX_COLUMNS.index('block_height')
+TX_RAW = TX_COLUMNS.index('tx_raw_hex')
+TX_SIGNATURE = TX_COLUMNS.index('signature_hex')
+
+
+def is_offloaded(conn):
+    return inspect(conn).has_table(transaction_raw.name)
+
+
+def create_raw_table(conn):
+    transaction_raw.create(conn, checkfirst=True)
+
+
+# Hex already stored in `transaction` -> `transaction_raw` (uncompressed)
+def offload(conn):
+    create_raw_table(conn)
+    conn.execute(text('INSERT INTO transaction_raw (tx_id_base58, block_height, raw, signature, compressed) '
+                      'SELECT tx_id_base58, block_height, decode(tx_raw_hex, \'hex\'), decode(signature_hex, \'hex\'), false '
+                      'FROM "transaction" WHERE tx_raw_hex IS NOT NULL OR signature_hex IS NOT NULL ON CONFLICT DO NOTHING'))
+    return conn.execute(text('UPDATE "transaction" SET tx_raw_hex = NULL, signature_hex = NULL '
+                             'WHERE tx_raw_hex IS NOT NULL OR signature_hex IS NOT NULL')).rowcount
+
+
+# Writer side: transaction rows lose their hex, which becomes a `transaction_raw` row
+class RawStore:
+
+    table = transaction_raw
+    columns = RAW_COLUMNS
+
+    def __init__(self, compression=RAW_COMPRESSION):
+        self.compression = compression
+
+    def encode(self, raw_hex):
+        raw = bytes.fromhex(raw_hex)
+        if (self.compression):
+            compressed = zlib.compress(raw, self.compression)
+            if (len(compressed) < len(raw)):
+                return compressed, True
+        return raw, False
+
+    # Rows in TX_COLUMNS order -> (the same rows without hex, rows in RAW_COLUMNS order)
+    def split(self, txs):
+        rows, raw_rows = [], []
+        for tx in txs:
+            raw_hex, signature_hex = tx[TX_RAW], tx[TX_SIGNATURE]
+            if (raw_hex is None and signature_hex is None):
+                rows.append(tx)
+                continue
+            raw, compressed = self.encode(raw_hex) if raw_hex else (None, False)
+            raw_rows.append((tx[TX_ID], tx[TX_HEIGHT], raw, bytes.fromhex(signature_hex) if signature_hex else None, compressed))
+            row = list(tx)
+            row[TX_RAW] = row[TX_SIGNATURE] = None
+            rows.append(row)
+        return rows, raw_rows
+
+
+# tx id -> (raw transaction, signature) bytes of the stored ones among tx_ids, wherever they are kept
+def load_raw(conn, tx_ids):
+    tx_ids = list(tx_ids)
+    found = {}
+    if (is_offloaded(conn)):
+        query = select(transaction_raw.c.tx_id_base58, transaction_raw.c.raw, transaction_raw.c.signature, transaction_raw.c.compressed) \
+            .where(transaction_raw.c.tx_id_base58.in_(tx_ids))
+        for tx_id, raw, signature, compressed in conn.execute(query):
+            raw = bytes(raw) if raw is not None else None
+            found[tx_id] = (zlib.decompress(raw) if compressed else raw, bytes(signature) if signature is not None else None)
+
+    # Inline hex (not offloaded DB, or rows written before the offload)
+    missing = [tx_id for tx_id in tx_ids if tx_id not in found]
+    if (missing):
+        query = select(Transaction.tx_id_base58, Transaction.tx_raw_hex, Transaction.signature_hex) \
+            .where(Transaction.tx_id_base58.in_(missing), (Transaction.tx_raw_hex.isnot(None)) | (Transaction.signature_hex.isnot(None)))
+        for tx_id, raw_hex, signature_hex in conn.execute(query):
+            found[tx_id] = (bytes.fromhex(raw_hex) if raw_hex else None, bytes.fromhex(signature_hex) if signature_hex else None)
+    return found
+
+
+if __name__ == '__main__':
+    import sys
+    import databaseDTO
+
+    sys.argv, args = sys.argv[:1], sys.argv[1:]
+    if (args != ['offload']):
+        print("usage: raw_store.py offload")
+        exit(-1)
+
+    databaseDTO.bootstrap_db()
+    with databaseDTO.engine.begin() as conn:
+        moved = offload(conn)
+    print(" - {} transactions offloaded, run VACUUM FULL \"transaction\" to reclaim the space of their hex -".format(moved))
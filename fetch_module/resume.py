@@ -0,0 +1,60 @@
+from sqlalchemy import func
+
+from transactions import Block, Transaction
+
+
+# What a (re)started fetch has to do, computed from two aggregate queries instead of probing every block.
+# prev_hashes -> PrevBlockHashHex of every stored block (lets the chain walk skip header requests)
+# partial -> stored blocks missing some transactions, with the ids of the transactions they already have
+class ResumePlan:
+
+    def __init__(self, prev_hashes, partial):
+        self.prev_hashes = prev_hashes
+        self.partial = partial
+
+    def action(self, b_hash):
+        if (b_hash not in self.prev_hashes):
+            return "clean"  #this miss in db -> clean insert
+        if (b_hash in self.partial):
+            return "dirty"  #here i have been interrupted, add the rest -> dirty insert
+        return "skip"       #everything good,SKIP
+
+    def prev_hash_of(self, b_hash):
+        return self.prev_hashes.get(b_hash)
+
+    def stored_tx_ids(self, b_hash):
+        return self.partial.get(b_hash, set())
+
+
+# heights -> (low, high) to plan only that interval (i.e. a backfill shard)
+def load_resume_plan(session, heights=None):
+    stored_txs = session.query(Transaction.block_hash, func.count().label('n'))
+    if (heights is not None):
+        stored_txs = stored_txs.filter(Transaction.block_height.between(*heights))
+    stored_txs = stored_txs.group_by(Transaction.block_hash).subquery()
+
+    # Transactions with no parser never get stored, the block counts them apart
+    n_stored = func.coalesce(stored_txs.c.n, 0) + func.coalesce(Block.tx_skipped, 0)
+    blocks = session.query(Block.block_hash, Block.prev_block_hash, Block.tx_number, n_stored) \
+                    .outerjoin(stored_txs, stored_txs.c.block_hash == Block.block_hash)
+    if (heights is not None):
+        blocks = blocks.filter(Block.block_height.between(*heights))
+
+    prev_hashes = {}
+    partial = {}
+    for b_hash, prev_hash, tx_number, n_stored in blocks.yield_per(50000):
+        prev_hashes[b_hash] = prev_hash
+        if (n_stored != tx_number):
+            partial[b_hash] = set()
+
+    if (partial):
+        partial_txs = session.query(Transaction.block_hash, Transaction.tx_id_base58) \
+                             .join(stored_txs, stored_txs.c.block_hash == Transaction.block_hash) \
+                             .join(Block, Block.block_hash == Transaction.block_hash) \
+                             .filter(stored_txs.c.n + func.coalesce(Block.tx_skipped, 0) != Block.tx_number)
+        if (heights is not None):
+            partial_txs = partial_txs.filter(Block.block_height.between(*heights))
+        for b_hash, tx_id in partial_txs.yield_per(50000):
+            partial[b_hash].add(tx_id)
+
+    return ResumePlan(prev_hashes, partial)
@@ -0,0 +1,29 @@
+import os
+import sys
+import uuid
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+# Modules of fetch_module import each other by name (they are run from that directory)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fetch_module'))
+
+
+# Engine on a throwaway schema of the configured database, tests using it are skipped when it isn't reachable
+@pytest.fixture
+def db_engine():
+    import databaseDTO
+    schema = 'test_{}'.format(uuid.uuid4().hex[:12])
+    try:
+        admin = create_engine(databaseDTO.db_url())
+        with admin.begin() as conn:
+            conn.execute(text('CREATE SCHEMA {}'.format(schema)))
+    except OperationalError:
+        pytest.skip('database not reachable')
+    engine = create_engine(databaseDTO.db_url(), connect_args={'options': '-csearch_path={}'.format(schema)})
+    yield engine
+    engine.dispose()
+    with admin.begin() as conn:
+        conn.execute(text('DROP SCHEMA {} CASCADE'.format(schema)))
+    admin.dispose()
@@ -0,0 +1,58 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import text
+
+from backfill import claim_shard, complete_shard, plan_shards, renew_lease, shard_status
+
+
+def expire(engine, start):
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE backfill_shard SET lease_until = now() - interval '1 second' WHERE start_height = :start"),
+                     {'start': start})
+
+
+def test_plan_shards_aligned(db_engine):
+    plan_shards(db_engine, 7, 95, 30)
+    with db_engine.connect() as conn:
+        assert conn.execute(text('SELECT start_height, end_height FROM backfill_shard ORDER BY 1')).fetchall() == \
+            [(7, 29), (30, 59), (60, 89), (90, 95)]
+
+
+def test_claims_never_share_a_shard(db_engine):
+    plan_shards(db_engine, 1, 199, 10)
+    with ThreadPoolExecutor(8) as pool:
+        claims = list(pool.map(lambda i: claim_shard(db_engine, 'w{}'.format(i)), range(25)))
+    starts = [shard[0] for shard in claims if shard is not None]
+    assert len(starts) == 20 and len(set(starts)) == 20
+    assert claims.count(None) == 5
+    assert claim_shard(db_engine, 'late') is None
+
+
+def test_expired_lease_is_claimed_again(db_engine):
+    plan_shards(db_engine, 1, 19, 10)
+    assert claim_shard(db_engine, 'a') == (10, 19)
+    assert claim_shard(db_engine, 'b') == (1, 9)
+    assert claim_shard(db_engine, 'c') is None
+    expire(db_engine, 10)
+    assert claim_shard(db_engine, 'c') == (10, 19)
+    with db_engine.connect() as conn:
+        assert conn.execute(text('SELECT worker, attempts FROM backfill_shard WHERE start_height = 10')).one() == ('c', 2)
+
+
+def test_renewal_fails_once_taken(db_engine):
+    plan_shards(db_engine, 1, 9, 10)
+    claim_shard(db_engine, 'a')
+    assert renew_lease(db_engine, 1, 'a')
+    assert not renew_lease(db_engine, 1, 'b')
+    expire(db_engine, 1)
+    assert claim_shard(db_engine, 'b') == (1, 9)
+    assert not renew_lease(db_engine, 1, 'a')
+    assert renew_lease(db_engine, 1, 'b')
+
+    complete_shard(db_engine, 1, 'a')     # The former owner can't complete it either
+    assert shard_status(db_engine) == [('leased', 1, 9)]
+    complete_shard(db_engine, 1, 'b')
+    assert shard_status(db_engine) == [('done', 1, 9)]
+    assert not renew_lease(db_engine, 1, 'b')
+    expire(db_engine, 1)
+    assert claim_shard(db_engine, 'c') is None
@@ -0,0 +1,54 @@
+from sqlalchemy import BigInteger, Boolean, Column, Integer, LargeBinary, MetaData, Numeric, String, Table, select, text
+
+from bench import SyntheticChain
+from bulk_writer import TX_HEIGHT, BulkWriter, _copy_value, block_rows, copy_rows
+from transactions import Block, Transaction
+
+TRICKY = ['back\\slash', 'tab\there', 'new\nline', 'carriage\rreturn', '\\N', 'NULL', '\\x414243', '\\\\x00', '',
+          'end\\', '\\t\\n', 'ünïcode ✓']
+BYTES = [b'', b'\x00', b'\\x', b'\t\n\\', bytes(range(256))]
+
+
+def test_copy_value_escapes():
+    assert _copy_value(None) == '\\N'
+    assert _copy_value(True) == 't' and _copy_value(False) == 'f'
+    assert _copy_value('a\\b\tc\nd') == 'a\\\\b\\tc\\nd'
+    assert _copy_value('\\N') == '\\\\N'                  # A string, not NULL
+    assert _copy_value(b'\x00\xff') == '\\\\x00ff'
+    assert _copy_value(2 ** 200) == str(2 ** 200)
+
+
+def test_copy_rows_round_trip(db_engine):
+    table = Table('copy_check', MetaData(), Column('id', Integer, primary_key=True), Column('s', String),
+                  Column('b', LargeBinary), Column('flag', Boolean), Column('big', Numeric(78, 0)), Column('n', BigInteger))
+    table.create(db_engine)
+    rows = [(i, s, BYTES[i % len(BYTES)], i % 2 == 0, 2 ** 255 + i, -i) for i, s in enumerate(TRICKY)]
+    rows.append((len(rows), None, None, None, None, None))
+    with db_engine.begin() as conn:
+        copy_rows(conn, table.name, [c.name for c in table.columns], rows)
+    with db_engine.connect() as conn:
+        stored = [tuple(row) for row in conn.execute(select(table).order_by(table.c.id))]
+    assert [(i, s, None if b is None else bytes(b), flag, big, n) for i, s, b, flag, big, n in stored] == rows
+
+
+def test_batches_never_split_a_block(db_engine):
+    Block.__table__.create(db_engine)
+    Transaction.__table__.create(db_engine)
+    parsed = [block_rows(b) for b in SyntheticChain(mix={"LIKE": 3, "FOLLOW": 1}, txs_per_block=6, seed=5).blocks(40)]
+    batches = []
+
+    # Runs in the DB transaction of every batch: each block written so far has all its transactions
+    def check(conn, txs):
+        batches.append((len({tx[TX_HEIGHT] for tx in txs}), len(txs)))
+        assert conn.execute(text('SELECT count(*) FROM block b WHERE tx_number - coalesce(tx_skipped, 0) <> '
+                                 '(SELECT count(*) FROM "transaction" t WHERE t.block_hash = b.block_hash)')).scalar() == 0
+
+    with BulkWriter(db_engine, batch_blocks=5, batch_txs=20, derived=check) as writer:
+        for block in parsed:
+            writer.add(block.block, block.txs)
+            assert writer.n_blocks < 5 and len(writer.txs) < 20    # Flushed as soon as either limit is reached
+
+    assert sum(n for n, _ in batches) == 40 and sum(n for _, n in batches) == sum(len(b.txs) for b in parsed)
+    for n_blocks, n_txs in batches[:-1]:
+        assert n_blocks == 5 or (n_blocks < 5 and n_txs >= 20)
+    assert len(batches) > 40 // 5       # The transaction limit was hit too
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+from feed import ChangeFeed, NdjsonLog, Sink, read, segments
+
+
+def publish(log, n, per_batch=3):
+    for i in range(0, n, per_batch):
+        log.publish([{'type': 'rollback', 'height': h} for h in range(i, min(i + per_batch, n))])
+
+
+def test_offsets_consecutive_across_segments(tmp_path):
+    log = NdjsonLog(str(tmp_path), segment_bytes=200, keep_segments=0)
+    publish(log, 40)
+    found = segments(str(tmp_path))
+    assert len(found) > 3
+    records = list(read(str(tmp_path)))
+    assert [r['offset'] for r in records] == list(range(40))
+    assert [r['height'] for r in records] == list(range(40))
+    for first, path in found:      # Every segment is named after its first record
+        with open(path) as f:
+            assert f.readline().startswith('{{"offset":{},'.format(first))
+    assert [r['offset'] for r in read(str(tmp_path), 25)] == list(range(25, 40))
+
+
+def test_partial_last_line_truncated(tmp_path):
+    log = NdjsonLog(str(tmp_path))
+    publish(log, 5)
+    _, path = segments(str(tmp_path))[-1]
+    with open(path, 'ab') as f:
+        f.write(b'{"offset":5,"type":"roll')       # Append cut short by a crash
+    assert [r['offset'] for r in read(str(tmp_path))] == list(range(5))
+    publish(log, 2)
+    records = list(read(str(tmp_path)))
+    assert [r['offset'] for r in records] == list(range(7))
+    assert [r['height'] for r in records[5:]] == [0, 1]
+    with open(path, 'rb') as f:
+        assert all(line.startswith(b'{"offset":') for line in f)
+
+
+def test_retention(tmp_path):
+    log = NdjsonLog(str(tmp_path), segment_bytes=200, keep_segments=2)
+    publish(log, 60)
+    found = segments(str(tmp_path))
+    assert len(found) == 2
+    offsets = [r['offset'] for r in read(str(tmp_path))]
+    assert offsets[0] == found[0][0] and offsets == list(range(found[0][0], 60))
+
+
+class Failing(Sink):
+
+    def publish(self, records):
+        raise OSError('disk full')
+
+
+def test_failing_sink_doesnt_raise():
+    ChangeFeed(Failing()).rollback(3)
+    with pytest.raises(OSError):
+        ChangeFeed(Failing(), strict=True).rollback(3)
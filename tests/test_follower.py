@@ -0,0 +1,144 @@
+import asyncio
+import json
+
+import pytest
+
+import follower
+from bench import SyntheticChain
+from follower import POLL_GROWTH, POLL_MAX, POLL_MIN, TipFollower
+from node_client import NodeError
+
+
+# Node serving a chain of full blocks (lowest first) whose last one is the tip
+class FakeNode:
+
+    def __init__(self, chain):
+        self.serve(chain)
+        self.fetched = []
+        self.fail = False
+
+    def serve(self, chain):
+        self.blocks = {block['Header']['BlockHashHex']: block for block in chain}
+        self.tip = chain[-1]['Header']
+
+    async def get_last_block(self):
+        if (self.fail):
+            raise NodeError("GET lastblock failed")
+        return {'Header': self.tip}
+
+    async def get_full_block_raw(self, b_hash):
+        self.fetched.append(b_hash)
+        return json.dumps(self.blocks[b_hash]).encode()
+
+
+# What the follower asks the DB, on a dict of stored blocks
+class FakeDB:
+
+    def __init__(self, chain):
+        self.stored = {block['Header']['BlockHashHex']: block['Header']['Height'] for block in chain}
+        self.rolled_back = []    # Heights rolled back, by rollback
+        self.chunks = []         # Heights inserted, by chunk
+        self.aborted = 0
+
+    async def run_db(self, func, *args):
+        return getattr(self, func.__name__)(*args)
+
+    def recent_blocks(self, depth):
+        top = max(self.stored.values(), default=None)
+        return {b_hash: h for b_hash, h in self.stored.items() if h >= top - depth}
+
+    def rollback_above(self, height):
+        orphans = sorted(h for h in self.stored.values() if h > height)
+        self.stored = {b_hash: h for b_hash, h in self.stored.items() if h <= height}
+        self.rolled_back.append(orphans)
+        return len(orphans)
+
+    def insert_branch(self, chunk):
+        for parsed in chunk:
+            assert not self.stored or parsed.prev_hash in self.stored, "block written before its parent"
+            self.stored[parsed.block_hash] = parsed.height
+        self.chunks.append([parsed.height for parsed in chunk])
+
+    def max_block_h(self):
+        return max(self.stored.values())
+
+    def abort_pending(self):
+        self.aborted += 1
+
+
+def extend(chain, n, seed):
+    source = SyntheticChain(mix={"LIKE": 1}, txs_per_block=1, seed=seed)
+    chain = list(chain)
+    for _ in range(n):
+        prev = chain[-1]['Header'] if chain else {'BlockHashHex': '0' * 64, 'Height': 0}
+        chain.append(source.block(prev['Height'] + 1, prev['BlockHashHex']))
+    return chain
+
+
+def hashes(chain):
+    return [block['Header']['BlockHashHex'] for block in chain]
+
+
+def follower_of(node, db, tmp_path):
+    return TipFollower(node, db.run_db, status_file=str(tmp_path / 'status.json'))
+
+
+def test_fork_rolled_back_to_ancestor(tmp_path):
+    stored = extend([], 10, seed=1)
+    forked = extend(stored[:7], 5, seed=2)          # Leaves 8-10 at height 7, tip at 12
+    node, db = FakeNode(forked), FakeDB(stored)
+    tip = follower_of(node, db, tmp_path)
+
+    assert asyncio.run(tip.step())
+    assert db.rolled_back == [[8, 9, 10]]
+    assert db.chunks == [[8, 9, 10, 11, 12]]
+    assert db.stored == {b_hash: i + 1 for i, b_hash in enumerate(hashes(forked))}
+    assert tip.rollbacks == 1 and tip.stored_height == 12 and tip.lag_blocks == 0
+    assert not asyncio.run(tip.step())                    # Same tip: nothing asked to the DB
+    assert db.chunks == [[8, 9, 10, 11, 12]]
+
+
+def test_long_branch_written_by_chunks_oldest_first(tmp_path, monkeypatch):
+    monkeypatch.setattr(follower, 'BRANCH_CHUNK', 3)
+    stored = extend([], 5, seed=1)
+    chain = extend(stored, 8, seed=3)
+    node, db = FakeNode(chain), FakeDB(stored)
+    tip = follower_of(node, db, tmp_path)
+
+    branch, kept, ancestor = asyncio.run(tip.new_branch(node.tip, db.recent_blocks(follower.MAX_REORG_DEPTH)))
+    assert branch == hashes(chain[5:])[::-1] and ancestor == 5
+    assert list(kept) == hashes(chain[5:8])[::-1]        # The oldest ones walked, written first
+
+    node.fetched = []
+    assert asyncio.run(tip.step())
+    assert db.rolled_back == []                           # The ancestor is the highest stored block
+    assert db.chunks == [[6, 7, 8], [9, 10, 11], [12, 13]]
+    assert node.fetched[:8] == hashes(chain[5:])[::-1]   # Walk, then blocks not kept fetched again
+    assert node.fetched[8:] == hashes(chain[8:])
+    assert len(db.stored) == 13
+
+
+def test_poll_interval_backs_off(tmp_path, monkeypatch):
+    chain = extend([], 3, seed=1)
+    node, db = FakeNode(chain), FakeDB(chain[:2])
+    tip = follower_of(node, db, tmp_path)
+    intervals = []
+
+    async def sleep(seconds):
+        intervals.append(seconds)
+        if (len(intervals) == 3):
+            node.serve(extend(chain, 1, seed=4))            # The tip moves
+        elif (len(intervals) == 13):
+            node.fail = True
+        elif (len(intervals) == 14):
+            raise asyncio.CancelledError
+
+    monkeypatch.setattr(follower.asyncio, 'sleep', sleep)
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(tip.run())
+    growth = [min(POLL_MAX, POLL_MIN * POLL_GROWTH ** i) for i in range(10)]
+    assert growth[-1] == POLL_MAX
+    assert intervals == [POLL_MIN] + growth[1:3] + growth + [POLL_MAX]
+    assert all(POLL_MIN <= seconds <= POLL_MAX for seconds in intervals)
+    assert tip.errors == 1 and db.aborted == 1
+    assert json.loads((tmp_path / 'status.json').read_text())['errors'] == 1
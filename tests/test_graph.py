@@ -0,0 +1,73 @@
+from itertools import permutations
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import graph
+from graph import Graph
+
+
+def build(edges, n=None):
+    n = n if n is not None else max(max(a, b) for a, b in edges) + 1
+    src = np.array([a for a, _ in edges], dtype=np.int32)
+    dst = np.array([b for _, b in edges], dtype=np.int32)
+    weight = np.arange(1, len(edges) + 1, dtype=np.float64)
+    return Graph(['k{}'.format(i) for i in range(n)], src, dst, weight, np.ones(len(edges), dtype=np.int64))
+
+
+def cycles(found):
+    members, _ = found
+    return sorted(zip(*(m.tolist() for m in members)))
+
+
+# Every cycle of that length, from its smallest member
+def brute_cycles(edges, length):
+    edges = set(edges)
+    nodes = sorted({v for edge in edges for v in edge})
+    found = set()
+    for path in permutations(nodes, length):
+        if (path[0] == min(path) and all((path[i], path[(i + 1) % length]) in edges for i in range(length))):
+            found.add(path)
+    return sorted(found)
+
+
+# Two triangles sharing node 2, a 2-cycle, a 3-cycle the other way round and a few edges closing nothing
+EDGES = [(0, 1), (1, 2), (2, 0), (2, 3), (3, 4), (4, 2), (1, 0), (5, 6), (6, 5), (7, 6), (8, 7), (6, 8),
+         (3, 9), (9, 10), (0, 9), (4, 3), (10, 0)]
+
+
+def test_pagerank_sums_to_one_with_dangling_nodes():
+    g = build([(0, 1), (1, 2), (2, 0), (0, 3), (4, 3)], n=6)    # 3 and 5 have no out-edges
+    rank = g.pagerank()
+    assert rank.sum() == pytest.approx(1)
+    assert (rank > 0).all()
+    assert rank[5] == pytest.approx(rank[4])     # Both only get the teleport/dangling share
+    assert rank[3] > rank[4]
+
+
+def test_component_labels_by_decreasing_size():
+    g = build([(0, 1), (2, 1), (3, 4), (5, 6), (6, 7), (7, 5), (8, 5)], n=10)
+    labels = g.components().tolist()
+    assert labels[5] == labels[6] == labels[7] == labels[8] == 0
+    assert labels[0] == labels[1] == labels[2] == 1
+    assert labels[3] == labels[4] == 2
+    assert labels[9] == 3
+
+
+def test_two_and_three_cycles():
+    g = build(EDGES)
+    assert cycles(g.two_cycles()) == brute_cycles(EDGES, 2) == [(0, 1), (3, 4), (5, 6)]
+    assert cycles(g.three_cycles()) == brute_cycles(EDGES, 3) == [(0, 1, 2), (0, 9, 10), (2, 3, 4), (6, 8, 7)]
+
+    members, edges = g.three_cycles()
+    for (a, b, c), (e1, e2, e3) in zip(zip(*members), zip(*edges)):
+        assert (g.src[e1], g.indices[e1]) == (a, b)
+        assert (g.src[e2], g.indices[e2]) == (b, c)
+        assert (g.src[e3], g.indices[e3]) == (c, a)
+
+
+@pytest.mark.parametrize('chunk', [1, 2, 3, 5])
+def test_three_cycles_across_chunks(monkeypatch, chunk):
+    monkeypatch.setattr(graph, 'CYCLE_CHUNK', chunk)
+    assert cycles(build(EDGES).three_cycles()) == brute_cycles(EDGES, 3)
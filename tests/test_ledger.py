@@ -0,0 +1,40 @@
+from bench import SyntheticChain
+from bulk_writer import TX_COLUMNS, block_rows
+from ledger import COIN_SELL_FEE_BP, deltas, row_deltas
+
+# Types moving DeSo only between accounts (no creation/burn) -> DeSo of a block is conserved once its reward is its fees
+MIX = {"LIKE": 30, "FOLLOW": 15, "SUBMIT_POST": 20, "UPDATE_PROFILE": 2, "PRIVATE_MESSAGE": 5, "MESSAGING_GROUP": 1,
+       "AUTHORIZE_DERIVED_KEY": 1, "NFT_BID": 3, "CREATE_NFT": 1, "UPDATE_NFT": 1, "BASIC_TRANSFER": 10,
+       "CREATOR_COIN_TRANSFER": 2, "NFT_TRANSFER": 1}
+
+MINE_FEE = TX_COLUMNS.index('mine_fee')
+AMOUNT = TX_COLUMNS.index('amount')
+TX_TYPE = TX_COLUMNS.index('tx_type')
+
+
+# Rows of a synthetic block whose reward is the sum of its fees, and that reward
+def block_txs(seed):
+    chain = SyntheticChain(mix=MIX, txs_per_block=128, users=200, seed=seed)
+    txs = [list(tx) for tx in block_rows(next(chain.blocks(1))).txs]
+    reward = next(tx for tx in txs if tx[TX_TYPE] == 'BlockReward')
+    reward[AMOUNT] = sum(tx[MINE_FEE] for tx in txs)
+    return txs, reward
+
+
+def test_fee_debits_equal_reward_credits():
+    for seed in range(5):
+        txs, reward = block_txs(seed)
+        changes = row_deltas(txs)
+        deso = [amount for (_, asset_type, _, _), amount in changes.items() if asset_type == 'deso']
+        assert reward[AMOUNT] > 0
+        assert -sum(amount for amount in deso if amount < 0) == sum(amount for amount in deso if amount > 0)
+
+
+def test_creator_coin_sell_credits_proceeds():
+    sell = {column: None for column in TX_COLUMNS}
+    sell.update(tx_type='CreatorCoin', block_height=7, tx_transactor_base58='seller', other_us_base58='creator',
+                mine_fee=100, is_buy=False, amount=5000, deso_locked_diff=-2000000)
+    assert deltas([sell]) == {('seller', 'creator_coin', 'creator', 7): -5000,
+                              ('seller', 'deso', '', 7): 2000000 * (10000 - COIN_SELL_FEE_BP) // 10000 - 100}
+    sell['deso_locked_diff'] = None     # Stored before the node (or this schema) reported it
+    assert deltas([sell]) == {('seller', 'creator_coin', 'creator', 7): -5000, ('seller', 'deso', '', 7): -100}
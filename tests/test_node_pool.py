@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from node_client import NodeError, NodeRequestError
+from node_pool import NodePool
+
+
+class FakeClient:
+
+    def __init__(self, url, error=None):
+        self.base_url = url
+        self.error = error
+        self.calls = 0
+
+    async def get_header(self, b_hash):
+        self.calls += 1
+        if (self.error is not None):
+            raise self.error
+        return {'Header': {'BlockHashHex': b_hash, 'Node': self.base_url}}
+
+    async def close(self):
+        pass
+
+
+def pool_of(*clients):
+    pool = NodePool(urls=[client.base_url for client in clients], max_attempts=3)
+    for node, client in zip(pool.nodes, clients):
+        asyncio.run(node.client.close())
+        node.client = client
+    return pool
+
+
+def test_client_errors_are_not_retried_on_another_node():
+    wrong = FakeClient('http://a', NodeRequestError("POST /api/v1/block -> HTTP 404: not found", 404))
+    other = FakeClient('http://b')
+    pool = pool_of(wrong, other)
+    pool.nodes[1].latency = 1.0                 # The failing node is picked first
+
+    with pytest.raises(NodeRequestError) as raised:
+        asyncio.run(pool.get_header('ab'))
+    assert raised.value.status == 404
+    assert (wrong.calls, other.calls) == (1, 0)
+    assert pool.nodes[0].failures == 0 and pool.nodes[0].errors == 0 and pool.nodes[0].cooldown_until == 0
+
+
+def test_node_errors_fail_over():
+    down = FakeClient('http://a', NodeError("POST /api/v1/block -> HTTP 503"))
+    up = FakeClient('http://b')
+    pool = pool_of(down, up)
+    pool.nodes[1].latency = 1.0
+
+    assert asyncio.run(pool.get_header('ab'))['Header']['Node'] == 'http://b'
+    assert (down.calls, up.calls) == (1, 1)
+    assert pool.nodes[0].failures == 1 and pool.nodes[0].errors > 0
+    assert pool.nodes[1].failures == 0
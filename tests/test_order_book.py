@@ -0,0 +1,89 @@
+import json
+from collections import namedtuple
+
+from sqlalchemy import select, text
+
+from order_book import Replay, _lock_state, advance, create_order_book, dao_book_state, reset_above
+from transactions import Block, Transaction
+
+Event = namedtuple('Event', ['tx_id_base58', 'block_height', 'tx_index', 'tx_transactor_base58', 'buying_coin_base58',
+                             'selling_coin_base58', 'dao_exchange_rate', 'dao_coins', 'dao_fills_json'])
+
+
+class NoOrders:
+
+    def execute(self, query):
+        return []
+
+
+def order(tx_id, height, transactor, rate, quantity, fills=(), tx_index=0):
+    return Event(tx_id, height, tx_index, transactor, 'A', 'B', rate, quantity, json.dumps(list(fills)) if fills else None)
+
+
+def fill(transactor, bought, fulfilled=False, buying='A', selling='B'):
+    return {'transactor': transactor, 'buying': buying, 'selling': selling, 'bought': str(bought), 'sold': str(bought),
+            'fulfilled': fulfilled}
+
+
+def replay(events):
+    book = Replay(NoOrders(), events)
+    for event in events:
+        book.apply(event)
+    return book
+
+
+def test_fills_match_best_rate_then_oldest():
+    resting = [order('low', 1, 'maker', 5, 100), order('old', 2, 'maker', 7, 100), order('new', 3, 'maker', 7, 100),
+               order('same_height', 3, 'maker', 7, 100, tx_index=1)]
+    taker = Event('t1', 4, 0, 'taker', 'B', 'A', 1, 250,
+                  json.dumps([fill('maker', 100, True), fill('maker', 60), fill('taker', 160, buying='B', selling='A')]))
+    book = replay(resting + [taker])
+    assert [f['order_id'] for f in book.fills] == ['old', 'new', None]
+    assert sorted(book.orders) == ['low', 'new', 'same_height', 't1']
+    assert book.orders['new']['quantity_remaining'] == 40
+    assert book.orders['t1']['quantity_remaining'] == 90
+
+    book = replay(resting[:1] + resting[2:] + [taker])     # Same rate and height -> lowest tx_index first
+    assert [f['order_id'] for f in book.fills][:2] == ['new', 'same_height']
+
+
+def test_market_and_fulfilled_orders_never_rest():
+    resting = [order('maker_order', 1, 'maker', 5, 100)]
+    market = Event('m1', 2, 0, 'taker', 'B', 'A', 0, 500,
+                   json.dumps([fill('maker', 30), fill('taker', 30, buying='B', selling='A')]))
+    book = replay(resting + [market])
+    assert sorted(book.orders) == ['maker_order']
+    assert book.orders['maker_order']['quantity_remaining'] == 70
+
+    filled = Event('f1', 3, 0, 'taker', 'B', 'A', 9, 500,
+                   json.dumps([fill('maker', 70), fill('taker', 70, True, buying='B', selling='A')]))
+    book = replay(resting + [filled])
+    assert sorted(book.orders) == ['maker_order']       # Fulfilled as reported, whatever its quantity says
+
+
+def test_stale_mark_never_waits_on_a_replay(db_engine):
+    Block.__table__.create(db_engine)
+    Transaction.__table__.create(db_engine)
+    create_order_book(db_engine)
+    with db_engine.begin() as conn:
+        conn.execute(text("INSERT INTO block (block_hash, block_height) SELECT 'b' || h, h FROM generate_series(1, 30) h"))
+    with db_engine.begin() as conn:
+        assert advance(conn, heights=20) == 20
+
+    replaying = db_engine.connect()
+    transaction = replaying.begin()
+    assert _lock_state(replaying, wait=True) == 20       # catch_up's advance holds the state row
+    with db_engine.begin() as conn:
+        conn.execute(text("SET LOCAL lock_timeout = '1s'"))
+        reset_above(conn, 9)                              # Orders written at height 10 by a writer
+        assert advance(conn) == 0                         # The writer's own advance skips the locked book
+    transaction.commit()
+    replaying.close()
+
+    with db_engine.begin() as conn:
+        assert advance(conn) == 30                        # Stale: replayed from the lowest height
+        assert advance(conn) == 0
+    with db_engine.begin() as conn:
+        reset_above(conn, 40)                             # Above the replayed height: not stale
+        assert advance(conn) == 0
+        assert conn.execute(select(dao_book_state.c.processed_height)).scalar() == 30
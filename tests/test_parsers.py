@@ -0,0 +1,19 @@
+from parsers import raw_tx_identity
+
+KEY = '02' * 33
+
+
+# Inputs (TxID, index), outputs (public key, uvarint amount), then the TxnType and its metadata
+def raw_tx(inputs, amounts, tx_type):
+    data = '{:02x}'.format(len(inputs)) + ''.join(tx_id * 32 + '{:02x}'.format(index) for tx_id, index in inputs)
+    data += '{:02x}'.format(len(amounts)) + ''.join(KEY + amount for amount in amounts)
+    return data + tx_type + '00' * 8
+
+
+def test_raw_tx_identity():
+    assert raw_tx_identity(raw_tx([('aa', 0), ('bb', 3)], ['ac02', '05'], '02')) == 'BasicTransfer'
+    assert raw_tx_identity(raw_tx([], ['e807'], '09')) == 'Follow'
+    assert raw_tx_identity(raw_tx([], [], '1a')) == 'DaoCoinLimitOrder'
+    assert raw_tx_identity(raw_tx([], [], '0d')) is None     # UPDATE_GLOBAL_PARAMS, no parser
+    assert raw_tx_identity('01aa') is None                     # Truncated
+    assert raw_tx_identity('not hex') is None